@@ -9,4 +9,10 @@
     
 """
 
-from .stats import Stats
\ No newline at end of file
+import time as _time
+_started = _time.time()
+
+from .stats import Stats
+from .metrics import import_times as _import_times
+
+_import_times[__name__] = _time.time() - _started
\ No newline at end of file
@@ -1,6 +1,13 @@
-from twisted.web import static, server, wsgi, resource
+from twisted.web import server, wsgi, resource
 from twisted.internet import reactor
-from flask import Flask, render_template, url_for, abort, redirect, request
+from flask import Flask, render_template, url_for, abort, redirect, request, jsonify
+import stats.proc_rrd as rrdtool
+from .graphs import GraphResource, GraphFile
+from .charts import ChartResource
+from .export import ExportResource
+from .metrics import MetricsResource
+from .cluster import ClusterResource, GraphProxyResource
+from .admin import AdminResource
 
 class Root(resource.Resource):
     """ A hackish way to allow us to put children onto a wsgi resource!!! """
@@ -13,6 +20,10 @@ class Root(resource.Resource):
         request.postpath.insert(0, path0)
         return self.wsgi_resource
 
+def filter_graphs(graphs, template_name, period):
+    """ The graphs of `graphs` (id -> template) that are made from template_name and drawn for period. """
+    return (graph for graph in graphs.values() if graph.template == template_name and period in graph.config['periods'])
+
 class WebApp:
     """ The core webapp that powers the front end of the stats server."""
     def __init__(self, stats):
@@ -39,16 +50,40 @@ class WebApp:
             """ Generates an image URL for the graph, and appends a param to it that should invalidate the cache upon graph update. """
             filename = '%s-%s.%i.png' % (graph.id, period, id or 0)
             return url_for('graph', filename = filename, _ = stats.last_draw_timestamp.get(filename, -1))
-                               
+        
+        def chart_url(graph, period, id = 0):
+            """ The URL of the data the browser draws the graph from, when graph_render_mode is 'client'. """
+            return url_for('chart', filename = '%s-%s.%i.json' % (graph.id, period, id or 0))
+        
+        def chart_refresh(period):
+            """ How often, in seconds, the browser should redraw a chart of `period`, as often as it'd be drawn on a timer. """
+            graph_draw_frequency = config['graph_draw_frequency']
+            return graph_draw_frequency.get(period, graph_draw_frequency['default'])
         
         app.jinja_env.globals.update(dict(
-            graph_url = graph_url
-            
+            graph_url = graph_url,
+            chart_url = chart_url,
+            chart_refresh = chart_refresh,
+            client_charts = lambda: config['graph_render_mode'] == 'client'
         ))       
         
+        @app.after_request
+        def conditional(response):
+            """ Pages only change when their graphs are drawn again, so browsers asking for them again only get them if they did. """
+            if request.method == 'GET' and response.status_code == 200 and response.mimetype == 'text/html':
+                response.add_etag(weak = True) # it's the same page, gzipped or not.
+                response.headers['Cache-Control'] = 'no-cache'
+                response = response.make_conditional(request)
+            return response
+        
         @app.route('/graphs/<filename>')
         def graph(filename):
-            """This function will be overwritten by a static.File resource. Leave it here so we can use url_for :)"""
+            """This function will be overwritten by a GraphFile or GraphResource. Leave it here so we can use url_for :)"""
+            return 'You should never see this, this is overwritten by twisted...'
+        
+        @app.route('/charts/<filename>')
+        def chart(filename):
+            """ Overwritten by a ChartResource, like graph() is. """
             return 'You should never see this, this is overwritten by twisted...'
         
         @app.route('/')
@@ -56,6 +91,18 @@ class WebApp:
             return render_template('index.html', templates = templates)
         
         
+        @app.route('/schedule')
+        def schedule():
+            """ How many polls start in each slot of time, to see how evenly they're spread out, and how the scheduler is keeping up. """
+            load = stats.template_runner.poll_load(request.args.get('resolution', 1, type = int) or 1)
+            load['scheduler'] = stats.template_runner.scheduler.stats()
+            load['rrdtool'] = rrdtool.queue_stats()
+            load['pollers'] = stats.pollers.status() if stats.pollers else []
+            renderers = stats.template_runner.renderers
+            load['renderers'] = renderers.status() if renderers else None
+            load['cluster'] = stats.cluster.status() if stats.cluster else None
+            return jsonify(load)
+        
         @app.route('/route', methods = ['POST'])
         def route():
             try:
@@ -83,7 +130,7 @@ class WebApp:
             alias = id
             id = template.aliases_reversed[id]
             
-            _graphs = (graph for graph in graphs.values() if graph.template == template_name and period in graph.config['periods'])
+            _graphs = filter_graphs(graphs, template_name, period)
             
             return render_template('graph.html', graphs = _graphs, period = period, id = id, template=template, templates = templates, alias = alias)
     
@@ -93,8 +140,25 @@ class WebApp:
     def run(self):
         app = self.app = self._create_app()
 
-        wsgi_resource = Root(wsgi.WSGIResource(reactor, self.stats.wsgi_threadpool, app))
-        wsgi_resource.putChild('graphs', static.File(self.stats.config['image_path']))
+        # Pages are gzipped, for the dashboards that reload them all day.
+        wsgi_resource = Root(resource.EncodingResourceWrapper(
+            wsgi.WSGIResource(reactor, self.stats.wsgi_threadpool, app), [server.GzipEncoderFactory()]
+        ))
+        # With charts drawn by the browser, images are only drawn for whoever still asks for one.
+        if self.stats.config['graph_render_mode'] in ('on_demand', 'client'):
+            graphs = GraphResource(self.stats)
+        else:
+            graphs = GraphFile(self.stats, self.stats.config['image_path'])
+        charts = ChartResource(self.stats)
+        if self.stats.cluster is not None:
+            graphs = GraphProxyResource(self.stats, graphs)
+            charts = GraphProxyResource(self.stats, charts, '/charts/', '.json')
+            wsgi_resource.putChild('cluster', ClusterResource(self.stats))
+        wsgi_resource.putChild('graphs', graphs)
+        wsgi_resource.putChild('charts', charts)
+        wsgi_resource.putChild('export', ExportResource(self.stats))
+        wsgi_resource.putChild('metrics', MetricsResource())
+        wsgi_resource.putChild('admin', AdminResource(self.stats))
         
         site = server.Site(wsgi_resource)
         reactor.listenTCP(
@@ -0,0 +1,43 @@
+"""
+    prickle.app.admin
+    ~~~~~~~~~~~~~~~~~
+
+    /admin, for telling a running prickle what to do. Only `admin_hosts` may use it.
+
+    POST /admin/reload reloads the config file, like a SIGHUP does, and answers with the ids of
+    the graphs that were added, removed and changed, see Stats.reload.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import resource
+import json
+
+class AdminResource(resource.Resource):
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+        self.putChild('reload', ReloadResource(stats))
+
+    def getChildWithDefault(self, path, request):
+        if request.getClientIP() not in self.stats.config['admin_hosts']:
+            return resource.ForbiddenResource()
+        return resource.Resource.getChildWithDefault(self, path, request)
+
+class ReloadResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+
+    def render_POST(self, request):
+        changes = self.stats.reload()
+        request.setHeader('content-type', 'application/json')
+        if changes is None:
+            request.setResponseCode(500)
+            return json.dumps(dict(error = 'The config could not be reloaded, see the log.'))
+        return json.dumps(changes)
+
+__all__ = ['AdminResource', 'ReloadResource']
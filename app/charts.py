@@ -0,0 +1,474 @@
+"""
+    prickle.app.charts
+    ~~~~~~~~~~~~~~~~~~
+
+    /charts/<id>-<period>.<index>.json, the data behind a graph for the browser to draw, so that
+    with `graph_render_mode = 'client'` nothing has to run `rrdtool graph` at all.
+
+    What's on a chart comes from the same arguments the template would draw its image with: the
+    title, labels and limits, its DEFs (read straight from the rrd files), CDEFs (worked out
+    here), the LINEs, AREAs and HRULEs it draws, and what its GPRINTs would print in the legend.
+    Every series is cut down to as many points as the chart is pixels wide (its `-w`, or `width`
+    in the query string) with Largest-Triangle-Three-Buckets, which keeps the peaks a plain
+    average would flatten.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import resource, server
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from stats.base.template import _option, _periodSeconds
+from stats.rrdfile import RRDFile
+from .graphs import parse_graph_filename
+import stats.proc_rrd as rrdtool
+import operator
+import logging
+import json
+import math
+import time
+import re
+
+NAN = float('nan')
+INF = float('inf')
+
+class ChartError(Exception):
+    """ A graph uses something of rrdtool's that I can't draw. """
+
+# Colons in legends and formats are escaped, the ones between fields aren't.
+_fields = re.compile(r'(?<!\\):')
+
+def _split(arg):
+    return [field.replace('\\:', ':') for field in _fields.split(arg)]
+
+def _color(spec):
+    """ 'vname#RRGGBB' -> (vname, '#RRGGBB'), the colour is None if there isn't one. """
+    if '#' in spec:
+        vname, color = spec.split('#', 1)
+        return vname, '#' + color
+    return spec, None
+
+def chart_definition(args):
+    """ Works out what a chart shows from the `rrdtool graph` arguments of the image it stands in for. """
+    def option(short, long, default = None):
+        value = _option(args, short, long, default)
+        return value.strip() if isinstance(value, basestring) else value
+
+    lower, upper = option('-l', '--lower-limit'), option('-u', '--upper-limit')
+    chart = dict(
+        title = option('-t', '--title', ''),
+        vertical_label = option('-v', '--vertical-label', ''),
+        lower_limit = float(lower) if lower else None,
+        upper_limit = float(upper) if upper else None,
+        width = int(option('-w', '--width', 400)),
+        height = int(option('-h', '--height', 100)),
+        defs = [], # (vname, filename, ds, cf)
+        cdefs = [], # (vname, rpn)
+        items = [], # (kind, vname, color, label, stack), kind being 'line' or 'area'.
+        rules = [], # (value, color, label)
+        legend = [], # (color, label, [(vname, cf, format), ...])
+    )
+
+    for arg in args:
+        element = arg.split(':', 1)[0]
+        if element == 'DEF':
+            fields = _split(arg)
+            vname, filename = fields[1].split('=', 1)
+            chart['defs'].append((vname, filename, fields[2], fields[3]))
+        elif element == 'CDEF':
+            vname, rpn = arg[5:].split('=', 1)
+            chart['cdefs'].append((vname, rpn.split(',')))
+        elif element == 'VDEF':
+            raise ChartError('VDEF is not supported')
+        elif element in ('AREA', 'LINE', 'LINE1', 'LINE2', 'LINE3'):
+            fields = _split(arg) + ['', '']
+            vname, color = _color(fields[1])
+            stack = 'STACK' in fields[3:]
+            chart['items'].append(('area' if element == 'AREA' else 'line', vname, color, fields[2], stack))
+            chart['legend'].append((color, fields[2], []))
+        elif element == 'HRULE':
+            fields = _split(arg) + ['']
+            value, color = _color(fields[1])
+            chart['rules'].append((float(value), color, fields[2]))
+        elif element == 'GPRINT':
+            fields = _split(arg)
+            if len(fields) != 4:
+                # GPRINT:vdef:format, which needs a VDEF.
+                raise ChartError('GPRINT without a consolidation function is not supported')
+            if not chart['legend']:
+                chart['legend'].append((None, '', []))
+            chart['legend'][-1][2].append((fields[1], fields[2], fields[3]))
+        elif element in ('STACK', 'TICK', 'SHIFT', 'VRULE', 'PRINT'):
+            raise ChartError('%s is not supported' % element)
+
+    return chart
+
+def _divide(a, b):
+    if b == 0:
+        return NAN if a == 0 or a != a else math.copysign(INF, a)
+    return a / b
+
+def _compare(op):
+    def compare(a, b):
+        if a != a or b != b or abs(a) == INF or abs(b) == INF:
+            return NAN
+        return 1.0 if op(a, b) else 0.0
+    return compare
+
+_rpnConstants = {'UNKN': NAN, 'INF': INF, 'NEGINF': -INF}
+_rpnUnary = {
+    'UN': lambda a: 1.0 if a != a else 0.0,
+    'ISINF': lambda a: 1.0 if abs(a) == INF else 0.0,
+    'ABS': abs,
+}
+_rpnBinary = {
+    '+': operator.add, '-': operator.sub, '*': operator.mul, '/': _divide,
+    'GT': _compare(operator.gt), 'GE': _compare(operator.ge), 'LT': _compare(operator.lt),
+    'LE': _compare(operator.le), 'EQ': _compare(operator.eq), 'NE': _compare(operator.ne),
+    'MIN': lambda a, b: NAN if a != a or b != b else min(a, b),
+    'MAX': lambda a, b: NAN if a != a or b != b else max(a, b),
+    'ADDNAN': lambda a, b: b if a != a else a if b != b else a + b,
+}
+
+def rpn(tokens, series, count):
+    """ Evaluates a CDEF's `tokens` over `count` rows of `series` (vname -> values), the way rrdtool would. """
+    program = []
+    for token in tokens:
+        if token in series:
+            program.append((0, series[token]))
+        elif token in _rpnConstants:
+            program.append((1, _rpnConstants[token]))
+        elif token in _rpnUnary:
+            program.append((2, _rpnUnary[token]))
+        elif token in _rpnBinary:
+            program.append((3, _rpnBinary[token]))
+        elif token == 'IF':
+            program.append((4, None))
+        else:
+            try:
+                program.append((1, float(token)))
+            except ValueError:
+                raise ChartError('CDEF operator %r is not supported' % token)
+
+    values = []
+    for i in xrange(count):
+        stack = []
+        try:
+            for kind, value in program:
+                if kind == 0:
+                    stack.append(value[i])
+                elif kind == 1:
+                    stack.append(value)
+                elif kind == 2:
+                    stack.append(value(stack.pop()))
+                elif kind == 3:
+                    b = stack.pop()
+                    stack.append(value(stack.pop(), b))
+                else:
+                    c, b, a = stack.pop(), stack.pop(), stack.pop()
+                    # An unknown condition is false.
+                    stack.append(b if a == a and a != 0 else c)
+        except IndexError:
+            raise ChartError('CDEF %r runs out of stack' % ','.join(tokens))
+        if len(stack) != 1:
+            raise ChartError('CDEF %r leaves %i values on the stack' % (','.join(tokens), len(stack)))
+        values.append(stack[0])
+    return values
+
+_prefixes = ['a', 'f', 'p', 'n', 'u', 'm', '', 'k', 'M', 'G', 'T', 'P', 'E']
+_gprintFormat = re.compile(r'%%|%([-+ 0#]*\d*(?:\.\d+)?)l?([feg])|%([sS])')
+_alignment = re.compile(r'\\[rljcgn]')
+
+def gprint(format, value):
+    """ Formats `value` like rrdtool's GPRINT would, %s and %S scale it down to an SI prefix. """
+    format = _alignment.sub('', format)
+    prefix = ''
+    if '%s' in format or '%S' in format:
+        magnitude = 0
+        if value == value and abs(value) not in (0, INF):
+            magnitude = max(-6, min(6, int(math.floor(math.log10(abs(value)) / 3))))
+        value /= 1000.0 ** magnitude
+        prefix = _prefixes[magnitude + 6]
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(3):
+            return prefix
+        if value != value:
+            return 'nan'
+        return ('%' + match.group(1) + match.group(2)) % value
+    return _gprintFormat.sub(replace, format)
+
+_consolidate = {
+    'MAX': max,
+    'MIN': min,
+    'AVERAGE': lambda values: sum(values) / len(values),
+    'TOTAL': sum,
+    'FIRST': lambda values: values[0],
+    'LAST': lambda values: values[-1],
+}
+
+def consolidate(cf, values):
+    """ What GPRINT:vname:`cf` shows of `values`, unknown values left out. """
+    values = [value for value in values if value == value]
+    if not values or cf not in _consolidate:
+        return NAN
+    return _consolidate[cf](values)
+
+def lttb(points, threshold):
+    """
+        Largest-Triangle-Three-Buckets, picks `threshold` of `points` [(x, y), ...] that keep the shape of the line:
+        the first and the last, and from each of the buckets in between the one making the largest triangle with the
+        point picked before it and the average of the next bucket.
+    """
+    count = len(points)
+    if threshold >= count:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    sampled = [points[0]]
+    every = float(count - 2) / (threshold - 2)
+    a = 0
+    for i in xrange(threshold - 2):
+        start, end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, count)
+        avgX = sum([point[0] for point in points[start:end]]) / float(end - start)
+        avgY = sum([point[1] for point in points[start:end]]) / float(end - start)
+
+        ax, ay = points[a]
+        best, bestArea = None, -1
+        for j in xrange(int(i * every) + 1, start):
+            x, y = points[j]
+            area = abs((ax - avgX) * (y - ay) - (ax - x) * (avgY - ay))
+            if area > bestArea:
+                best, bestArea = j, area
+        sampled.append(points[best])
+        a = best
+
+    sampled.append(points[-1])
+    return sampled
+
+def downsample(times, values, threshold):
+    """
+        Cuts a series down to about `threshold` [time, value] points with lttb, unknown values are gaps in the line: each
+        run between gaps gets its share of the points, and the gaps are kept as a [time, None] where they start.
+    """
+    runs, run = [], []
+    for t, value in zip(times, values):
+        if value == value:
+            run.append((t, value))
+        else:
+            if run:
+                runs.append((run, t))
+            run = []
+    if run:
+        runs.append((run, None))
+
+    total = sum([len(segment) for segment, gap in runs])
+    points = []
+    for run, gap in runs:
+        share = max(2, int(round(threshold * len(run) / float(total))))
+        points += [[t, float('%.6g' % value)] for t, value in lttb(run, share)]
+        if gap is not None:
+            points.append([gap, None])
+    return points
+
+def _align(result, column, start, step, count):
+    """ `column` of a fetch `result`, at the rows start + step, start + 2 * step, ..., so series of different steps line up. """
+    first = result.start + result.step
+    values = []
+    for i in xrange(count):
+        row = (start + (i + 1) * step - first) // result.step
+        values.append(float(column[row]) if 0 <= row < len(column) else NAN)
+    return values
+
+def chart_data(chart, start, end, width):
+    """ Reads what `chart` shows between `start` and `end`, `width` points of it per series. Runs in a thread. """
+    resolution = max(1, (end - start) // width)
+
+    # One fetch per file and consolidation function.
+    wanted = {}
+    for vname, filename, ds, cf in chart['defs']:
+        wanted.setdefault((filename, cf), []).append(ds)
+
+    fetched = {}
+    for (filename, cf), sources in wanted.iteritems():
+        with RRDFile(filename) as rrd:
+            result = rrd.fetch(cf, start, end, resolution, sorted(set(sources)))
+        fetched[filename, cf] = result
+
+    # The time axis is the one of the first DEF.
+    vname, filename, ds, cf = chart['defs'][0]
+    axis = fetched[filename, cf]
+    count = (axis.end - axis.start) // axis.step
+    times = range(axis.start + axis.step, axis.end + 1, axis.step)
+
+    series = {}
+    for vname, filename, ds, cf in chart['defs']:
+        result = fetched[filename, cf]
+        series[vname] = _align(result, result.columns[result.names.index(ds)], axis.start, axis.step, count)
+    for vname, tokens in chart['cdefs']:
+        series[vname] = rpn(tokens, series, count)
+
+    drawn = []
+    top = None
+    for kind, vname, color, label, stack in chart['items']:
+        values = series[vname]
+        base = None
+        if stack and top is not None:
+            base = len(drawn) - 1
+            values = [a + b for a, b in zip(top, values)]
+        top = values
+        drawn.append(dict(type = kind, color = color, label = label, base = base, points = downsample(times, values, width)))
+
+    legend = [
+        dict(color = color, label = label, values = [gprint(format, consolidate(cf, series[vname])) for vname, cf, format in gprints])
+        for color, label, gprints in chart['legend']
+    ]
+
+    return dict(
+        title = chart['title'],
+        vertical_label = chart['vertical_label'],
+        lower_limit = chart['lower_limit'],
+        upper_limit = chart['upper_limit'],
+        width = chart['width'],
+        height = chart['height'],
+        start = axis.start,
+        end = axis.end,
+        step = axis.step,
+        series = drawn,
+        rules = [dict(value = value, color = color, label = label) for value, color, label in chart['rules']],
+        legend = legend
+    )
+
+class ChartResource(resource.Resource):
+    """ I am /charts/, every child of mine is the data of a graph as json. """
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+
+    def getChild(self, filename, request):
+        # Refreshed every few seconds by every dashboard, and json squeezes down to a fraction of itself.
+        return resource.EncodingResourceWrapper(ChartData(self, filename), [server.GzipEncoderFactory()])
+
+    def chart(self, filename):
+        """ Returns (chart definition, period) of the graph behind filename, or None if there's no such graph. """
+        parsed = parse_graph_filename(filename, '.json')
+        if parsed is None:
+            return None
+
+        id, period, index = parsed
+        template = self.stats.active_graphs.get(id)
+        if template is None or period not in template.config['periods'] or not 0 <= index < template.numGraphs:
+            return None
+
+        return chart_definition(template._graphDefinition(period, index)), period
+
+class ChartData(resource.Resource):
+    """ The data of a single chart. """
+    isLeaf = True
+
+    def __init__(self, charts, filename):
+        resource.Resource.__init__(self)
+        self.charts = charts
+        self.filename = filename
+
+    def _fail(self, request, code, message):
+        request.setResponseCode(code)
+        request.setHeader('content-type', 'text/plain')
+        return '%s\n' % message
+
+    def render_GET(self, request):
+        try:
+            found = self.charts.chart(self.filename)
+        except (ChartError, ValueError, IndexError), e:
+            return self._fail(request, 501, 'This graph can not be drawn as a chart: %s' % e)
+        if found is None:
+            return self._fail(request, 404, 'No such chart')
+
+        chart, period = found
+        if not chart['defs'] or period not in _periodSeconds:
+            return self._fail(request, 501, 'This graph can not be drawn as a chart')
+        try:
+            width = max(10, min(int(request.args.get('width', [chart['width']])[0]), 4000))
+        except ValueError:
+            return self._fail(request, 400, 'width must be a number')
+
+        end = int(time.time())
+        start = end - _periodSeconds[period]
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        # rrdcached may still be holding on to some of the data.
+        d = rrdtool.flush(*sorted(set([filename for vname, filename, ds, cf in chart['defs']])))
+        d.addCallback(lambda res: deferToThread(chart_data, chart, start, end, width))
+        d.addCallbacks(self._write, self._error, callbackArgs = (request, finished), errbackArgs = (request, finished))
+        return server.NOT_DONE_YET
+
+    def _write(self, data, request, finished):
+        if finished:
+            return
+        request.setHeader('content-type', 'application/json')
+        request.write(json.dumps(data, separators = (',', ':')))
+        request.finish()
+
+    def _error(self, err, request, finished):
+        log.msg('Failed to read chart %r: %s' % (self.filename, err.getErrorMessage()), logLevel = logging.ERROR)
+        if finished:
+            return
+        request.write(self._fail(request, 501 if err.check(ChartError) else 500, err.getErrorMessage()))
+        request.finish()
+
+__all__ = ['ChartResource', 'ChartError', 'chart_definition', 'lttb']
+
+import unittest
+
+class TestCharts(unittest.TestCase):
+    def test_definition(self):
+        chart = chart_definition([
+            "-s -1hour", "-t web1 requests", "--lazy", "-h", "150", "-w", "700", "-l 0", "-v requests/sec",
+            "DEF:hits=/db/web1.rrd:get_hits:AVERAGE",
+            "CDEF:bits=hits,8,*",
+            "AREA:hits#BFFF00:Cache Hits",
+            "GPRINT:hits:MAX:  Max\\: %7.1lf %S",
+            "LINE2:bits#FF0000:Bits:STACK",
+            "HRULE:0#000000",
+        ])
+        self.assertEqual((chart['title'], chart['vertical_label'], chart['lower_limit'], chart['width'], chart['height']), ('web1 requests', 'requests/sec', 0, 700, 150))
+        self.assertEqual(chart['defs'], [('hits', '/db/web1.rrd', 'get_hits', 'AVERAGE')])
+        self.assertEqual(chart['cdefs'], [('bits', ['hits', '8', '*'])])
+        self.assertEqual(chart['items'], [('area', 'hits', '#BFFF00', 'Cache Hits', False), ('line', 'bits', '#FF0000', 'Bits', True)])
+        self.assertEqual(chart['rules'], [(0.0, '#000000', '')])
+        self.assertEqual(chart['legend'][0], ('#BFFF00', 'Cache Hits', [('hits', 'MAX', '  Max: %7.1lf %S')]))
+
+    def test_rpn(self):
+        series = dict(polls = [0.0, 2.0, NAN], ms = [5.0, 10.0, 1.0])
+        self.assertEqual(rpn('polls,0,GT,ms,polls,/,0,IF'.split(','), series, 3), [0.0, 5.0, 0.0])
+        self.assertEqual(rpn('ms,-1,*'.split(','), series, 3), [-5.0, -10.0, -1.0])
+        self.assertRaises(ChartError, rpn, ['ms', 'SIN'], series, 3)
+
+    def test_gprint(self):
+        self.assertEqual(gprint('  Max: %7.1lf %S\\r', 12345.0), '  Max:    12.3 k')
+        self.assertEqual(gprint('%5.2lf%%', 0.5), ' 0.50%')
+        self.assertEqual(gprint('%5.1lf %s', NAN), 'nan ')
+
+    def test_lttb(self):
+        points = [(i, 0.0) for i in xrange(100)]
+        points[37] = (37, 100.0)
+        sampled = lttb(points, 10)
+        self.assertEqual(len(sampled), 10)
+        self.assertEqual((sampled[0], sampled[-1]), (points[0], points[-1]))
+        # The spike survives.
+        self.assertTrue((37, 100.0) in sampled)
+
+    def test_downsample_gaps(self):
+        values = [float(i) for i in xrange(50)] + [NAN] * 10 + [float(i) for i in xrange(50)]
+        points = downsample(range(110), values, 20)
+        self.assertTrue([50, None] in points)
+        self.assertTrue(len(points) <= 23)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+    prickle.app.cluster
+    ~~~~~~~~~~~~~~~~~~~
+
+    /cluster, which the other nodes of the cluster ask how we're doing, and the proxy that sends
+    requests for graph images to the node that owns the graph.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import resource
+from twisted.web.proxy import ReverseProxyResource
+from .graphs import parse_graph_filename
+import json
+import time
+
+PROXIED_HEADER = 'x-prickle-proxied-by'
+
+class ClusterResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+
+    def render_GET(self, request):
+        cluster = self.stats.cluster
+        try:
+            since = float(request.args.get('since', [0])[0])
+        except ValueError:
+            since = 0
+
+        answer = cluster.status()
+        answer.update(now = time.time(), drawn = cluster.drawn(since))
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(answer)
+
+class GraphProxyResource(resource.Resource):
+    """
+        I am /graphs/ (or /charts/) on a node of a cluster, I serve images (or charts) of the graphs we own from `local`,
+        and proxy the rest to their owners.
+    """
+
+    def __init__(self, stats, local, prefix = '/graphs/', extension = '.png'):
+        resource.Resource.__init__(self)
+        self.stats = stats
+        self.local = local
+        self.prefix = prefix
+        self.extension = extension
+
+    def getChild(self, filename, request):
+        cluster = self.stats.cluster
+        parsed = parse_graph_filename(filename, self.extension)
+        owner = cluster.owner(self.stats.placement(parsed[0])) if parsed else None
+
+        # If it's been proxied to us, the node that sent it thinks it's ours, don't send it back and forth.
+        if owner is None or owner == cluster.name or request.requestHeaders.hasHeader(PROXIED_HEADER):
+            return self.local.getChildWithDefault(filename, request)
+
+        request.requestHeaders.setRawHeaders(PROXIED_HEADER, [cluster.name])
+        host, port = cluster.address(owner)
+        return ReverseProxyResource(host, port, self.prefix + filename)
+
+__all__ = ['ClusterResource', 'GraphProxyResource']
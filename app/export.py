@@ -0,0 +1,197 @@
+"""
+    prickle.app.export
+    ~~~~~~~~~~~~~~~~~~
+
+    /export streams the raw data behind many graphs at once, as csv or newline delimited json,
+    reading the rrd files directly with a bounded amount of them in flight at any time.
+
+        /export?id=web1&id=web2&ds=requests&start=-86400&resolution=300&format=csv
+
+    `id` and `ds` can be repeated or comma separated, `start` and `end` are unix timestamps,
+    or seconds relative to now when negative. POSTing the same fields as a form works too,
+    for when the list of ids gets too long for a url.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import resource, server
+from twisted.internet import task
+from twisted.internet.defer import DeferredList
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from zope.interface import implementer
+from stats.rrdfile import RRDFile
+import stats.proc_rrd as rrdtool
+import json
+import time
+import logging
+
+_contentTypes = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+def _values(request, name):
+    """ All the values of a repeatable, comma separable argument. """
+    values = []
+    for value in request.args.get(name, []):
+        values.extend([v for v in value.split(',') if v])
+    return values
+
+def _timestamp(value, now):
+    value = int(value)
+    if value <= 0:
+        return now + value
+    return value
+
+class ExportError(Exception):
+    """ The export request didn't make sense. """
+
+class ExportResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+
+    def render_GET(self, request):
+        try:
+            export = self._parse(request)
+        except (ExportError, ValueError), e:
+            request.setResponseCode(400)
+            request.setHeader('content-type', 'text/plain')
+            return '%s\n' % e
+
+        request.setHeader('content-type', _contentTypes[export.format])
+        export.start()
+        return server.NOT_DONE_YET
+
+    render_POST = render_GET
+
+    def _parse(self, request):
+        now = int(time.time())
+        format = request.args.get('format', ['csv'])[0]
+        if format not in _contentTypes:
+            raise ExportError('format must be one of %s' % ', '.join(sorted(_contentTypes)))
+
+        ids = _values(request, 'id')
+        if not ids:
+            raise ExportError('No ids given')
+
+        graphs = self.stats.active_graphs
+        for id in ids:
+            if id not in graphs or not graphs[id].useDatabase:
+                raise ExportError('Unknown graph id %r' % id)
+
+        return Export(
+            request, [(id, graphs[id].filename) for id in ids],
+            ds = _values(request, 'ds') or None,
+            cf = request.args.get('cf', ['AVERAGE'])[0],
+            start = _timestamp(request.args.get('start', ['-86400'])[0], now),
+            end = _timestamp(request.args.get('end', ['0'])[0], now),
+            resolution = int(request.args.get('resolution', ['1'])[0]),
+            format = format,
+            concurrency = self.stats.config['export_concurrency']
+        )
+
+@implementer(IPushProducer)
+class Export(object):
+    """
+        One running export. `concurrency` cooperative tasks share one iterator over the ids, each of them
+        reads a file in a thread, writes it out and moves on to the next id, so at most `concurrency` ids
+        are ever held in memory. When the client can't keep up, the transport pauses us.
+    """
+
+    def __init__(self, request, files, ds, cf, start, end, resolution, format, concurrency):
+        self.request = request
+        self.files = files
+        self.ds = ds
+        self.cf = cf
+        self.range = (start, end)
+        self.resolution = resolution
+        self.format = format
+        self.concurrency = concurrency
+        self.tasks = []
+        self.stopped = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(lambda err: self.stopProducing())
+
+        if self.format == 'csv':
+            self.request.write('id,timestamp,ds,value\n')
+
+        work = self._work()
+        self.tasks = [task.cooperate(work) for i in xrange(self.concurrency)]
+        DeferredList([t.whenDone() for t in self.tasks], consumeErrors = True).addCallback(self._finished)
+
+    def _work(self):
+        for id, filename in self.files:
+            if self.stopped:
+                return
+
+            # rrdcached may still be holding on to some of the data.
+            d = rrdtool.flush(filename)
+            d.addCallback(lambda res, id = id, filename = filename: deferToThread(self._read, id, filename))
+            d.addCallbacks(self._write, self._error, errbackArgs = (id, ))
+            yield d
+
+    def _read(self, id, filename):
+        """ Runs in a thread, reads one file and formats it for the response. """
+        start, end = self.range
+        with RRDFile(filename) as rrd:
+            result = rrd.fetch(self.cf, start, end, self.resolution, self.ds)
+
+        times = xrange(result.start + result.step, result.end + 1, result.step)
+        if self.format == 'csv':
+            return ''.join([
+                '%s,%i,%s,%s\n' % (id, t, name, '' if value != value else repr(float(value)))
+                for name, column in zip(result.names, result.columns) for t, value in zip(times, column)
+            ])
+
+        return json.dumps({
+            'id': id,
+            'cf': self.cf,
+            'start': times[0] if times else result.start,
+            'step': result.step,
+            'ds': dict([
+                (name, [None if value != value else float(value) for value in column])
+                for name, column in zip(result.names, result.columns)
+            ])
+        }) + '\n'
+
+    def _write(self, data):
+        if not self.stopped:
+            self.request.write(data)
+
+    def _finished(self, res):
+        if not self.stopped:
+            self.request.unregisterProducer()
+            self.request.finish()
+
+    def _error(self, err, id):
+        log.msg('Failed to export %r: %s' % (id, err.getErrorMessage()), logLevel = logging.ERROR)
+        if self.format == 'ndjson' and not self.stopped:
+            self.request.write(json.dumps({'id': id, 'error': err.getErrorMessage()}) + '\n')
+
+    def _eachTask(self, method):
+        for t in self.tasks:
+            try:
+                method(t)
+            except task.TaskDone:
+                pass
+
+    def pauseProducing(self):
+        self._eachTask(task.CooperativeTask.pause)
+
+    def resumeProducing(self):
+        self._eachTask(task.CooperativeTask.resume)
+
+    def stopProducing(self):
+        if not self.stopped:
+            self.stopped = True
+            self._eachTask(task.CooperativeTask.stop)
+
+__all__ = ['ExportResource']
@@ -0,0 +1,233 @@
+"""
+    prickle.app.graphs
+    ~~~~~~~~~~~~~~~~~~
+
+    I serve the graph images, and render them when they're asked for if their
+    cached copy is missing or older than it's allowed to be.
+
+    Image urls carry the time the image was drawn, see WebApp.graph_url, so an image asked for
+    with the time it was last drawn can be kept by browsers for good, the next one will have
+    another url. Any other is kept until it's asked for again, and then only sent again if it
+    changed, by its ETag or Last-Modified.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import static, server, resource, http
+from twisted.python import log
+from stats.util import DeferredCoalescer
+import os.path
+import time
+
+def parse_graph_filename(filename, extension = '.png'):
+    """ Splits '<id>-<period>.<index>.png' (or whatever `extension`) back into (id, period, index), returns None if it doesn't look like one. """
+    if not filename.endswith(extension):
+        return None
+
+    try:
+        name, index = filename[:-len(extension)].rsplit('.', 1)
+        id, period = name.rsplit('-', 1)
+        return id, period, int(index)
+    except ValueError:
+        return None
+
+# For urls that will never point at anything else, see cache_control.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+def cache_control(stats, filename, timestamp, mtime):
+    """
+        The Cache-Control of graph image `filename`, last modified at `mtime`, asked for with the url of the image
+        drawn at `timestamp` (its `_` argument, or None). Only the image drawn then will ever be served with that url,
+        unless it's been drawn again since, or was never drawn by us at all.
+    """
+    drawn = stats.last_draw_timestamp.get(filename, -1)
+    if drawn >= 0 and timestamp == str(drawn) and int(mtime) <= drawn:
+        return IMMUTABLE
+    return 'no-cache'
+
+class GraphFile(static.File):
+    """
+        static.File, for graph images. Besides the Last-Modified static.File sends, and the If-Modified-Since it answers,
+        I give them an ETag, answer If-None-Match, and say how long they may be cached, see cache_control.
+    """
+
+    def __init__(self, stats, path, *args, **kwargs):
+        static.File.__init__(self, path, *args, **kwargs)
+        self.stats = stats
+
+    def createSimilarFile(self, path):
+        f = self.__class__(self.stats, path, self.defaultType, self.ignoredExts, self.registry)
+        f.processors = self.processors
+        f.indexNames = self.indexNames[:]
+        f.childNotFound = self.childNotFound
+        return f
+
+    def etag(self):
+        return '"%x-%x"' % (int(self.getModificationTime() * 1000000), self.getsize())
+
+    def render_GET(self, request):
+        self.restat(False)
+        if self.isfile():
+            timestamp = request.args.get('_', [None])[0]
+            request.setHeader('cache-control', cache_control(self.stats, self.basename(), timestamp, self.getModificationTime()))
+            if request.setETag(self.etag()) is http.CACHED:
+                return ''
+        return static.File.render_GET(self, request)
+    render_HEAD = render_GET
+
+class GraphResource(resource.Resource):
+    """ I am /graphs/, every child of mine is an image that gets rendered on demand. """
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+        self.rendering = DeferredCoalescer()
+
+    def getChild(self, filename, request):
+        # Path segments come unquoted, so "..%2F" would walk out of image_path.
+        if '/' in filename or os.sep in filename or '..' in filename or parse_graph_filename(filename) is None:
+            return resource.NoResource('No such graph')
+        return GraphImage(self, filename)
+
+    def path(self, filename):
+        return os.path.join(self.stats.config['image_path'], filename)
+
+    def max_age(self, period):
+        """ How old a graph for `period` may get before we redraw it, defaults to how often it'd be drawn on a timer. """
+        config = self.stats.config
+        graph_draw_frequency = config['graph_draw_frequency']
+        return config['graph_max_age'].get(period, graph_draw_frequency.get(period, graph_draw_frequency['default']))
+
+    def refresh(self, filename):
+        """
+            Render the graph behind filename if its cached copy is too old, returns a deferred that fires when it's done,
+            or None if there's nothing to do. Everyone asking for the same image while it renders waits on the same render.
+        """
+        parsed = parse_graph_filename(filename)
+        if parsed is None:
+            return None
+
+        id, period, index = parsed
+        template = self.stats.active_graphs.get(id)
+        if template is None or period not in template.config['periods'] or not 0 <= index < template.numGraphs:
+            return None
+
+        try:
+            if time.time() - os.path.getmtime(self.path(filename)) < self.max_age(period):
+                return None
+        except OSError:
+            pass
+
+        return self.rendering(filename, template._graphOne, period, index)
+
+class GraphImage(resource.Resource):
+    """ A single graph image, I make sure it's fresh and then let static.File serve it. """
+    isLeaf = True
+
+    def __init__(self, graphs, filename):
+        resource.Resource.__init__(self)
+        self.graphs = graphs
+        self.filename = filename
+
+    def render_GET(self, request):
+        d = self.graphs.refresh(self.filename)
+        if d is None:
+            return self._serve(request)
+
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
+        d.addErrback(log.err)
+        d.addCallback(self._serveLater, request, finished)
+        return server.NOT_DONE_YET
+
+    def _serve(self, request):
+        return GraphFile(self.graphs.stats, self.graphs.path(self.filename)).render(request)
+
+    def _serveLater(self, res, request, finished):
+        if finished:
+            # They went away while we were rendering.
+            return
+
+        body = self._serve(request)
+        if body is not server.NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+__all__ = ['GraphResource', 'GraphFile', 'parse_graph_filename']
+
+import unittest
+import tempfile
+import shutil
+
+class TestGraphFile(unittest.TestCase):
+    class Stats(object):
+        def __init__(self):
+            self.last_draw_timestamp = {}
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'web1-hour.0.png')
+        with open(self.filename, 'wb') as f:
+            f.write('png')
+        os.utime(self.filename, (1000, 1000))
+        self.stats = self.Stats()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def request(self, timestamp = None, etag = None):
+        from twisted.web.test.requesthelper import DummyChannel
+        request = server.Request(DummyChannel(), False)
+        request.method = 'GET'
+        request.args = {}
+        if timestamp is not None:
+            request.args['_'] = [timestamp]
+        if etag is not None:
+            request.requestHeaders.setRawHeaders('if-none-match', [etag])
+        return request
+
+    def test_cache_control(self):
+        self.assertEqual(cache_control(self.stats, 'web1-hour.0.png', '1000', 1000), 'no-cache')
+        self.stats.last_draw_timestamp['web1-hour.0.png'] = 1000
+        self.assertEqual(cache_control(self.stats, 'web1-hour.0.png', '1000', 1000), IMMUTABLE)
+        self.assertEqual(cache_control(self.stats, 'web1-hour.0.png', '999', 1000), 'no-cache')
+        self.assertEqual(cache_control(self.stats, 'web1-hour.0.png', None, 1000), 'no-cache')
+        # Drawn again since, but we haven't heard yet.
+        self.assertEqual(cache_control(self.stats, 'web1-hour.0.png', '1000', 1001), 'no-cache')
+
+    def test_not_modified(self):
+        self.stats.last_draw_timestamp['web1-hour.0.png'] = 1000
+        graphs = GraphFile(self.stats, self.path)
+        image = graphs.getChild('web1-hour.0.png', self.request())
+        etag = image.etag()
+
+        request = self.request('1000', etag)
+        self.assertEqual(image.render(request), '')
+        self.assertEqual(request.code, http.NOT_MODIFIED)
+        self.assertEqual(request.responseHeaders.getRawHeaders('cache-control'), [IMMUTABLE])
+
+        with open(self.filename, 'wb') as f:
+            f.write('another png')
+        request = self.request(None, etag)
+        image.render(request)
+        self.assertNotEqual(request.code, http.NOT_MODIFIED)
+        self.assertEqual(request.responseHeaders.getRawHeaders('cache-control'), ['no-cache'])
+
+    def test_outside_image_path(self):
+        import urllib
+        self.stats.config = dict(image_path = self.path)
+        self.stats.active_graphs = {}
+        root = resource.Resource()
+        root.putChild('graphs', GraphResource(self.stats))
+        for path in ('/graphs/..%2F..%2Fetc%2Fpasswd', '/graphs/..', '/graphs/passwd'):
+            request = self.request()
+            request.prepath, request.postpath = [], map(urllib.unquote, path[1:].split('/'))
+            self.assertTrue(isinstance(resource.getChildForRequest(root, request), resource.NoResource), path)
+
+        request = self.request()
+        request.prepath, request.postpath = [], ['graphs', 'web1-hour.0.png']
+        self.assertTrue(isinstance(resource.getChildForRequest(root, request), GraphImage))
+
+if __name__ == '__main__':
+    unittest.main()
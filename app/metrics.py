@@ -0,0 +1,21 @@
+"""
+    prickle.app.metrics
+    ~~~~~~~~~~~~~~~~~~~
+
+    /metrics, how prickle itself is doing, in the prometheus text exposition format.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.web import resource
+from stats.metrics import registry
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return registry.render()
+
+__all__ = ['MetricsResource']
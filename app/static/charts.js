@@ -0,0 +1,211 @@
+/*
+    prickle charts
+
+    Draws every <div class="chart" data-src="/charts/..."> on the page as an SVG chart, from the json
+    app/charts.py serves, and draws it again every data-refresh seconds.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+*/
+(function () {
+    var SVG = 'http://www.w3.org/2000/svg';
+    var MARGIN = {top: 22, right: 16, bottom: 20, left: 56};
+    var PREFIXES = {'-4': 'p', '-3': 'n', '-2': 'u', '-1': 'm', '0': '', '1': 'k', '2': 'M', '3': 'G', '4': 'T', '5': 'P'};
+    var TIME_STEPS = [60, 300, 600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 2 * 86400, 7 * 86400, 14 * 86400, 30 * 86400];
+
+    function element(name, attributes, parent) {
+        var node = document.createElementNS(SVG, name);
+        for (var key in attributes) {
+            node.setAttribute(key, attributes[key]);
+        }
+        if (parent) {
+            parent.appendChild(node);
+        }
+        return node;
+    }
+
+    function text(parent, x, y, value, anchor) {
+        var node = element('text', {x: x, y: y, 'text-anchor': anchor || 'start', 'font-size': 11}, parent);
+        node.appendChild(document.createTextNode(value));
+        return node;
+    }
+
+    function si(value) {
+        if (value === 0) {
+            return '0';
+        }
+        var magnitude = Math.max(-4, Math.min(5, Math.floor(Math.log(Math.abs(value)) / Math.LN10 / 3)));
+        var scaled = value / Math.pow(1000, magnitude);
+        return (Math.round(scaled * 100) / 100) + (PREFIXES[magnitude] ? ' ' + PREFIXES[magnitude] : '');
+    }
+
+    function niceStep(range, ticks) {
+        var rough = range / ticks;
+        var power = Math.pow(10, Math.floor(Math.log(rough) / Math.LN10));
+        var steps = [1, 2, 5, 10];
+        for (var i = 0; i < steps.length; i++) {
+            if (steps[i] * power >= rough) {
+                return steps[i] * power;
+            }
+        }
+        return 10 * power;
+    }
+
+    function pad(n) {
+        return n < 10 ? '0' + n : '' + n;
+    }
+
+    function timeLabel(t, span) {
+        var date = new Date(t * 1000);
+        if (span <= 2 * 86400) {
+            return pad(date.getHours()) + ':' + pad(date.getMinutes());
+        }
+        return (date.getMonth() + 1) + '/' + date.getDate();
+    }
+
+    // Splits points into the runs between the [time, null] gaps.
+    function segments(points) {
+        var runs = [], run = [];
+        for (var i = 0; i < points.length; i++) {
+            if (points[i][1] === null) {
+                if (run.length) {
+                    runs.push(run);
+                }
+                run = [];
+            } else {
+                run.push(points[i]);
+            }
+        }
+        if (run.length) {
+            runs.push(run);
+        }
+        return runs;
+    }
+
+    function draw(container, data) {
+        var width = data.width, height = data.height;
+        var low = Infinity, high = -Infinity;
+        data.series.forEach(function (series) {
+            series.points.forEach(function (point) {
+                if (point[1] !== null) {
+                    low = Math.min(low, point[1]);
+                    high = Math.max(high, point[1]);
+                }
+            });
+        });
+        // Like rrdtool without --rigid, the limits only say how far the axis goes at least.
+        if (data.lower_limit !== null) {
+            low = Math.min(low, data.lower_limit);
+        }
+        if (data.upper_limit !== null) {
+            high = Math.max(high, data.upper_limit);
+        }
+        if (low === Infinity) {
+            low = 0;
+            high = 1;
+        }
+        if (high <= low) {
+            high = low + 1;
+        }
+        var step = niceStep(high - low, 4);
+        low = Math.floor(low / step) * step;
+        high = Math.ceil(high / step) * step;
+
+        var x = function (t) { return MARGIN.left + (t - data.start) / (data.end - data.start) * width; };
+        var y = function (v) { return MARGIN.top + height - (v - low) / (high - low) * height; };
+        var zero = y(Math.max(low, Math.min(high, 0)));
+
+        var svg = element('svg', {width: width + MARGIN.left + MARGIN.right, height: height + MARGIN.top + MARGIN.bottom});
+        text(svg, MARGIN.left + width / 2, 14, data.title, 'middle').setAttribute('font-weight', 'bold');
+        var label = text(svg, 12, MARGIN.top + height / 2, data.vertical_label, 'middle');
+        label.setAttribute('transform', 'rotate(-90 12 ' + (MARGIN.top + height / 2) + ')');
+
+        for (var v = low; v <= high + step / 2; v += step) {
+            element('line', {x1: MARGIN.left, x2: MARGIN.left + width, y1: y(v), y2: y(v), stroke: '#ddd'}, svg);
+            text(svg, MARGIN.left - 4, y(v) + 4, si(v), 'end');
+        }
+
+        var span = data.end - data.start, timeStep = TIME_STEPS[TIME_STEPS.length - 1];
+        for (var i = 0; i < TIME_STEPS.length; i++) {
+            if (span / TIME_STEPS[i] <= 8) {
+                timeStep = TIME_STEPS[i];
+                break;
+            }
+        }
+        var offset = new Date().getTimezoneOffset() * 60;
+        for (var t = Math.ceil((data.start - offset) / timeStep) * timeStep + offset; t <= data.end; t += timeStep) {
+            element('line', {x1: x(t), x2: x(t), y1: MARGIN.top, y2: MARGIN.top + height, stroke: '#eee'}, svg);
+            text(svg, x(t), MARGIN.top + height + 14, timeLabel(t, span), 'middle');
+        }
+
+        data.series.forEach(function (series) {
+            var color = series.color || '#000000';
+            var base = series.base === null ? null : data.series[series.base].points;
+            segments(series.points).forEach(function (run) {
+                var path = run.map(function (point) { return x(point[0]) + ',' + y(point[1]); });
+                if (series.type === 'area') {
+                    var first = run[0][0], last = run[run.length - 1][0];
+                    var under = [];
+                    if (base !== null) {
+                        under = base.filter(function (point) {
+                            return point[1] !== null && point[0] >= first && point[0] <= last;
+                        }).map(function (point) { return x(point[0]) + ',' + y(point[1]); }).reverse();
+                    }
+                    if (!under.length) {
+                        under = [x(last) + ',' + zero, x(first) + ',' + zero];
+                    }
+                    element('polygon', {points: path.concat(under).join(' '), fill: color, stroke: 'none'}, svg);
+                } else {
+                    element('polyline', {points: path.join(' '), fill: 'none', stroke: color, 'stroke-width': 1.5}, svg);
+                }
+            });
+        });
+
+        data.rules.forEach(function (rule) {
+            if (rule.value >= low && rule.value <= high) {
+                element('line', {x1: MARGIN.left, x2: MARGIN.left + width, y1: y(rule.value), y2: y(rule.value), stroke: rule.color || '#000'}, svg);
+            }
+        });
+
+        var legend = document.createElement('div');
+        legend.className = 'legend';
+        data.legend.forEach(function (entry) {
+            var row = document.createElement('div');
+            if (entry.color) {
+                var swatch = document.createElement('span');
+                swatch.className = 'swatch';
+                swatch.style.cssText = 'display:inline-block;width:10px;height:10px;margin-right:4px;background:' + entry.color;
+                row.appendChild(swatch);
+            }
+            row.appendChild(document.createTextNode([entry.label].concat(entry.values).join(' ')));
+            legend.appendChild(row);
+        });
+
+        container.innerHTML = '';
+        container.appendChild(svg);
+        container.appendChild(legend);
+    }
+
+    function load(container) {
+        var request = new XMLHttpRequest();
+        request.open('GET', container.getAttribute('data-src'));
+        request.onload = function () {
+            if (request.status === 200) {
+                draw(container, JSON.parse(request.responseText));
+            } else {
+                container.textContent = request.responseText;
+            }
+        };
+        request.send();
+
+        var refresh = parseInt(container.getAttribute('data-refresh'), 10);
+        if (refresh > 0) {
+            setTimeout(function () { load(container); }, refresh * 1000);
+        }
+    }
+
+    var charts = document.querySelectorAll('div.chart[data-src]');
+    for (var i = 0; i < charts.length; i++) {
+        load(charts[i]);
+    }
+})();
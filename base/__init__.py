@@ -9,4 +9,6 @@
 """
 
 from .template import BaseTemplate
-from .config import Config
\ No newline at end of file
+from .config import Config, ImmutableDict
+from .connections import ConnectionManager, ConnectionBackoff
+from .counters import CounterStore
\ No newline at end of file
@@ -8,9 +8,22 @@
     
 """
 
+import errno
 import copy
 
+class ImmutableDict(dict):
+    """ A dict that can't be changed once it's made, for defaults that everyone copies and no one should touch. """
+    
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%r objects are immutable' % self.__class__.__name__)
+    
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    
+    def __reduce_ex__(self, protocol):
+        return type(self), (dict(self), )
+
 class Config(dict):
+    filename = None # the file I was last loaded from, Stats.reload loads it again.
     
     def __init__(self, defaults):
         dict.__init__(self, copy.deepcopy(defaults or {}))
@@ -31,5 +44,6 @@ class Config(dict):
             e.strerror = 'Unable to load configuration file (%s)' % e.strerror
             raise
         self.update(tmp)
+        self.filename = filename
         return True
     
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""
+    prickle.base.connections
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    I keep the connections templates poll their targets with open between polls.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet.defer import Deferred, CancelledError, succeed, fail, maybeDeferred
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from collections import deque
+import logging
+import time
+
+class ConnectionBackoff(Exception):
+    """ We failed to connect to this target recently, and are waiting a while before trying again. """
+
+def _transportAlive(proto):
+    transport = proto.transport
+    return transport is not None and transport.connected and not transport.disconnecting
+
+def _loseConnection(proto):
+    proto.transport.loseConnection()
+
+class _Connection(object):
+    """ What we know about the connection to one target. """
+
+    def __init__(self, key, isAlive, close):
+        self.key = key
+        self.isAlive = isAlive
+        self.close = close
+        self.proto = None
+        self.busy = False
+        self.lastUsed = 0
+        self.failures = 0
+        self.retryAt = 0
+        self.waiters = None # Deferreds waiting on a connection attempt in progress.
+
+class ConnectionManager(object):
+    """
+        I keep one connection per key (a template's id) open across polls. Connections are made lazily
+        when asked for, targets that fail to connect are left alone for a while that doubles with every
+        failure, connections that go unused for `idleTimeout` seconds get closed, and no more than
+        `maxConnections` are ever open at once: when we're at the cap, the least recently used idle
+        connection is closed to make room, or the caller waits for one to free up.
+    """
+    initialDelay = 1.0
+    maxDelay = 300.0
+    factor = 2.0
+
+    def __init__(self, maxConnections = 1000, idleTimeout = 300):
+        self.maxConnections = maxConnections
+        self.idleTimeout = idleTimeout
+        self.connections = {}
+        self.open = 0 # connections that are open, or being opened.
+        self.waiting = deque()
+        self._reaper = LoopingCall(self.closeIdle)
+
+    def __repr__(self):
+        return '<base.ConnectionManager open=%i, maxConnections=%i, waiting=%i>' % (self.open, self.maxConnections, len(self.waiting))
+
+    def start(self):
+        if not self._reaper.running:
+            self._reaper.start(max(self.idleTimeout / 4.0, 1), now = False)
+
+    def stop(self):
+        if self._reaper.running:
+            self._reaper.stop()
+        waiting, self.waiting = self.waiting, deque()
+        for d in waiting:
+            d.cancel()
+        for key in self.connections.keys():
+            self.close(key)
+
+    def get(self, key, connect, isAlive = None, close = None):
+        """
+            Returns a deferred that fires with the open connection for `key`. If there isn't one, I call connect(),
+            which should return a deferred that fires with a new one. `isAlive(conn)` tells me if a connection is
+            still usable, and `close(conn)` closes it, by default I treat connections as protocols with a transport.
+
+            The connection is marked busy until release(key) is called.
+        """
+        conn = self.connections.get(key)
+        if conn is None:
+            conn = self.connections[key] = _Connection(key, isAlive or _transportAlive, close or _loseConnection)
+
+        conn.busy = True
+        if conn.proto is not None:
+            if conn.isAlive(conn.proto):
+                conn.lastUsed = time.time()
+                return succeed(conn.proto)
+            # It went away since we last used it.
+            self._forget(conn)
+
+        d = Deferred()
+        if conn.waiters is not None:
+            conn.waiters.append(d)
+            return d
+
+        if time.time() < conn.retryAt:
+            return fail(ConnectionBackoff('Not reconnecting to %r for another %.1f seconds' % (key, conn.retryAt - time.time())))
+
+        conn.waiters = [d]
+        self._acquire().addCallback(
+            lambda res: maybeDeferred(connect)
+        ).addCallbacks(
+            self._connected, self._connectFailed, callbackArgs = (conn, ), errbackArgs = (conn, )
+        )
+        return d
+
+    def release(self, key):
+        """ Whoever asked for the connection to `key` is done with it for now. """
+        conn = self.connections.get(key)
+        if conn is not None:
+            conn.busy = False
+            conn.lastUsed = time.time()
+            if self.waiting and conn.proto is not None:
+                # Someone's waiting for a slot, they can have this one.
+                self._close(conn)
+
+    def drop(self, key):
+        """ Close the connection to `key` because something went wrong with it, and back off before reconnecting. """
+        conn = self.connections.get(key)
+        if conn is not None and conn.proto is not None:
+            self._close(conn)
+            self._backoff(conn)
+
+    def close(self, key):
+        """ Close the connection to `key` and forget about it. """
+        conn = self.connections.pop(key, None)
+        if conn is not None and conn.proto is not None:
+            self._close(conn)
+
+    def closeIdle(self):
+        """ Close connections that have been idle too long or have died, and forget targets we haven't heard of in a while. """
+        now = time.time()
+        for key, conn in self.connections.items():
+            if conn.proto is not None:
+                if not conn.isAlive(conn.proto):
+                    self._forget(conn)
+                elif not conn.busy and now - conn.lastUsed > self.idleTimeout:
+                    log.msg('Closing idle connection to %r' % (key, ), logLevel = logging.DEBUG)
+                    self._close(conn)
+            elif conn.waiters is None and not conn.busy and now > conn.retryAt and now - conn.lastUsed > self.idleTimeout:
+                del self.connections[key]
+
+    def _acquire(self):
+        """ Get a slot for a new connection, closing the least recently used idle connection if we're at the cap. """
+        if self.open < self.maxConnections:
+            self.open += 1
+            return succeed(None)
+
+        idle = [conn for conn in self.connections.itervalues() if conn.proto is not None and not conn.busy]
+        if idle:
+            # Closing it frees its slot, which we take right away.
+            self._close(min(idle, key = lambda conn: conn.lastUsed))
+            self.open += 1
+            return succeed(None)
+
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def _release(self):
+        if self.waiting:
+            # Hand the slot straight over.
+            self.waiting.popleft().callback(None)
+        else:
+            self.open -= 1
+
+    def _connected(self, proto, conn):
+        conn.proto = proto
+        conn.failures = 0
+        conn.retryAt = 0
+        conn.lastUsed = time.time()
+        waiters, conn.waiters = conn.waiters, None
+        for d in waiters:
+            d.callback(proto)
+
+    def _connectFailed(self, err, conn):
+        if not err.check(CancelledError):
+            # We never got a slot if we were cancelled while waiting for one.
+            self._release()
+        self._backoff(conn)
+        waiters, conn.waiters = conn.waiters, None
+        for d in waiters:
+            d.errback(err)
+
+    def _backoff(self, conn):
+        conn.failures += 1
+        delay = min(self.initialDelay * self.factor ** (conn.failures - 1), self.maxDelay)
+        conn.retryAt = time.time() + delay
+        log.msg('Connection to %r failed %i times in a row, waiting %.1f seconds before reconnecting' % (conn.key, conn.failures, delay), logLevel = logging.INFO)
+
+    def _close(self, conn):
+        proto, conn.proto = conn.proto, None
+        try:
+            conn.close(proto)
+        except Exception:
+            log.err()
+        self._release()
+
+    def _forget(self, conn):
+        """ The connection died on its own, just give up its slot. """
+        conn.proto = None
+        self._release()
+
+__all__ = ['ConnectionManager', 'ConnectionBackoff']
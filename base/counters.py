@@ -0,0 +1,288 @@
+"""
+    prickle.base.counters
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    I keep the counters templates last read, so they can write how much they went up by, and
+    put them on disk when we shut down, so the first poll after a restart has something to
+    compare against instead of being thrown away.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.python import log
+from array import array
+import cPickle as pickle
+import operator
+import logging
+import errno
+import time
+import os
+
+# Counters are unsigned 64 bit ints, where array has them, or doubles, which hold them exactly up to 2**53.
+_typecode = 'L' if array('L').itemsize >= 8 else 'd'
+
+def _wrapped(previous, value):
+    """
+        How much a counter that went from `previous` down to `value` went up by, if it wrapped around at 2**32
+        or 2**64, or None if it didn't, and was reset. Like rrdtool, I try 32 bits first, but only call it a
+        wrap if the counter was in the top quarter of its range and is now in the bottom one.
+    """
+    for bits in (32, 64):
+        limit = 2 ** bits
+        if previous < limit:
+            if previous >= limit * 3 / 4 and value < limit / 4:
+                return value + limit - previous
+            return None
+    return None
+
+class CounterStore(object):
+    """
+        I keep the last counters of every graph, one row per graph id, in flat arrays rather than an object
+        per graph, since there can be tens of thousands of them. Templates give me their counters with every
+        poll, see `deltas`, and I hand back how much each went up since the poll before. Counters that went
+        down wrapped or were reset, see `_wrapped`, a reset means the server restarted and the poll is thrown
+        away, as is the first poll of a graph I know nothing about, and one whose last counters are too old to
+        say anything about this one interval, say after a long downtime.
+
+        Rows of graphs I've been told to forget are reused as soon as half of what I hold is forgotten.
+    """
+    version = 1
+
+    def __init__(self):
+        self._rows = {} # id -> row.
+        self._ids = [] # row -> id, None once it's forgotten.
+        self._offsets = array('l') # row -> where its counters start in _values.
+        self._widths = array('H') # row -> how many counters it has.
+        self._times = array('d') # row -> when they were read.
+        self._values = array(_typecode)
+        self._forgotten = 0 # how many of _values belong to forgotten rows.
+        self.wraps = 0
+        self.resets = 0
+
+    def __repr__(self):
+        return '<base.CounterStore graphs=%i, counters=%i, wraps=%i, resets=%i>' % (len(self._rows), len(self._values) - self._forgotten, self.wraps, self.resets)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def __iter__(self):
+        """ The ids I keep counters of, safe to forget() while going through them. """
+        return iter(self._rows.keys())
+
+    def deltas(self, id, values, now = None, restart = False, fromZero = False, maxAge = None):
+        """
+            Graph `id` just read counters `values`, returns how much each went up since it last read them, or None
+            if it never has, if that was more than `maxAge` seconds ago, if they went down without wrapping, or if
+            whoever calls me knows they were `restart`ed. With `fromZero`, counters that went down without wrapping
+            started over from zero when their server restarted, so they went up by what they read now instead.
+            `values` are kept either way, to compare the next ones with.
+        """
+        now = time.time() if now is None else now
+        row = self._rows.get(id)
+        if row is not None and self._widths[row] != len(values):
+            # Its template changed under it, what we have means nothing now.
+            self.forget(id)
+            row = None
+
+        if row is None:
+            self._add(id, values, now)
+            return None
+
+        # Everything since would land in one interval, when the rrd has given up on the ones in between anyway.
+        age = now - self._times[row]
+        stale = maxAge is not None and age > maxAge
+
+        offset, end = self._offsets[row], self._offsets[row] + len(values)
+        last, values = self._values[offset:end], array(_typecode, values)
+        deltas = map(operator.sub, values, last)
+        if deltas and min(deltas) < 0:
+            for i, delta in enumerate(deltas):
+                if delta < 0:
+                    delta = deltas[i] = _wrapped(last[i], values[i])
+                    if delta is None and fromZero:
+                        deltas[i] = values[i]
+                        self.resets += 1
+                        continue
+                    if delta is None:
+                        restart = True
+                        break
+                    self.wraps += 1
+
+        self._values[offset:end] = values
+        self._times[row] = now
+
+        if restart:
+            self.resets += 1
+            log.msg('[%s] counters went down, possible server restart? Not writing this poll.' % id, logLevel = logging.INFO)
+            return None
+        if stale:
+            log.msg('[%s] counters were last read %is ago, not writing this poll.' % (id, age), logLevel = logging.DEBUG)
+            return None
+
+        return deltas
+
+    def forget(self, id):
+        """ Throw away the counters of `id`, because it's gone, or polled somewhere else now. """
+        row = self._rows.pop(id, None)
+        if row is None:
+            return
+
+        self._ids[row] = None
+        self._forgotten += self._widths[row]
+        if self._forgotten * 2 > len(self._values):
+            self._compact()
+
+    def _add(self, id, values, now):
+        self._rows[id] = len(self._ids)
+        self._ids.append(id)
+        self._offsets.append(len(self._values))
+        self._widths.append(len(values))
+        self._times.append(now)
+        self._values.extend(array(_typecode, values))
+
+    def _compact(self):
+        old = self._rows_of()
+        self.__init__()
+        for id, t, values in old:
+            self._add(id, values, t)
+
+    def _rows_of(self):
+        """ Returns [(id, time, values), ...] of every row that isn't forgotten. """
+        return [
+            (id, self._times[row], self._values[self._offsets[row]:self._offsets[row] + self._widths[row]])
+            for row, id in enumerate(self._ids) if id is not None
+        ]
+
+    def save(self, filename):
+        """ Write everything I keep to `filename`, atomically, so a crash halfway leaves the last one whole. """
+        rows = self._rows_of()
+        state = dict(
+            version = self.version,
+            typecode = _typecode,
+            saved = time.time(),
+            ids = [id for id, t, values in rows],
+            times = array('d', [t for id, t, values in rows]).tostring(),
+            widths = array('H', [len(values) for id, t, values in rows]).tostring(),
+            values = array(_typecode, [value for id, t, values in rows for value in values]).tostring()
+        )
+
+        tmp = '%s.%i.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+        return len(rows)
+
+    def load(self, filename):
+        """ Read back what save() wrote to `filename`, over what I keep. Returns how many graphs it had, 0 if there's no such file. """
+        try:
+            with open(filename, 'rb') as f:
+                state = pickle.load(f)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+
+        if (state.get('version'), state.get('typecode')) != (self.version, _typecode):
+            log.msg('%s is counter state version %r (%r), not %r (%r), starting over.' % (
+                filename, state.get('version'), state.get('typecode'), self.version, _typecode
+            ), logLevel = logging.WARNING)
+            return 0
+
+        times, widths, values = array('d'), array('H'), array(_typecode)
+        times.fromstring(state['times'])
+        widths.fromstring(state['widths'])
+        values.fromstring(state['values'])
+
+        offset = 0
+        for id, t, width in zip(state['ids'], times, widths):
+            self.forget(id)
+            self._add(id, values[offset:offset + width], t)
+            offset += width
+        return len(state['ids'])
+
+__all__ = ['CounterStore']
+
+import unittest
+import tempfile
+import shutil
+
+class TestCounterStore(unittest.TestCase):
+    def setUp(self):
+        self.store = CounterStore()
+
+    def test_deltas(self):
+        self.assertEqual(self.store.deltas('a', [10, 100], now = 1), None)
+        self.assertEqual(self.store.deltas('a', [15, 300], now = 2), [5, 200])
+        self.assertEqual(self.store.deltas('a', [15, 301], now = 3), [0, 1])
+
+    def test_wrap(self):
+        self.store.deltas('a', [2 ** 32 - 10, 2 ** 64 - 10])
+        self.assertEqual(self.store.deltas('a', [5, 5]), [15, 15])
+        self.assertEqual(self.store.wraps, 2)
+
+    def test_reset(self):
+        self.store.deltas('a', [1000, 1000])
+        self.assertEqual(self.store.deltas('a', [2000, 10]), None)
+        self.assertEqual(self.store.resets, 1)
+        # And it carries on from the reset.
+        self.assertEqual(self.store.deltas('a', [2001, 20]), [1, 10])
+
+    def test_restart(self):
+        self.store.deltas('a', [1])
+        self.assertEqual(self.store.deltas('a', [2], restart = True), None)
+        self.assertEqual(self.store.deltas('a', [3]), [1])
+
+    def test_width_changed(self):
+        self.store.deltas('a', [1])
+        self.assertEqual(self.store.deltas('a', [2, 2]), None)
+        self.assertEqual(self.store.deltas('a', [3, 3]), [1, 1])
+
+    def test_forget(self):
+        for id in 'abcd':
+            self.store.deltas(id, [1, 1])
+        for id in 'abc':
+            self.store.forget(id)
+        self.assertEqual(len(self.store._values), 2) # compacted.
+        self.assertFalse('a' in self.store)
+        self.assertEqual(self.store.deltas('a', [2, 2]), None)
+        self.assertEqual(self.store.deltas('d', [3, 4]), [2, 3])
+
+    def test_from_zero(self):
+        self.store.deltas('a', [1000, 2 ** 32 - 10])
+        self.assertEqual(self.store.deltas('a', [10, 5], fromZero = True), [10, 15])
+        self.assertEqual((self.store.resets, self.store.wraps), (1, 1))
+        self.assertEqual(self.store.deltas('a', [20, 6], fromZero = True), [10, 1])
+
+    def test_max_age(self):
+        self.store.deltas('a', [1], now = 0)
+        self.assertEqual(self.store.deltas('a', [2], now = 60, maxAge = 120), [1])
+        self.assertEqual(self.store.deltas('a', [500], now = 3600, maxAge = 120), None)
+        self.assertEqual(self.store.deltas('a', [501], now = 3660, maxAge = 120), [1])
+
+    def test_save_load(self):
+        path = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(path, 'counters.state')
+            self.store.deltas('a', [1, 2], now = 10)
+            self.store.deltas('b', [3], now = 20)
+            self.store.deltas('c', [4])
+            self.store.forget('c')
+            self.assertEqual(self.store.save(filename), 2)
+
+            store = CounterStore()
+            self.assertEqual(store.load(filename), 2)
+            self.assertEqual(store.deltas('a', [2, 4]), [1, 2])
+            self.assertEqual(store.deltas('b', [4]), [1])
+            self.assertEqual(store.deltas('c', [5]), None)
+            # What was saved long before isn't compared with.
+            self.assertEqual(store.deltas('b', [9], now = time.time() + 3600, maxAge = 120), None)
+            self.assertEqual(CounterStore().load(os.path.join(path, 'nope')), 0)
+        finally:
+            shutil.rmtree(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,250 @@
+"""
+    prickle.base.scheduler
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    One timer for all the polls and renders, instead of a LoopingCall each.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+import logging
+
+class _Timer(object):
+    """ One pending call in the wheel, it's dropped when its call is stopped. """
+    __slots__ = ('due', 'dueTick', 'call')
+
+    def __init__(self, due, dueTick, call):
+        self.due = due
+        self.dueTick = dueTick
+        self.call = call
+
+class Scheduler(object):
+    """
+        I am a hashed timing wheel. Every `tick` seconds I look at the one slot of the wheel that tick hashes to,
+        and run everything in it that's due, all in the same reactor call. Calls due more than a turn of the wheel
+        away just sit in their slot until their turn comes around.
+
+        I keep track of how many calls are waiting (`pending`), how many ran in the last tick (`lastBatch`),
+        and how late they ran, which is at most `tick` seconds unless the reactor is falling behind.
+    """
+    tick = 1.0
+    slots = 512
+    lateWarning = 5.0 # complain when calls run this many seconds late.
+
+    def __init__(self, tick = None, slots = None, clock = reactor):
+        self.tick = tick or self.tick
+        self.slots = slots or self.slots
+        self.clock = clock
+        self.wheel = [[] for i in xrange(self.slots)]
+        self.current = int(clock.seconds() // self.tick) # the last tick we've run.
+        self.pending = 0
+        self.fired = 0
+        self.lastBatch = 0
+        self.maxBatch = 0
+        self.lastLateness = 0.0 # the latest any call in the last batch ran, in seconds.
+        self.maxLateness = 0.0
+        self._loop = LoopingCall(self._advance)
+        self._loop.clock = clock
+
+    def __repr__(self):
+        return '<base.Scheduler pending=%i, fired=%i, lastBatch=%i, lastLateness=%.3f>' % (self.pending, self.fired, self.lastBatch, self.lastLateness)
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self.tick, now = False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def call(self, f, *args, **kwargs):
+        """ Returns a `ScheduledCall` of f, which works like a LoopingCall, except that I do the timing. """
+        return ScheduledCall(self, f, *args, **kwargs)
+
+    def stats(self):
+        return dict(
+            pending = self.pending,
+            fired = self.fired,
+            lastBatch = self.lastBatch,
+            maxBatch = self.maxBatch,
+            lastLateness = self.lastLateness,
+            maxLateness = self.maxLateness
+        )
+
+    def _schedule(self, due, call):
+        # Anything due in a tick we've already run goes in the next one, or it would wait a whole turn.
+        dueTick = max(int(due // self.tick), self.current + 1)
+        timer = _Timer(due, dueTick, call)
+        self.wheel[dueTick % self.slots].append(timer)
+        self.pending += 1
+        return timer
+
+    def _cancel(self, timer):
+        timer.call = None
+        self.pending -= 1
+
+    def _advance(self):
+        now = self.clock.seconds()
+        nowTick = int(now // self.tick)
+        batch = []
+
+        # If we've fallen behind by more than a turn, every slot only needs looking at once.
+        for t in xrange(self.current + 1, min(nowTick, self.current + self.slots) + 1):
+            slot = self.wheel[t % self.slots]
+            if not slot:
+                continue
+
+            waiting = []
+            for timer in slot:
+                if timer.call is None:
+                    continue
+                if timer.dueTick <= nowTick:
+                    batch.append(timer)
+                else:
+                    waiting.append(timer)
+            self.wheel[t % self.slots] = waiting
+
+        self.current = nowTick
+        self.lastBatch = len(batch)
+        if not batch:
+            self.lastLateness = 0.0
+            return
+
+        self.pending -= len(batch)
+        self.fired += len(batch)
+        self.maxBatch = max(self.maxBatch, len(batch))
+        self.lastLateness = max(0.0, now - min([timer.due for timer in batch]))
+        self.maxLateness = max(self.maxLateness, self.lastLateness)
+        if self.lastLateness > self.lateWarning:
+            log.msg('Scheduler is running %i calls %.1f seconds late, is the reactor keeping up?' % (len(batch), self.lastLateness), logLevel = logging.WARNING)
+
+        for timer in batch:
+            try:
+                timer.call._fire(timer.due)
+            except Exception:
+                log.err()
+
+class ScheduledCall(object):
+    """
+        I call f every `interval` seconds, driven by a `Scheduler`. Like a LoopingCall, if f returns a deferred,
+        I don't call it again until the deferred has fired. If a call comes due while I'm still waiting, it's skipped.
+    """
+
+    def __init__(self, scheduler, f, *args, **kwargs):
+        self.scheduler = scheduler
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = None
+        self.running = False
+        self._timer = None
+        self._due = None
+
+    def start(self, interval, now = True, offset = None):
+        """
+            Start calling f every `interval` seconds. If `offset` is given, f gets called that many seconds into
+            every interval of wall clock time, otherwise right away if `now` is True, or in `interval` seconds.
+        """
+        assert not self.running, 'Tried to start a ScheduledCall that was already running.'
+        assert interval > 0
+        self.interval = interval
+        self.running = True
+        t = self.scheduler.clock.seconds()
+
+        if offset is not None:
+            self._timer = self.scheduler._schedule(t + (offset - t) % interval, self)
+        elif now:
+            self._fire(t)
+        else:
+            self._timer = self.scheduler._schedule(t + interval, self)
+
+    def stop(self):
+        assert self.running, 'Tried to stop a ScheduledCall that was not running.'
+        self.running = False
+        if self._timer is not None:
+            self.scheduler._cancel(self._timer)
+            self._timer = None
+
+    def _fire(self, due):
+        self._timer = None
+        self._due = due
+        d = maybeDeferred(self.f, *self.args, **self.kwargs)
+        d.addErrback(self._error)
+        if d.called:
+            self._reschedule(None)
+        else:
+            d.addCallback(self._reschedule)
+
+    def _error(self, err):
+        log.msg('Scheduled call to %r failed:' % (self.f, ), logLevel = logging.ERROR)
+        log.err(err)
+
+    def _reschedule(self, res):
+        if not self.running or self._timer is not None:
+            # We were stopped, or stopped and started again, while f was running.
+            return
+
+        due = self._due + self.interval
+        now = self.scheduler.clock.seconds()
+        if due < now:
+            # We missed some, skip ahead to the next one but keep in phase.
+            due = now + (due - now) % self.interval
+
+        self._timer = self.scheduler._schedule(due, self)
+
+__all__ = ['Scheduler', 'ScheduledCall']
+
+import unittest
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        from twisted.internet.task import Clock
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.scheduler = Scheduler(tick = 1, slots = 8, clock = self.clock)
+        self.scheduler.start()
+        self.calls = []
+
+    def advance(self, seconds):
+        for i in xrange(seconds):
+            self.clock.advance(1)
+
+    def test_offset(self):
+        call = self.scheduler.call(lambda: self.calls.append(self.clock.seconds()))
+        call.start(5, offset = 2)
+        self.advance(20)
+        self.assertEqual(self.calls, [1002, 1007, 1012, 1017])
+        self.assertEqual(self.scheduler.pending, 1)
+
+        call.stop()
+        self.advance(20)
+        self.assertEqual(len(self.calls), 4)
+        self.assertEqual(self.scheduler.pending, 0)
+
+    def test_longer_than_wheel(self):
+        self.scheduler.call(lambda: self.calls.append(self.clock.seconds())).start(20, now = False)
+        self.advance(45)
+        self.assertEqual(self.calls, [1020, 1040])
+
+    def test_waits_for_deferred(self):
+        from twisted.internet.defer import Deferred
+        waiting = []
+        def work():
+            self.calls.append(self.clock.seconds())
+            waiting.append(Deferred())
+            return waiting[-1]
+
+        self.scheduler.call(work).start(2, offset = 1)
+        self.advance(7)
+        self.assertEqual(self.calls, [1001])
+        waiting[-1].callback(None)
+        self.advance(2)
+        self.assertEqual(self.calls, [1001, 1008])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,28 +12,65 @@ from twisted.internet.task import LoopingCall
 import os.path
 from twisted.python import log
 import logging
-from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
+from twisted.internet.defer import maybeDeferred, inlineCallbacks, returnValue, DeferredList, succeed
 from twisted.internet.threads import deferToThreadPool
 from twisted.internet import reactor
 import stats.proc_rrd as rrdtool
+import stats.metrics as metrics
+from stats.util import pick_rra
+from .connections import ConnectionBackoff
+from .counters import CounterStore
 import time
+import zlib
 
-class BaseTemplate:
+# The counters of templates that aren't run by a TemplateRunner, i.e. in tests.
+_counters = CounterStore()
+
+# How far back "-s -1<period>" reaches, months and years are rounded up.
+_periodSeconds = dict(
+    minute = 60,
+    hour = 3600,
+    day = 86400,
+    week = 604800,
+    month = 2678400,
+    year = 31622400
+)
+
+def _option(args, short, long, default):
+    """ Finds the value of an rrdtool command line option in args, whether it's given as "-w700", "-w 700", "-w", "700" or "--width=700". """
+    for i, arg in enumerate(args):
+        if arg == short or arg == long:
+            if i + 1 < len(args):
+                return args[i + 1]
+        elif arg.startswith(long + '='):
+            return arg[len(long) + 1:]
+        elif arg.startswith(short) and not arg.startswith('--'):
+            return arg[len(short):]
+    return default
+
+class BaseTemplate(object):
     """
         I am the base template.
+        
+        There can be tens of thousands of us, so I keep my state in __slots__, and templates that keep state
+        of their own should declare theirs too. A template that doesn't just gets a __dict__ as well.
     """
+    __slots__ = (
+        'id', 'filename', 'config', 'factory', '_testing', 'loopingCall', 'running', 'doingWork', '_drawnState',
+        '_defaultIntervalDraws', '_pollStarted', 'requestsSent', 'successfulRequests', 'failedRequests',
+        'graphsRendered', 'graphsSkipped', 'lastUpdate', 'pollOffset'
+    )
+    
     interval = 60
     gatherFirst = False # Do we want to use the first request to create baseline stats?
     dataFactory = None # The class that will hold our outputted data, to be put into our database!!
-    requestsSent = 0
-    successfulRequests = 0
-    failedRequests = 0
     numGraphs = 0
     sortPriority = 0
     
-    doingWork = False
     waitTillFinish = False
     useDatabase = True
+    rollup = False # Am I fed the updates of other graphs, config['ids'], which then have to be polled in the same process as me?
+    sharedDefinitions = True # Are create() and graph() the same for every graph of my class? Then they're compiled once per class.
     
     def __init__(self, filename = None, testing = False, id = None, config = None, factory = None):
         """ DO NOT OVERWRITE ME, USE init() instead!!! """
@@ -43,8 +80,18 @@ class BaseTemplate:
         self.config = config
         self.factory = factory
         self._testing = testing
-        self.loopingCall = LoopingCall(self._do_work)
+        self.loopingCall = None # made when I'm first run, most of us never are in a front end or a poller.
         self.running = False
+        self.doingWork = False
+        self._drawnState = None # (period, graph index) -> what graph was drawn from, once I draw something.
+        self._defaultIntervalDraws = ()
+        self.requestsSent = 0
+        self.successfulRequests = 0
+        self.failedRequests = 0
+        self.graphsRendered = 0
+        self.graphsSkipped = 0 # Graphs we didn't draw, because nothing on them could have changed.
+        self.lastUpdate = None # When we last successfully updated our database.
+        self.pollOffset = None # How many seconds into each interval (of wall clock time) I poll, once I'm running.
         self.init()
         
     def init(self):
@@ -53,8 +100,8 @@ class BaseTemplate:
         """
 
     def __repr__(self):
-        return '<templates.%s id=%r, requestsSent=%i, successfulRequests=%i, failedRequests=%i, running=%r, doingWork=%r>' % ( 
-            self.__class__.__name__.lower(), self.id, self.requestsSent, self.successfulRequests, self.failedRequests, self.running, self.doingWork
+        return '<templates.%s id=%r, requestsSent=%i, successfulRequests=%i, failedRequests=%i, graphsRendered=%i, graphsSkipped=%i, running=%r, doingWork=%r>' % ( 
+            self.__class__.__name__.lower(), self.id, self.requestsSent, self.successfulRequests, self.failedRequests, self.graphsRendered, self.graphsSkipped, self.running, self.doingWork
         )
         
     def __cmp__(self, other):
@@ -83,6 +130,7 @@ class BaseTemplate:
         
         self.doingWork = True
         self.requestsSent += 1
+        self._pollStarted = time.time()
         
         d = maybeDeferred(self.do_work) \
          .addCallback(self.parse) \
@@ -105,6 +153,18 @@ class BaseTemplate:
                return "N:15:100" 
         """
         raise NotImplemented()
+    
+    def _deltas(self, values, restart = False, fromZero = False):
+        """
+            For templates that write how much counters went up by: returns how much each of `values` went up since
+            my last poll, or None if this poll has nothing to compare with and shouldn't be written. The counters
+            are kept across restarts, see `base.CounterStore`, so that's only after my first poll ever, or after
+            what I poll was restarted, which I can say with `restart` if I know better than the counters do, or
+            after my last poll is older than the heartbeat of my RRD, say after a long downtime. Counters that
+            start over from zero when what I poll restarts can say so with `fromZero` to be written anyway.
+        """
+        counters = self.factory.counters if self.factory is not None else _counters
+        return counters.deltas(self.id, values, restart = restart, fromZero = fromZero, maxAge = self.interval * 2 or None)
         
     def _update(self, data):
         """
@@ -114,21 +174,65 @@ class BaseTemplate:
         if not data:
             return None
         
-        return rrdtool.update(self.filename, data)
+        # Hand it to the rollups I'm a member of, see templates.aggregate.
+        rollups = self.factory.rollups.get(self.id) if self.factory is not None else None
+        if rollups:
+            for rollup in rollups:
+                rollup.feed(self, data)
+        
+        return rrdtool.update(self.filename, data).addCallback(self._updated)
+    
+    def getConnection(self, connect, isAlive = None, close = None):
+        """
+            Returns a deferred that fires with my open connection to whatever I poll, calling connect() to make
+            a new one if I don't have one yet, or the last one died. See `base.ConnectionManager.get`.
+        """
+        return self.factory.connections.get(self.id, connect, isAlive, close)
+    
+    def dropConnection(self, err = None):
+        """ Close my connection because something went wrong with it. I can be used as an errback, and pass the error on. """
+        self.factory.connections.drop(self.id)
+        return err
+    
+    def _releaseConnection(self):
+        if self.factory is not None:
+            self.factory.connections.release(self.id)
+    
+    def _updated(self, res):
+        self.lastUpdate = int(time.time())
+        return res
 
     def create(self):
         """ Return an iterable of strings that shall be used to create the database """
         raise NotImplemented()
 
     @inlineCallbacks
-    def _create(self, overwrite = False):
-        """ Internal _create call. """
+    def _create(self, overwrite = False, exists = None):
+        """
+            Internal _create call, fires with True if I created my database, and False if I didn't need to.
+            `exists` saves looking for the file, when whoever calls me already knows whether it's there.
+        """
         if not self.useDatabase:
-            return
+            returnValue(False)
         
-        if os.path.exists(self.filename) and not overwrite:
-            log.msg('Database %r already exists, not overwriting!' % self.filename, logLevel = logging.INFO)
-            return
+        if exists is None:
+            exists = os.path.exists(self.filename)
+        
+        if exists and not overwrite:
+            log.msg('Database %r already exists, not overwriting!' % self.filename, logLevel = logging.DEBUG)
+            returnValue(False)
+        
+        res = yield rrdtool.create(self.filename, *self._createArgs())
+        log.msg('Database %r created successfully!' % self.filename, logLevel = logging.DEBUG)
+        returnValue(True)
+    
+    _compiledCreates = {}
+    
+    def _createArgs(self):
+        """ Returns the arguments for `rrdtool create`, from create(), worked out once per class and interval if they're shared. """
+        key = (self.__class__, self.interval)
+        if self.sharedDefinitions and key in BaseTemplate._compiledCreates:
+            return BaseTemplate._compiledCreates[key]
         
         # Variables that shall be substituted in data returned by create()
         fmt_dict = {
@@ -136,8 +240,89 @@ class BaseTemplate:
             '2interval': self.interval*2,
         }
         
-        res = yield rrdtool.create(self.filename, *[ln % fmt_dict for ln in self.create()])
-        log.msg('Database %r created successfully!' % self.filename, logLevel = logging.INFO)
+        args = tuple([ln % fmt_dict for ln in self.create()])
+        if self.sharedDefinitions:
+            BaseTemplate._compiledCreates[key] = args
+        return args
+    
+    _rraDefinitions = {}
+    
+    def _rras(self):
+        """ Returns (step, [(cf, steps, rows), ...]) of the database create() makes, worked out once per template class and interval. """
+        key = (self.__class__, self.interval)
+        if key not in BaseTemplate._rraDefinitions:
+            args = self._createArgs()
+            rras = []
+            for arg in args:
+                if arg.startswith('RRA:'):
+                    fields = arg.split(':')
+                    rras.append((fields[1], int(fields[3]), int(fields[4])))
+            
+            BaseTemplate._rraDefinitions[key] = (int(_option(args, '-s', '--step', 300)), rras)
+        
+        return BaseTemplate._rraDefinitions[key]
+    
+    _dataSourceDefinitions = {}
+    
+    def _dataSources(self):
+        """ Returns [(name, type), ...] of the data sources of the database create() makes, in the order update() gives their values. """
+        key = (self.__class__, self.interval)
+        if key not in BaseTemplate._dataSourceDefinitions or not self.sharedDefinitions:
+            sources = [tuple(arg.split(':')[1:3]) for arg in self._createArgs() if arg.startswith('DS:')]
+            if not self.sharedDefinitions:
+                return sources
+            BaseTemplate._dataSourceDefinitions[key] = sources
+        
+        return BaseTemplate._dataSourceDefinitions[key]
+    
+    def _rraStep(self, period, args):
+        """
+            Returns the step of the RRA in my database that rrdtool will draw a graph with
+            these args from, or None if I can't tell.
+        """
+        span = _periodSeconds.get(period)
+        if span is None:
+            return None
+        
+        step, rras = self._rras()
+        cf = 'AVERAGE'
+        for arg in args:
+            if arg.startswith('DEF:'):
+                cf = arg.split(':')[3]
+                break
+        
+        rras = [(steps, rows) for rra_cf, steps, rows in rras if rra_cf == cf]
+        # rrdtool fetches data at the resolution of one pixel unless it's told otherwise.
+        resolution = max(int(_option(args, '-S', '--step', 0)), span // int(_option(args, '-w', '--width', 400)))
+        now = int(time.time())
+        i = pick_rra(step, rras, now - span, now, resolution)
+        if i is None:
+            return None
+        
+        return step * rras[i][0]
+    
+    def _sourceState(self, step, sources):
+        """
+            Returns which consolidated row of a `step` second RRA the sources' databases have last written,
+            or None if we can't tell or a source has stopped updating (and its graph will fill with unknowns).
+        """
+        now = time.time()
+        state = []
+        for source in sources:
+            if source is None or source.lastUpdate is None or now - source.lastUpdate >= 2 * source.interval:
+                return None
+            state.append(source.lastUpdate // step)
+        
+        return state
+    
+    def _skipGraph(self, period, index, state):
+        """ Returns True if graph `index` for `period` was last drawn from exactly this state, so drawing it again is pointless. """
+        if state is None or self._drawnState is None or self._drawnState.get((period, index)) != state:
+            return False
+        
+        self.graphsSkipped += 1
+        self.factory.skippedGraphs[period] += 1
+        return True
     
     def parse(self, data):
         """
@@ -165,68 +350,193 @@ class BaseTemplate:
             I am called every every `config.graph_draw_frequency[period]` seconds.
         """
 
-        fmt_dict = {
+        fmt_dict = self._graphFormat(period)
+        
+        return DeferredList([
+            self._renderGraph(i, vector, fmt_dict) for i, vector in enumerate(self._graphVectors(period))
+        ], consumeErrors = True)
+    
+    def _graphOne(self, period, index):
+        """
+            Render just graph number `index` for `period`, this gets called when graphs are
+            rendered on demand instead of every `config.graph_draw_frequency[period]` seconds.
+        """
+        vector = self._graphVectors(period)[index]
+        return self._renderGraph(index, vector, self._graphFormat(period))
+    
+    _compiledGraphs = {}
+    
+    def _graphVectors(self, period):
+        """
+            Returns graph() compiled for `period`, as a list of (args, holes) per graph: args has every argument that's
+            the same for all graphs of my class already substituted, and holes is [(index, argument), ...] of the ones
+            that need my own fields, see _graphArgs. They're compiled once per class, interval and period if they're shared.
+        """
+        key = (self.__class__, self.interval, period)
+        if self.sharedDefinitions and key in BaseTemplate._compiledGraphs:
+            return BaseTemplate._compiledGraphs[key]
+        
+        fixed = {'period': period, 'template': self.template}
+        vectors = []
+        for graph in self.graph():
+            args, holes = [], []
+            for i, arg in enumerate(graph):
+                try:
+                    args.append(arg % fixed)
+                except KeyError:
+                    args.append(None)
+                    holes.append((i, arg))
+            vectors.append((args, holes))
+        
+        if self.sharedDefinitions:
+            BaseTemplate._compiledGraphs[key] = vectors
+        return vectors
+    
+    def _graphFormat(self, period):
+        """ Variables that shall be substituted in data returned by graph() """
+        return {
             'period': period,
             'filename': self.filename,
             'id': self.id,
             'timestamp': int(time.time()),
             'template': self.template,
         }
+    
+    def _graphDefinition(self, period, index):
+        """ The arguments `rrdtool graph` draws graph `index` for `period` with, for whoever wants to draw it some other way. """
+        return self._graphArgs(self._graphVectors(period)[index], self._graphFormat(period))
+    
+    def _graphArgs(self, vector, fmt_dict):
+        """ Fill my own fields from fmt_dict into the holes of one graph compiled by _graphVectors. """
+        args, holes = vector
+        args = list(args)
+        for i, arg in holes:
+            args[i] = arg % fmt_dict
+        return args
+    
+    def _graphFilename(self, period, index):
+        return '%s-%s.%i.png' % (self.id, period, index)
+    
+    def _renderGraph(self, index, vector, fmt_dict):
+        period = fmt_dict['period']
+        filename = self._graphFilename(period, index)
+        args = self._graphArgs(vector, fmt_dict)
         
-        defers = []
-        
-        for i, graph in enumerate(self.graph()):
-            filename = '%s-%s.%i.png' % (self.id, period, i)
-            defers.append(
-                rrdtool.graph(
-                    os.path.join(self.factory.stats.config['image_path'], filename),
-                    *[ln % fmt_dict for ln in graph]
-                ).addErrback(
-                    self._graphError, filename
-                ).addCallback(
-                    self._graphSuccess, filename
-                )
-            )
-            
-        return DeferredList(defers, consumeErrors = True)
+        # Don't bother if the RRA this graph is drawn from hasn't got a new row since we last drew it.
+        step = self._rraStep(period, args)
+        state = self._sourceState(step, [self]) if step else None
+        if self._skipGraph(period, index, state):
+            return succeed(None)
+        
+        self.graphsRendered += 1
+        return self._rrdGraph(
+            os.path.join(self.factory.stats.config['image_path'], filename), args, period
+        ).addCallbacks(
+            self._graphSuccess, self._graphError,
+            callbackArgs = (filename, period, index, state), errbackArgs = (filename,)
+        )
      
+    def _rrdGraph(self, path, args, period):
+        """ Draw graph `path` with rrdtool, or have a render worker draw it if we have them. """
+        renderers = self.factory.renderers if self.factory is not None else None
+        if renderers is not None:
+            return renderers.graph(self.id, period, path, args)
+        return rrdtool.graph(path, *args)
+    
     def _graphError(self, err, filename):
-        log.msg("Failed to generate graph %r!" % graph)
+        if err.check(rrdtool.LimiterQueueFull):
+            log.msg("Not generating graph %r, too many graphs are waiting already." % filename, logLevel = logging.WARNING)
+            return
+        
+        log.msg("Failed to generate graph %r!" % filename)
         log.err(err)
     
-    def _graphSuccess(self, res, filename):
+    def _graphSuccess(self, res, filename, period = None, index = None, state = None):
         ct = time.time()
         log.msg('Generated graph %r!' % (filename), logLevel = logging.DEBUG)
         self.factory.stats.last_draw_timestamp[filename] = int(ct)
+        self._setDrawnState(period, index, state)
+    
+    def _setDrawnState(self, period, index, state):
+        """ Graph `index` for `period` was just drawn from `state`, see _skipGraph. """
+        if self._drawnState is None:
+            self._drawnState = {}
+        self._drawnState[(period, index)] = state
 
+    def pollPhase(self):
+        """ How many seconds into each interval I should poll, worked out from my id so it's the same after every restart. """
+        return (zlib.crc32(str(self.id)) & 0xffffffff) % (self.interval * 1000) / 1000.0
+    
     def run(self):
         """
             Run me, and error if somehow I'm called while I am running!
         """
-        assert not self.loopingCall.running
         assert not self.running
+        if self.loopingCall is None:
+            if self.factory is not None:
+                self.loopingCall = self.factory.scheduler.call(self._do_work)
+            else:
+                self.loopingCall = LoopingCall(self._do_work)
+        assert not self.loopingCall.running
         self.running = True
         if self.interval > 0:
-            self.loopingCall.start(self.interval)
+            if self.factory is None:
+                self.loopingCall.start(self.interval)
+            elif self.factory.stats.config['poll_spread']:
+                # Poll at my own offset into the interval, so templates with the same interval don't all poll at once.
+                self.pollOffset = self.pollPhase()
+                self.loopingCall.start(self.interval, offset = self.pollOffset)
+            else:
+                self.pollOffset = time.time() % self.interval
+                self.loopingCall.start(self.interval)
+        
+    def reconfigure(self, config):
+        """
+            Take a new config, one TemplateRunner.prepare has already made a template with, without stopping, so I
+            keep when I poll. My connection is closed, the next poll makes one with the new config. The counters I
+            work out rates from are in the TemplateRunner's store, which forgets them unless only my periods changed.
+        """
+        self.config = config
+        self.init()
+        self._drawnState = None
+        if self.factory is not None:
+            self.factory.connections.close(self.id)
         
     def stop(self):
         """ Stop me. """
         if self.running:
             self.running = False
-            if self.loopingCall.running:
-                self.loopingCall.start()
+            self.pollOffset = None
+            if self.loopingCall is not None and self.loopingCall.running:
+                self.loopingCall.stop()
+            if self.factory is not None:
+                self.factory.connections.close(self.id)
         
     def failed(self, err):
         """ Something along the lines from do_work to update failed. """
         self.doingWork = False
         self.failedRequests += 1
+        self._releaseConnection()
+        if err.check(ConnectionBackoff):
+            self._pollDone('skipped')
+            log.msg("%r skipped a work cycle: %s" % (self, err.getErrorMessage()), logLevel = logging.DEBUG)
+            return
+        
+        self._pollDone('error')
         log.msg("%r has encountered an error: " % self, logLevel = logging.ERROR)
         log.err(err)
 
+    def _pollDone(self, result):
+        metrics.poll_duration.observe(
+            time.time() - self._pollStarted, template = getattr(self, 'template', self.__class__.__name__.lower()), result = result
+        )
+    
     def complete(self, val):
         """ do_work completed a successful unit of work, and no errors reached us. """
         
         self.doingWork = False
         self.successfulRequests += 1
+        self._releaseConnection()
+        self._pollDone('ok')
         
         log.msg('%r completed a successful work cycle' % self, logLevel = logging.DEBUG)
\ No newline at end of file
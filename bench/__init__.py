@@ -0,0 +1,9 @@
+"""
+    prickle.bench
+    ~~~~~~~~~~~~~
+
+    Tools to measure how much prickle can take, see `harness` and `micro`.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
@@ -0,0 +1,335 @@
+"""
+    prickle.bench.harness
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    I run the real Stats / TemplateRunner stack against local fake nginx, memcached and mysql
+    servers, and report how well it keeps up as the number of graphs grows:
+
+        python -m stats.bench.harness --graphs 100,1000,5000 --interval 10 --duration 60 --stub-rrdtool
+
+    Every N runs in a process of its own. The fake servers answer after a random delay of up to twice
+    `--latency` seconds, and fail `--error-rate` of the time. With `--stub-rrdtool`, rrdtool is swapped for
+    a shell script that answers every command with OK, so what's measured is prickle and not the disk.
+
+    For each N, I report:
+
+        polls/s     successful polls per second, after the first interval (the warm up) is over.
+        missed      intervals in that time that didn't end with a successful update.
+        lag         mean and 95th percentile time from starting a poll to its update being written.
+        late        the most the scheduler ran anything late.
+        render      how long drawing every graph for one period took, once polling is done.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from optparse import OptionParser, SUPPRESS_HELP
+from struct import pack
+import subprocess
+import tempfile
+import random
+import shutil
+import json
+import time
+import sys
+import os
+import re
+
+STUB_RRDTOOL = r'''#!/bin/sh
+# Answers like rrdtool would, without doing anything but touching the files it would write.
+if [ "$1" = "-" ]; then
+    while read cmd file rest; do
+        file=${file#\"}; file=${file%\"}
+        case "$cmd" in
+            quit) exit 0;;
+            graph) : > "$file"; echo "700x150";;
+            create) : > "$file";;
+        esac
+        echo "OK u:0.00 s:0.00 r:0.00"
+    done
+    exit 0
+fi
+case "$1" in
+    graph) : > "$2"; echo "700x150";;
+    create) : > "$2";;
+esac
+exit 0
+'''
+
+_nginxStatus = (
+    'Active connections: %(active)i \nserver accepts handled requests\n %(requests)i %(requests)i %(requests)i \n'
+    'Reading: 0 Writing: %(active)i Waiting: 0 \n'
+)
+
+_memcachedFields = ['curr_connections', 'get_hits', 'get_misses', 'bytes', 'bytes_read', 'bytes_written']
+
+def _fakeServers(latency, errorRate):
+    """ Starts the fake servers on ports of their own, returns {template: port}. """
+    from twisted.internet import reactor, protocol
+    from twisted.protocols.basic import LineReceiver
+
+    def later(f, *a):
+        reactor.callLater(random.uniform(0, 2 * latency), f, *a)
+
+    def failing():
+        return random.random() < errorRate
+
+    counter = [0]
+    def count():
+        counter[0] += random.randint(1, 1000)
+        return counter[0]
+
+    class FakeNginx(LineReceiver):
+        def lineReceived(self, line):
+            if not line:
+                later(self.respond)
+
+        def respond(self):
+            if not self.transport.connected:
+                return
+            if failing():
+                self.transport.write('HTTP/1.1 500 Internal Server Error\r\nContent-Length: 0\r\n\r\n')
+                return
+            body = _nginxStatus % dict(active = random.randint(1, 100), requests = count())
+            self.transport.write('HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %i\r\n\r\n%s' % (len(body), body))
+
+    class FakeMemcached(LineReceiver):
+        def lineReceived(self, line):
+            if line.startswith('stats'):
+                later(self.respond)
+
+        def respond(self):
+            if not self.transport.connected:
+                return
+            if failing():
+                self.sendLine('SERVER_ERROR out of memory')
+                return
+            for field in _memcachedFields:
+                self.sendLine('STAT %s %i' % (field, count()))
+            self.sendLine('END')
+
+    def packet(seq, payload):
+        return pack('<I', len(payload))[:3] + chr(seq) + payload
+
+    def lenenc(value):
+        return chr(len(value)) + value
+
+    class FakeMySQL(protocol.Protocol):
+        """ Lets anyone in with mysql_native_password, and answers any query with made up values for the variables it names. """
+        salt = '12345678abcdefghijkl'
+
+        def connectionMade(self):
+            self.authenticated = False
+            self.transport.write(packet(0,
+                '\x0a5.5.0-fake\0' + pack('<I', 1) + self.salt[:8] + '\0' + pack('<HBHH', 0xf7ff, 33, 2, 0x0008) +
+                chr(21) + '\0' * 10 + self.salt[8:] + '\0' + 'mysql_native_password\0'
+            ))
+
+        def dataReceived(self, data):
+            if not self.authenticated:
+                self.authenticated = True
+                self.transport.write(packet(2, '\x00\x00\x00\x02\x00\x00\x00'))
+            elif data[4:5] == '\x03':
+                later(self.respond, re.findall(r"'(\w+)'", data[5:]))
+
+        def respond(self, names):
+            if not self.transport.connected:
+                return
+            if failing():
+                self.transport.write(packet(1, '\xff' + pack('<H', 1205) + '#HY000Lock wait timeout exceeded'))
+                return
+            eof = '\xfe\x00\x00\x02\x00'
+            packets = [packet(1, '\x02'), packet(2, 'name'), packet(3, 'value'), packet(4, eof)]
+            for i, name in enumerate(names):
+                packets.append(packet(5 + i, lenenc(name) + lenenc(str(count()))))
+            packets.append(packet(5 + len(names), eof))
+            self.transport.write(''.join(packets))
+
+    ports = {}
+    for template, proto in (('nginx', FakeNginx), ('memcached', FakeMemcached), ('mysql', FakeMySQL)):
+        factory = protocol.Factory()
+        factory.protocol = proto
+        ports[template] = reactor.listenTCP(0, factory, interface = '127.0.0.1').getHost().port
+    return ports
+
+def _percentile(histogram, fraction, **labels):
+    """ The upper bound of the bucket the `fraction` percentile of a metrics.Histogram falls in. """
+    counts = None
+    for key, (bucketCounts, total, n) in histogram.series.iteritems():
+        if all([key[histogram.labelNames.index(name)] == value for name, value in labels.iteritems()]):
+            counts = bucketCounts if counts is None else [a + b for a, b in zip(counts, bucketCounts)]
+
+    if not counts:
+        return None
+
+    wanted = fraction * sum(counts)
+    seen = 0
+    for bound, n in zip(histogram.buckets, counts):
+        seen += n
+        if seen >= wanted:
+            return bound
+
+def run_once(options, n):
+    """ Runs one benchmark with n graphs, in this process, and returns what we found. """
+    workdir = tempfile.mkdtemp(prefix = 'prickle-bench-')
+    try:
+        if options.stub_rrdtool:
+            bindir = os.path.join(workdir, 'bin')
+            os.mkdir(bindir)
+            stub = os.path.join(bindir, 'rrdtool')
+            with open(stub, 'w') as fp:
+                fp.write(STUB_RRDTOOL)
+            os.chmod(stub, 0755)
+            # proc_rrd looks rrdtool up in $PATH when it's imported.
+            os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+
+        return _run(options, n, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+def _run(options, n, workdir):
+    from twisted.internet import reactor
+    from twisted.internet.defer import maybeDeferred
+    from twisted.python import log
+    from stats import Stats
+    from stats.templates import load_template
+    import stats.metrics as metrics
+
+    mix = options.mix.split(',')
+    for name in mix:
+        load_template(name).interval = options.interval
+
+    ports = _fakeServers(options.latency, options.error_rate)
+    for name in ('database', 'image'):
+        os.mkdir(os.path.join(workdir, name))
+
+    stats = Stats('bench')
+    stats.config.update(dict(
+        database_path = os.path.join(workdir, 'database'),
+        image_path = os.path.join(workdir, 'image'),
+        httpd_port = 0,
+        interface = '127.0.0.1',
+        rrdtool_workers = options.workers,
+        max_connections = n + 100,
+        graph_draw_frequency = dict(hour = 3600, default = 3600),
+        graphs = [
+            dict(id = 'bench%i' % i, template = mix[i % len(mix)], config = dict(
+                host = '127.0.0.1', port = ports[mix[i % len(mix)]], user = 'bench', passwd = 'bench', periods = ['hour']
+            )) for i in xrange(n)
+        ]
+    ))
+
+    result = dict(graphs = n, interval = options.interval, duration = options.duration)
+    runner = stats.template_runner
+    templates = stats.active_graphs
+
+    def counts():
+        return (
+            sum([template.successfulRequests for template in templates.itervalues()]),
+            sum([template.failedRequests for template in templates.itervalues()]),
+            time.time()
+        )
+
+    def warmedUp():
+        result['start'] = counts()
+        reactor.callLater(options.duration, lambda: maybeDeferred(finished).addErrback(log.err).addBoth(stop))
+
+    def finished():
+        ok, failed, end = counts()
+        ok0, failed0, start = result.pop('start')
+        elapsed = end - start
+        expected = int(elapsed / options.interval * n)
+
+        pollCount, pollSum = metrics.poll_duration.total(result = 'ok')
+        result.update(
+            polls_per_second = (ok - ok0) / elapsed,
+            failed = failed - failed0,
+            expected = expected,
+            missed = max(0, expected - (ok - ok0)),
+            lag_mean = pollSum / pollCount if pollCount else None,
+            lag_p95 = _percentile(metrics.poll_duration, 0.95, result = 'ok'),
+            late_max = runner.scheduler.maxLateness,
+        )
+
+        if options.render:
+            rendered = sum([template.graphsRendered for template in templates.itervalues()])
+            return maybeDeferred(runner.render_graphs, ['hour']).addCallback(renderDone, time.time(), rendered)
+
+    def renderDone(res, started, rendered):
+        result['render_seconds'] = time.time() - started
+        result['rendered'] = sum([template.graphsRendered for template in templates.itervalues()]) - rendered
+
+    def stop(res):
+        # Whatever happened, don't leave the reactor running.
+        if reactor.running:
+            reactor.stop()
+
+    stats.create_databases()
+    reactor.callLater(options.interval, warmedUp)
+    stats.run()
+    return result
+
+_columns = [
+    ('graphs', 'N', '%i'),
+    ('polls_per_second', 'polls/s', '%.1f'),
+    ('expected', 'expected', '%i'),
+    ('missed', 'missed', '%i'),
+    ('failed', 'failed', '%i'),
+    ('lag_mean', 'lag mean', '%.3fs'),
+    ('lag_p95', 'lag p95', '<%gs'),
+    ('late_max', 'late', '%.3fs'),
+    ('render_seconds', 'render', '%.2fs'),
+]
+
+def _table(results):
+    rows = [[title for key, title, fmt in _columns]]
+    for result in results:
+        rows.append([
+            '-' if result.get(key) is None else fmt % result[key] for key, title, fmt in _columns
+        ])
+
+    widths = [max([len(row[i]) for row in rows]) for i in xrange(len(_columns))]
+    return '\n'.join(['  '.join([cell.rjust(width) for cell, width in zip(row, widths)]) for row in rows])
+
+def main(argv = None):
+    parser = OptionParser(usage = '%prog [options]')
+    parser.add_option('--graphs', default = '100,500,1000', help = 'comma separated numbers of graphs to try [%default]')
+    parser.add_option('--mix', default = 'nginx,memcached,mysql', help = 'templates to poll, round robin [%default]')
+    parser.add_option('--interval', type = 'int', default = 10, help = 'poll interval, in seconds [%default]')
+    parser.add_option('--duration', type = 'int', default = 30, help = 'seconds to measure for, after one interval of warm up [%default]')
+    parser.add_option('--latency', type = 'float', default = 0.005, help = 'mean response time of the fake servers, in seconds [%default]')
+    parser.add_option('--error-rate', type = 'float', default = 0.0, help = 'fraction of requests the fake servers fail [%default]')
+    parser.add_option('--workers', type = 'int', default = 0, help = 'rrdtool_workers [%default]')
+    parser.add_option('--stub-rrdtool', action = 'store_true', default = False, help = 'use a stub rrdtool that does nothing')
+    parser.add_option('--no-render', dest = 'render', action = 'store_false', default = True, help = "don't time a render at the end")
+    parser.add_option('--json', action = 'store_true', default = False, help = 'print results as json, one per line')
+    parser.add_option('--single', type = 'int', help = SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.single:
+        print json.dumps(run_once(options, options.single))
+        return
+
+    results = []
+    for n in [int(n) for n in options.graphs.split(',')]:
+        # A reactor can only run once, so every N gets a process of its own.
+        child = subprocess.Popen(
+            [sys.executable, '-m', 'stats.bench.harness', '--single', str(n)] + [arg for arg in (argv or sys.argv[1:])],
+            stdout = subprocess.PIPE
+        )
+        output = child.communicate()[0]
+        if child.returncode:
+            print >> sys.stderr, 'Benchmark with %i graphs failed with exit status %i' % (n, child.returncode)
+            continue
+
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        if options.json:
+            print json.dumps(result)
+            sys.stdout.flush()
+
+    if not options.json:
+        print _table(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+    prickle.bench.micro
+    ~~~~~~~~~~~~~~~~~~~
+
+    I time the bits of python that run for every graph, every cycle, and compare them against
+    the timings saved last time:
+
+        python -m stats.bench.micro --save        # time everything, and save it as the baseline.
+        python -m stats.bench.micro               # time everything, and fail if anything got slower.
+
+    A benchmark fails when it's more than `--threshold` slower than its baseline. Every benchmark is
+    run `--repeat` times and the fastest is kept, since anything slower than that is noise from
+    whatever else the machine was doing. Baselines only mean something on the machine they were
+    saved on, so I won't compare against a baseline from another host unless told to with `--force`.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from optparse import OptionParser
+import platform
+import timeit
+import json
+import sys
+import os
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+GRAPHS = 1000 # how many graphs the scans over active_graphs look at.
+
+_nginxStatus = 'Active connections: 4 \nserver accepts handled requests\n 1112965 1112965 1112965 \nReading: 0 Writing: 4 Waiting: 5 \n'
+
+benchmarks = []
+
+def benchmark(f):
+    """ Registers f as a benchmark, f sets up whatever it needs and returns the function to time. """
+    benchmarks.append(f)
+    return f
+
+def _stats():
+    """ A Stats with GRAPHS graphs in active_graphs, made like TemplateRunner.run makes them. """
+    from stats import Stats
+    from stats.templates import load_template
+
+    stats = Stats('micro')
+    runner = stats.template_runner
+    mix = ['nginx', 'memcached', 'mysql']
+    for i in xrange(GRAPHS):
+        name = mix[i % len(mix)]
+        id = 'micro%i' % i
+        template = stats.active_graphs[id] = load_template(name)(
+            '/nonexistent/%s.rrd' % id, id = id, factory = runner,
+            config = dict(host = '127.0.0.1', periods = ['hour', 'day', 'week', 'month'] if i % 2 else ['hour'])
+        )
+        template._defaultIntervalDraws = tuple(set(template.config['periods']) - runner.scheduledPeriods)
+        template.running = True
+    return stats
+
+def _template(name):
+    from stats.templates import load_template
+    return load_template(name)('/nonexistent/%s.rrd' % name, id = name, config = dict(host = '127.0.0.1'))
+
+@benchmark
+def nginx_parse():
+    """ Nginx.parse of one status page. """
+    parse = _template('nginx').parse
+    return lambda: parse(_nginxStatus)
+
+@benchmark
+def memcached_update():
+    """ Memcached.update of one stats response. """
+    template = _template('memcached')
+    data = dict((key, 1000 + i) for i, key in enumerate(template._wantedFields))
+    # The first poll has nothing to get deltas from.
+    template.update(data)
+    return lambda: template.update(data)
+
+@benchmark
+def mysql_update():
+    """ MySQL.update of one SHOW GLOBAL STATUS. """
+    template = _template('mysql')
+    data = dict((key, 1000 + i) for i, key in enumerate(template._wantedFields))
+    data['uptime'] = 1000
+    template.update(data)
+    return lambda: template.update(data)
+
+@benchmark
+def graph_args():
+    """ Substituting into the arguments of all of a mysql graph's images, like _graph does for each period. """
+    template = _template('mysql')
+    return lambda: [template._graphArgs(vector, template._graphFormat('hour')) for vector in template._graphVectors('hour')]
+
+@benchmark
+def render_job_queue():
+    """ Working out what to draw for the 'hour' and 'default' periods, over every graph. """
+    runner = _stats().template_runner
+    return lambda: runner._jobQueue(['hour', 'default'])
+
+@benchmark
+def filter_scan():
+    """ The filter route's scan over every graph, for the graphs of one template and period. """
+    from stats.app import filter_graphs
+    graphs = _stats().active_graphs
+    return lambda: list(filter_graphs(graphs, 'mysql', 'day'))
+
+def run(names = None, repeat = 5, seconds = 0.2):
+    """ Returns {name: seconds per call} of the benchmarks named, or all of them. """
+    results = {}
+    for f in benchmarks:
+        if names and f.__name__ not in names:
+            continue
+
+        timer = timeit.Timer(f())
+        # Call it enough times that one run takes about `seconds`.
+        number = 1
+        while timer.timeit(number) < seconds / 10:
+            number *= 10
+        number = max(1, int(number * seconds / max(timer.timeit(number), 1e-9)))
+
+        results[f.__name__] = min(timer.repeat(repeat, number)) / number
+    return results
+
+def _load(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
+
+def _save(path, results):
+    with open(path, 'w') as fp:
+        json.dump(dict(host = platform.node(), python = platform.python_version(), results = results), fp, indent = 4, sort_keys = True)
+        fp.write('\n')
+
+def compare(results, baseline, threshold):
+    """ Returns [(name, seconds, baseline seconds or None, ratio or None, failed), ...] """
+    rows = []
+    for name in sorted(results):
+        seconds = results[name]
+        before = baseline.get(name)
+        ratio = seconds / before if before else None
+        rows.append((name, seconds, before, ratio, ratio is not None and ratio > 1 + threshold))
+    return rows
+
+def main(argv = None):
+    parser = OptionParser(usage = '%prog [options] [benchmark ...]')
+    parser.add_option('--baseline', default = BASELINE, help = 'where baselines are kept [%default]')
+    parser.add_option('--save', action = 'store_true', default = False, help = 'save these timings as the new baseline')
+    parser.add_option('--threshold', type = 'float', default = 0.2, help = 'fail when a benchmark is this much slower than its baseline [%default]')
+    parser.add_option('--repeat', type = 'int', default = 5, help = 'times to run each benchmark, the fastest is kept [%default]')
+    parser.add_option('--force', action = 'store_true', default = False, help = 'compare against a baseline saved on another host')
+    parser.add_option('--list', action = 'store_true', default = False, help = 'list the benchmarks and exit')
+    options, names = parser.parse_args(argv)
+
+    if options.list:
+        for f in benchmarks:
+            print '%-20s %s' % (f.__name__, f.__doc__.strip())
+        return 0
+
+    unknown = set(names) - set([f.__name__ for f in benchmarks])
+    if unknown:
+        parser.error('no such benchmark: %s' % ', '.join(sorted(unknown)))
+
+    results = run(names, options.repeat)
+    saved = _load(options.baseline)
+    baseline = {}
+    if saved and (saved['host'] == platform.node() or options.force):
+        baseline = saved['results']
+    elif saved:
+        print >> sys.stderr, 'Baseline %s was saved on %s, not comparing against it (--force to anyway).' % (options.baseline, saved['host'])
+
+    rows = compare(results, baseline, options.threshold)
+    print '%-20s %12s %12s %8s' % ('benchmark', 'usec/call', 'baseline', 'change')
+    for name, seconds, before, ratio, failed in rows:
+        print '%-20s %12.2f %12s %8s%s' % (
+            name, seconds * 1e6,
+            '-' if before is None else '%.2f' % (before * 1e6),
+            '-' if ratio is None else '%+.0f%%' % ((ratio - 1) * 100),
+            '  SLOWER' if failed else ''
+        )
+
+    if options.save:
+        if names:
+            # Keep the baselines of the benchmarks that weren't run this time.
+            results = dict(baseline, **results)
+        _save(options.baseline, results)
+        print 'Saved baseline to %s' % options.baseline
+        return 0
+
+    failed = [name for name, seconds, before, ratio, failed in rows if failed]
+    if failed:
+        print >> sys.stderr, '%i benchmark(s) got more than %i%% slower: %s' % (len(failed), options.threshold * 100, ', '.join(failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+    prickle.bench.startup
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    I time how long prickle takes to import for the different ways it gets started, each in a
+    fresh python, since that's what a rolling restart waits on:
+
+        python -m stats.bench.startup --save      # time everything, and save it as the baseline.
+        python -m stats.bench.startup             # time everything, and fail if anything got slower.
+
+    Along with the time, I list the heavy dependencies each way ended up importing, which should
+    only be the ones it needs, and `graphs` reports how much memory each of 50,000 graphs takes
+    once it's been made. Baselines and `--threshold` work like they do for bench.micro, and
+    are kept in a file of their own.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from optparse import OptionParser
+from .micro import _load, _save, compare
+import subprocess
+import platform
+import json
+import sys
+import os
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup.json')
+
+# Imported when they're needed, so only some of the scenarios should pay for them.
+HEAVY = ('flask', 'jinja2', 'werkzeug', 'MySQLdb', 'pymysql', 'pkg_resources', 'twisted.web.client')
+
+# name -> (what it is, the python that does it)
+scenarios = [
+    ('import', 'import stats', 'import stats'),
+    ('create_databases', 'a Stats with every template loaded, which is what create_databases needs',
+        'import stats\n'
+        'from stats.templates import load_template, template_index\n'
+        's = stats.Stats("startup")\n'
+        'for name in template_index(): load_template(name)\n'),
+    ('web', 'a Stats with its web front end made',
+        'import stats\n'
+        's = stats.Stats("startup")\n'
+        's.flask_app._create_app()\n'),
+    ('graphs', '50,000 graphs made and started without polling, reports the memory each one takes',
+        'import stats, resource, gc\n'
+        's = stats.Stats("startup")\n'
+        'mix = ["nginx", "memcached", "mysql"]\n'
+        's.config.update(database_path = "/nonexistent", image_path = "/nonexistent", graphs = [\n'
+        '    dict(id = "graph%i" % i, template = mix[i % 3], config = dict(host = "10.0.%i.%i" % (i // 256 % 256, i % 256)))\n'
+        '    for i in xrange(50000)])\n'
+        's.validate_config()\n'
+        'for graph in s.config["graphs"][:3]: s.template_runner.make_template(graph)\n'
+        'gc.collect(); before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+        's.template_runner.run(poll = False)\n'
+        'gc.collect(); extra["bytes/graph"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * 1024 // 50000\n'),
+]
+
+_measure = '''
+import time, sys, json
+extra = {}
+t = time.time()
+%s
+seconds = time.time() - t
+from stats.metrics import import_times
+json.dump(dict(seconds = seconds, import_times = import_times, heavy = [name for name in %r if name in sys.modules], extra = extra), sys.stdout)
+'''
+
+def measure(code):
+    """ Runs code in a fresh python, returns {seconds, import_times, heavy, extra}, extra being whatever else the code reported. """
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+    output = subprocess.check_output([sys.executable, '-c', _measure % (code, HEAVY)], env = env)
+    return json.loads(output)
+
+def run(names = None, repeat = 5):
+    """ Returns ({name: fastest seconds}, {name: what the fastest run reported}) of the scenarios named, or all of them. """
+    results, reports = {}, {}
+    for name, description, code in scenarios:
+        if names and name not in names:
+            continue
+        reports[name] = min([measure(code) for i in xrange(repeat)], key = lambda report: report['seconds'])
+        results[name] = reports[name]['seconds']
+    return results, reports
+
+def main(argv = None):
+    parser = OptionParser(usage = '%prog [options] [scenario ...]')
+    parser.add_option('--baseline', default = BASELINE, help = 'where baselines are kept [%default]')
+    parser.add_option('--save', action = 'store_true', default = False, help = 'save these timings as the new baseline')
+    parser.add_option('--threshold', type = 'float', default = 0.2, help = 'fail when a scenario is this much slower than its baseline [%default]')
+    parser.add_option('--repeat', type = 'int', default = 5, help = 'times to run each scenario, the fastest is kept [%default]')
+    parser.add_option('--force', action = 'store_true', default = False, help = 'compare against a baseline saved on another host')
+    parser.add_option('--list', action = 'store_true', default = False, help = 'list the scenarios and exit')
+    options, names = parser.parse_args(argv)
+
+    if options.list:
+        for name, description, code in scenarios:
+            print '%-20s %s' % (name, description)
+        return 0
+
+    unknown = set(names) - set([name for name, description, code in scenarios])
+    if unknown:
+        parser.error('no such scenario: %s' % ', '.join(sorted(unknown)))
+
+    results, reports = run(names, options.repeat)
+    saved = _load(options.baseline)
+    baseline = {}
+    if saved and (saved['host'] == platform.node() or options.force):
+        baseline = saved['results']
+    elif saved:
+        print >> sys.stderr, 'Baseline %s was saved on %s, not comparing against it (--force to anyway).' % (options.baseline, saved['host'])
+
+    rows = compare(results, baseline, options.threshold)
+    print '%-20s %12s %12s %8s  %s' % ('scenario', 'msec', 'baseline', 'change', 'imported')
+    for name, seconds, before, ratio, failed in rows:
+        report = reports[name]
+        imported = ['%s %.0fms' % (module, t * 1000) for module, t in sorted(report['import_times'].items())]
+        imported += ['%s %s' % item for item in sorted(report['extra'].items())]
+        print '%-20s %12.1f %12s %8s  %s%s' % (
+            name, seconds * 1e3,
+            '-' if before is None else '%.1f' % (before * 1e3),
+            '-' if ratio is None else '%+.0f%%' % ((ratio - 1) * 100),
+            ', '.join(imported + report['heavy']),
+            '  SLOWER' if failed else ''
+        )
+
+    if options.save:
+        if names:
+            # Keep the baselines of the scenarios that weren't run this time.
+            results = dict(baseline, **results)
+        _save(options.baseline, results)
+        print 'Saved baseline to %s' % options.baseline
+        return 0
+
+    failed = [name for name, seconds, before, ratio, failed in rows if failed]
+    if failed:
+        print >> sys.stderr, '%i scenario(s) got more than %i%% slower: %s' % (len(failed), options.threshold * 100, ', '.join(failed))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+    prickle.cluster
+    ~~~~~~~~~~~~~~~
+
+    I let several prickle nodes share one config file. Every node knows every graph, but each graph
+    id is owned by one node, picked off a consistent hash ring of the nodes that are up, and only its
+    owner polls it and draws it. Any node's web front end serves any page, and proxies the images on
+    it to the nodes that own them.
+
+    Nodes ask each other how they're doing every `cluster_heartbeat` seconds, at /cluster on their
+    web front ends. A node that hasn't answered for `cluster_timeout` seconds is taken off the ring,
+    and its graphs move to the nodes that are left, a node that starts answering again gets them back.
+    The answers also carry when the node last drew its graphs, so everyone's graph urls change when
+    the images do. Nodes start out assuming everyone is up, so a cluster that's restarted all at once
+    doesn't poll everything everywhere until it has heard from everyone. With `poll_workers`, only
+    the front end runs the heartbeat, and sends its pollers the nodes that are up when they change.
+
+    The databases of a graph whose owner changes are wherever its old owner wrote them, so either
+    put `database_path` and `image_path` on storage every node can see, or expect its history to
+    start over on the new owner. For several nodes on one box, give each its own port:
+
+        cluster_nodes = dict(a = '127.0.0.1:8081', b = '127.0.0.1:8082', c = '127.0.0.1:8083')
+
+    and start each with `stats.run(cluster_node = 'a', httpd_port = 8081)` and so on.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.task import LoopingCall
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.error import Error
+from twisted.python import log
+from bisect import bisect
+from struct import unpack
+import hashlib
+import logging
+import urllib
+import json
+import time
+
+class HashRing(object):
+    """ I map keys onto nodes, so that adding or taking away a node only moves the keys that it gets or had. """
+
+    def __init__(self, nodes, replicas = 64):
+        self.nodes = frozenset(nodes)
+        self.replicas = replicas
+        points = sorted([(self._hash('%s:%i' % (node, i)), node) for node in self.nodes for i in xrange(replicas)])
+        self._keys = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    @staticmethod
+    def _hash(key):
+        return unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+    def owner(self, key):
+        """ The node that owns key, or None if there are no nodes. """
+        if not self._keys:
+            return None
+        return self._nodes[bisect(self._keys, self._hash(key)) % len(self._keys)]
+
+class Cluster(object):
+    """
+        I keep track of which nodes of the cluster are up, and so which graphs are mine. Whoever wants to
+        know when that changes can add a function to `listeners`, it's called with no arguments.
+    """
+
+    def __init__(self, stats):
+        config = stats.config
+        self.stats = stats
+        self.name = config['cluster_node']
+        self.nodes = dict(config['cluster_nodes'])
+        self.heartbeat = config['cluster_heartbeat']
+        self.timeout = config['cluster_timeout']
+        self.listeners = []
+        self.lastSeen = dict((node, time.time()) for node in self.nodes)
+        self.since = dict((node, 0) for node in self.nodes) # their clock, the last time they told us what they drew.
+        self.alive = frozenset(self.nodes)
+        self.ring = HashRing(self.alive)
+        self.changes = 0
+        self.agent = Agent(reactor, connectTimeout = self.heartbeat, pool = HTTPConnectionPool(reactor))
+        self.loopingCall = LoopingCall(self.beat)
+
+    def __repr__(self):
+        return '<cluster.Cluster name=%r, alive=%r, changes=%i>' % (self.name, sorted(self.alive), self.changes)
+
+    def start(self):
+        if not self.loopingCall.running:
+            self.loopingCall.start(self.heartbeat, now = False)
+
+    def stop(self):
+        if self.loopingCall.running:
+            self.loopingCall.stop()
+
+    def owner(self, id):
+        return self.ring.owner(id)
+
+    def owns(self, id):
+        return self.ring.owner(id) == self.name
+
+    def address(self, node):
+        """ (host, port) of node's web front end. """
+        host, port = self.nodes[node].rsplit(':', 1)
+        return host, int(port)
+
+    def beat(self):
+        d = DeferredList([self._ping(node) for node in self.nodes if node != self.name])
+        d.addCallback(lambda res: self._check())
+        return d
+
+    def _ping(self, node):
+        url = 'http://%s/cluster?%s' % (self.nodes[node], urllib.urlencode(dict(node = self.name, since = self.since[node])))
+        d = self.agent.request('GET', url)
+        d.addTimeout(self.heartbeat, reactor)
+        d.addCallback(self._response)
+        d.addCallbacks(self._heard, self._notHeard, callbackArgs = (node, ), errbackArgs = (node, ))
+        return d
+
+    def _response(self, response):
+        d = readBody(response)
+        if response.code != 200:
+            def error(body):
+                raise Error(response.code, response.phrase, body)
+            d.addCallback(error)
+        return d
+
+    def _heard(self, body, node):
+        answer = json.loads(body)
+        self.lastSeen[node] = time.time()
+        self.since[node] = answer['now']
+
+        drawn = self.stats.last_draw_timestamp
+        for filename, timestamp in answer['drawn'].iteritems():
+            if timestamp > drawn.get(filename, -1):
+                drawn[str(filename)] = timestamp
+
+    def _notHeard(self, err, node):
+        if node in self.alive:
+            log.msg('Node %r did not answer its heartbeat: %s' % (node, err.getErrorMessage()), logLevel = logging.WARNING)
+
+    def _check(self):
+        now = time.time()
+        self.setAlive([node for node in self.nodes if node == self.name or now - self.lastSeen[node] < self.timeout])
+
+    def setAlive(self, alive):
+        """ Take `alive` as the nodes that are up, and tell the listeners if that changed. Pollers are told by their front end. """
+        alive = frozenset(alive)
+        if alive == self.alive:
+            return
+
+        log.msg('Cluster nodes up changed from %r to %r, moving graphs.' % (sorted(self.alive), sorted(alive)), logLevel = logging.WARNING)
+        self.alive = alive
+        self.ring = HashRing(alive)
+        self.changes += 1
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception:
+                log.err()
+
+    def drawn(self, since = 0):
+        """ What I've drawn of the graphs I own since `since`, the other nodes ask for this with every heartbeat. """
+        return dict(
+            (filename, timestamp) for filename, timestamp in self.stats.last_draw_timestamp.iteritems()
+            if timestamp > since and self.owns(self.stats.placement(filename.rsplit('-', 1)[0]))
+        )
+
+    def status(self):
+        now = time.time()
+        return dict(
+            node = self.name,
+            alive = sorted(self.alive),
+            changes = self.changes,
+            last_seen = dict((node, now - seen) for node, seen in self.lastSeen.iteritems() if node != self.name)
+        )
+
+__all__ = ['Cluster', 'HashRing']
+
+import unittest
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.keys = ['graph%i' % i for i in xrange(2000)]
+
+    def test_stable(self):
+        self.assertEqual(
+            [HashRing(['a', 'b', 'c']).owner(key) for key in self.keys],
+            [HashRing(['c', 'b', 'a']).owner(key) for key in self.keys]
+        )
+
+    def test_leaving_only_moves_its_keys(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b'])
+        for key in self.keys:
+            if before.owner(key) != 'c':
+                self.assertEqual(before.owner(key), after.owner(key))
+
+    def test_balanced(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = {}
+        for key in self.keys:
+            counts[ring.owner(key)] = counts.get(ring.owner(key), 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c', 'd'])
+        for count in counts.values():
+            self.assertTrue(250 < count < 750, counts)
+
+    def test_empty(self):
+        self.assertEqual(HashRing([]).owner('graph1'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+"""
+    prickle.metrics
+    ~~~~~~~~~~~~~~~
+
+    I keep count of how prickle itself is doing, and write it out in the prometheus
+    text exposition format for /metrics.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+import proc_rrd
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, _escape(value)) for name, value in labels])
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Histogram(object):
+    """ I count observations into buckets, separately for every combination of label values. """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        self.series = {} # label values -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple([labels[name] for name in self.labelNames])
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def total(self, **labels):
+        """ Returns (count, sum) of the observations whose labels match the ones given. """
+        count = total = 0
+        for key, (counts, sum, n) in self.series.iteritems():
+            if all([key[self.labelNames.index(name)] == value for name, value in labels.iteritems()]):
+                count += n
+                total += sum
+        return count, total
+
+    def samples(self):
+        for key, (counts, sum, count) in sorted(self.series.items()):
+            labels = zip(self.labelNames, key)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '_bucket', labels + [('le', _number(bound))], cumulative
+            yield '_sum', labels, sum
+            yield '_count', labels, count
+
+class Collected(object):
+    """ A metric whose samples are worked out by calling `collect` every time they're asked for. """
+
+    def __init__(self, name, type, help, collect):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.collect = collect
+
+    def samples(self):
+        return self.collect()
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """ Add metric, replacing the one with the same name if there is one. """
+        self.metrics = [m for m in self.metrics if m.name != metric.name] + [metric]
+        return metric
+
+    def histogram(self, name, help, labels = (), **kwargs):
+        return self.register(Histogram(name, help, labels, **kwargs))
+
+    def collected(self, name, type, help, collect):
+        """ `collect` returns an iterable of (suffix, [(label, value), ...], value). """
+        return self.register(Collected(name, type, help, collect))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix, _labels(labels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# How long the modules prickle imports only once it needs them took to import, module -> seconds.
+import_times = {}
+
+poll_duration = registry.histogram(
+    'prickle_poll_duration_seconds', 'How long polls took, from asking for the data to updating the database.',
+    ('template', 'result'), buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+)
+
+render_duration = registry.histogram(
+    'prickle_render_duration_seconds', "How long it took to draw one graph's images for a period.",
+    ('period', ), buckets = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+def _lanes(field):
+    return lambda: [('', [('lane', name)], lane[field]) for name, lane in sorted(proc_rrd.queue_stats().items())]
+
+def _waits():
+    for name, lane in sorted(proc_rrd.queue_stats().items()):
+        yield '_sum', [('lane', name)], lane['totalWait']
+        yield '_count', [('lane', name)], lane['started']
+
+registry.collected('prickle_rrdtool_queued', 'gauge', 'rrdtool commands waiting for their turn.', _lanes('queued'))
+registry.collected('prickle_rrdtool_active', 'gauge', 'rrdtool commands running.', _lanes('active'))
+registry.collected('prickle_rrdtool_shed_total', 'counter', 'rrdtool commands dropped because too many were waiting.', _lanes('shed'))
+registry.collected('prickle_rrdtool_wait_seconds', 'summary', 'How long rrdtool commands waited for their turn.', _waits)
+registry.collected('prickle_import_seconds', 'gauge', 'How long prickle, and the parts of it imported as needed, took to import.',
+    lambda: [('', [('module', name)], seconds) for name, seconds in sorted(import_times.items())])
+
+def threadpool_stats(pool):
+    """ How busy a threadpool is: (threads working, threads idle, jobs waiting for a thread, most threads it'll start). """
+    queue = getattr(pool, 'q', None) or pool._queue
+    return len(pool.working), len(pool.waiters), queue.qsize(), pool.max
+
+def watch(stats):
+    """ Collect metrics from the parts of a Stats instance that keep their own books. """
+    def threadpool():
+        working, idle, backlog, max = threadpool_stats(stats.wsgi_threadpool)
+        yield '', [('state', 'working')], working
+        yield '', [('state', 'idle')], idle
+        yield '', [('state', 'max')], max
+
+    def backlog():
+        yield '', [], threadpool_stats(stats.wsgi_threadpool)[2]
+
+    def scheduler():
+        scheduler = stats.template_runner.scheduler
+        yield '', [('stat', 'pending')], scheduler.pending
+        yield '', [('stat', 'last_batch')], scheduler.lastBatch
+        yield '', [('stat', 'last_lateness_seconds')], scheduler.lastLateness
+        yield '', [('stat', 'max_lateness_seconds')], scheduler.maxLateness
+
+    def templates():
+        counts = {}
+        for template in stats.active_graphs.values():
+            counts[template.template] = counts.get(template.template, 0) + 1
+        return [('', [('template', name)], count) for name, count in sorted(counts.items())]
+
+    registry.collected('prickle_wsgi_threads', 'gauge', 'Threads of the threadpool that runs the web frontend.', threadpool)
+    registry.collected('prickle_wsgi_backlog', 'gauge', 'Web requests waiting for a thread.', backlog)
+    registry.collected('prickle_scheduler', 'gauge', 'What the poll and render scheduler is up to.', scheduler)
+    registry.collected('prickle_graphs', 'gauge', 'Configured graphs, per template.', templates)
+
+__all__ = ['registry', 'poll_duration', 'render_duration', 'import_times', 'watch', 'threadpool_stats', 'Histogram', 'Registry']
@@ -0,0 +1,371 @@
+"""
+    prickle.mysqlclient
+    ~~~~~~~~~~~~~~~~~~~
+
+    Just enough of the MySQL client/server protocol to log in and run simple queries
+    on the reactor, so polling a MySQL server doesn't tie up a thread while it waits.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ClientCreator
+from twisted.internet.defer import Deferred
+from twisted.protocols.policies import TimeoutMixin
+from twisted.python import log
+from collections import deque
+from hashlib import sha1, sha256
+from struct import pack, unpack
+import logging
+
+DEFAULT_PORT = 3306
+
+CLIENT_LONG_PASSWORD = 1
+CLIENT_PROTOCOL_41 = 1 << 9
+CLIENT_TRANSACTIONS = 1 << 13
+CLIENT_SECURE_CONNECTION = 1 << 15
+CLIENT_PLUGIN_AUTH = 1 << 19
+
+CHARSET_UTF8 = 33
+MAX_PACKET = 0xffffff
+
+COM_QUIT = '\x01'
+COM_QUERY = '\x03'
+
+class MySQLError(Exception):
+    """ The server sent us an error packet, or we couldn't talk to it. """
+
+    def __init__(self, errno, message):
+        Exception.__init__(self, errno, message)
+        self.errno = errno
+        self.message = message
+
+    def __str__(self):
+        return '(%i) %s' % (self.errno, self.message)
+
+def _xor(a, b):
+    return ''.join([chr(ord(x) ^ ord(y)) for x, y in zip(a, b)])
+
+def scramble_native(password, salt):
+    """ mysql_native_password: SHA1(password) XOR SHA1(salt + SHA1(SHA1(password))) """
+    if not password:
+        return ''
+    stage1 = sha1(password).digest()
+    return _xor(stage1, sha1(salt + sha1(stage1).digest()).digest())
+
+def scramble_sha2(password, salt):
+    """ caching_sha2_password: SHA256(password) XOR SHA256(SHA256(SHA256(password)) + salt) """
+    if not password:
+        return ''
+    stage1 = sha256(password).digest()
+    return _xor(stage1, sha256(sha256(stage1).digest() + salt).digest())
+
+_scramblers = {
+    'mysql_native_password': scramble_native,
+    'caching_sha2_password': scramble_sha2,
+}
+
+def _lenencInt(data, pos):
+    """ Reads a length encoded integer at pos, returns (value, next pos), value is None for NULL. """
+    first = ord(data[pos])
+    if first < 0xfb:
+        return first, pos + 1
+    if first == 0xfb:
+        return None, pos + 1
+    if first == 0xfc:
+        return unpack('<H', data[pos + 1:pos + 3])[0], pos + 3
+    if first == 0xfd:
+        return unpack('<I', data[pos + 1:pos + 4] + '\0')[0], pos + 4
+    return unpack('<Q', data[pos + 1:pos + 9])[0], pos + 9
+
+def _lenencStr(data, pos):
+    length, pos = _lenencInt(data, pos)
+    if length is None:
+        return None, pos
+    return data[pos:pos + length], pos + length
+
+def _error(packet):
+    """ Turns an ERR packet into a MySQLError. """
+    errno = unpack('<H', packet[1:3])[0]
+    message = packet[3:]
+    if message.startswith('#'):
+        # The SQL state comes first, we don't need it.
+        message = message[6:]
+    return MySQLError(errno, message)
+
+def _isEOF(packet):
+    return packet[:1] == '\xfe' and len(packet) < 9
+
+class MySQLProtocol(Protocol, TimeoutMixin):
+    """
+        I log in to a MySQL server, and then run queries one at a time, firing each query's deferred with
+        the rows of its result as tuples of strings (or None for NULL). `ready` fires with me once I've logged in.
+
+        If the server takes longer than `timeOut` seconds to answer, I drop the connection.
+    """
+
+    def __init__(self, user, password, timeOut = 60):
+        self.user = user
+        self.password = password or ''
+        self.persistentTimeOut = self.timeOut = timeOut
+        self.ready = Deferred()
+        self.serverVersion = None
+        self._buffer = ''
+        self._partial = []
+        self._seq = 0
+        self._queue = deque()
+        self._current = None
+        self._rows = None
+        self._handler = self._handshake
+
+    def connectionMade(self):
+        self.setTimeout(self.persistentTimeOut)
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        self._buffer += data
+        while len(self._buffer) >= 4:
+            length = unpack('<I', self._buffer[:3] + '\0')[0]
+            if len(self._buffer) < length + 4:
+                return
+
+            self._seq = ord(self._buffer[3])
+            packet, self._buffer = self._buffer[4:length + 4], self._buffer[length + 4:]
+            if length == MAX_PACKET:
+                # More of this packet follows in the next one.
+                self._partial.append(packet)
+                continue
+
+            if self._partial:
+                packet = ''.join(self._partial) + packet
+                self._partial = []
+
+            self._handler(packet)
+
+    def _send(self, payload):
+        self._seq = (self._seq + 1) & 0xff
+        self.transport.write(pack('<I', len(payload))[:3] + chr(self._seq) + payload)
+
+    def _command(self, command, payload = ''):
+        self._seq = -1
+        self._send(command + payload)
+
+    def _handshake(self, packet):
+        if packet[:1] == '\xff':
+            return self._loginFailed(_error(packet))
+
+        end = packet.index('\0', 1)
+        self.serverVersion = packet[1:end]
+        pos = end + 5 # skip the connection id.
+        salt = packet[pos:pos + 8]
+        pos += 9
+        capabilities = unpack('<H', packet[pos:pos + 2])[0]
+        pos += 2
+        plugin = 'mysql_native_password'
+
+        if len(packet) > pos:
+            # character set and status flags, then the upper half of the capabilities.
+            capabilities |= unpack('<H', packet[pos + 3:pos + 5])[0] << 16
+            saltLength = ord(packet[pos + 5])
+            pos += 16
+            if capabilities & CLIENT_SECURE_CONNECTION:
+                length = max(13, saltLength - 8)
+                salt += packet[pos:pos + length - 1] # the last byte is a NUL.
+                pos += length
+            if capabilities & CLIENT_PLUGIN_AUTH:
+                plugin = packet[pos:].split('\0', 1)[0]
+
+        if not capabilities & CLIENT_PROTOCOL_41:
+            return self._loginFailed(MySQLError(0, 'Server %s is too old, it does not speak protocol 4.1' % self.serverVersion))
+
+        if plugin not in _scramblers:
+            # The server will ask us to switch to whatever the account really uses.
+            plugin = 'mysql_native_password'
+
+        flags = CLIENT_LONG_PASSWORD | CLIENT_PROTOCOL_41 | CLIENT_TRANSACTIONS | CLIENT_SECURE_CONNECTION | (capabilities & CLIENT_PLUGIN_AUTH)
+        auth = _scramblers[plugin](self.password, salt)
+        payload = pack('<IIB', flags, MAX_PACKET, CHARSET_UTF8) + '\0' * 23 + self.user + '\0' + chr(len(auth)) + auth
+        if flags & CLIENT_PLUGIN_AUTH:
+            payload += plugin + '\0'
+
+        self._handler = self._authResult
+        self._send(payload)
+
+    def _authResult(self, packet):
+        kind = packet[:1]
+        if kind == '\x00':
+            self._handler = self._idle
+            self.ready.callback(self)
+            self._sendNext()
+
+        elif kind == '\xff':
+            self._loginFailed(_error(packet))
+
+        elif kind == '\xfe':
+            # The server wants us to use another authentication method.
+            plugin, _, salt = packet[1:].partition('\0')
+            if plugin not in _scramblers:
+                return self._loginFailed(MySQLError(0, 'Unsupported authentication method %r' % plugin))
+            self._send(_scramblers[plugin](self.password, salt.rstrip('\0')))
+
+        elif kind == '\x01':
+            # caching_sha2_password telling us how it went, 3 means our scramble was good and an OK follows.
+            if packet[1:2] == '\x04':
+                self._loginFailed(MySQLError(0,
+                    'The server wants the full caching_sha2_password exchange, which needs a secure connection; '
+                    'log in once with another client so the server caches the password, or use the mysqldb driver'
+                ))
+
+    def _loginFailed(self, err):
+        self._handler = self._idle
+        self.ready.errback(err)
+        self.transport.loseConnection()
+
+    def query(self, sql):
+        """ Runs sql, returns a deferred that fires with the rows it returns. """
+        d = Deferred()
+        self._queue.append((sql, d))
+        if self._current is None and self.ready.called:
+            self._sendNext()
+        return d
+
+    def _sendNext(self):
+        if not self._queue:
+            # Don't time out an idle connection, we keep them around on purpose.
+            self.setTimeout(None)
+            return
+
+        sql, self._current = self._queue.popleft()
+        self._rows = []
+        self._handler = self._resultHeader
+        self.setTimeout(self.persistentTimeOut)
+        self._command(COM_QUERY, sql)
+
+    def _resultHeader(self, packet):
+        kind = packet[:1]
+        if kind == '\xff':
+            self._done(_error(packet))
+        elif kind == '\x00':
+            # An OK, the query didn't return a result set.
+            self._done([])
+        else:
+            self._handler = self._columnDefinition
+
+    def _columnDefinition(self, packet):
+        # We don't care what the columns are called.
+        if _isEOF(packet):
+            self._handler = self._row
+
+    def _row(self, packet):
+        if _isEOF(packet):
+            return self._done(self._rows)
+        if packet[:1] == '\xff':
+            return self._done(_error(packet))
+
+        row = []
+        pos = 0
+        while pos < len(packet):
+            value, pos = _lenencStr(packet, pos)
+            row.append(value)
+        self._rows.append(tuple(row))
+
+    def _done(self, result):
+        d, self._current = self._current, None
+        self._rows = None
+        self._handler = self._idle
+        self._sendNext()
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _idle(self, packet):
+        log.msg('MySQL server sent us a packet we did not ask for: %r' % packet[:64], logLevel = logging.ERROR)
+
+    def quit(self):
+        """ Say goodbye to the server and hang up. """
+        if self.transport.connected:
+            self._command(COM_QUIT)
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        err = MySQLError(2013, 'Lost connection to MySQL server: %s' % reason.getErrorMessage())
+        if not self.ready.called:
+            self.ready.errback(err)
+
+        pending = [d for sql, d in self._queue]
+        if self._current is not None:
+            pending.insert(0, self._current)
+        self._queue.clear()
+        self._current = None
+        for d in pending:
+            d.errback(err)
+
+def connect(host, port = DEFAULT_PORT, user = '', password = '', timeout = 30):
+    """ Connects and logs in to a MySQL server, returns a deferred that fires with a `MySQLProtocol` ready for queries. """
+    d = ClientCreator(reactor, MySQLProtocol, user, password, timeout).connectTCP(host, port, timeout = timeout)
+    return d.addCallback(lambda proto: proto.ready)
+
+__all__ = ['connect', 'MySQLProtocol', 'MySQLError', 'scramble_native', 'scramble_sha2']
+
+import unittest
+
+class TestProtocol(unittest.TestCase):
+    salt = '12345678abcdefghijkl'
+
+    def packet(self, seq, payload):
+        return pack('<I', len(payload))[:3] + chr(seq) + payload
+
+    def setUp(self):
+        from twisted.test.proto_helpers import StringTransport
+        self.proto = MySQLProtocol('prickle', 'secret', timeOut = None)
+        self.proto.makeConnection(StringTransport())
+        self.transport = self.proto.transport
+
+    def login(self):
+        handshake = (
+            '\x0a' + '5.5.0\0' + pack('<I', 1) + self.salt[:8] + '\0' +
+            pack('<HBHH', 0xf7ff, CHARSET_UTF8, 2, (CLIENT_PLUGIN_AUTH | CLIENT_SECURE_CONNECTION) >> 16) +
+            chr(21) + '\0' * 10 + self.salt[8:] + '\0' + 'mysql_native_password\0'
+        )
+        self.proto.dataReceived(self.packet(0, handshake))
+        sent = self.transport.value()
+        self.transport.clear()
+        self.proto.dataReceived(self.packet(2, '\x00\x00\x00\x02\x00\x00\x00'))
+        return sent
+
+    def test_scramble(self):
+        self.assertEqual(scramble_native('', self.salt), '')
+        self.assertEqual(scramble_native('secret', self.salt).encode('hex'), '4f1522d6eb54737eda413b3e219ca6caebe3df2c')
+
+    def test_login(self):
+        sent = self.login()
+        self.assertEqual(sent[3], '\x01')
+        self.assertTrue(sent[36:].startswith('prickle\0' + chr(20) + scramble_native('secret', self.salt) + 'mysql_native_password\0'))
+        self.assertTrue(self.proto.ready.called)
+
+    def test_query(self):
+        self.login()
+        rows = []
+        self.proto.query("SHOW GLOBAL STATUS").addCallback(rows.extend)
+        self.assertEqual(self.transport.value(), self.packet(0, COM_QUERY + 'SHOW GLOBAL STATUS'))
+
+        eof = '\xfe\x00\x00\x02\x00'
+        self.proto.dataReceived(''.join([
+            self.packet(1, '\x02'), self.packet(2, 'column'), self.packet(3, 'column'), self.packet(4, eof),
+            self.packet(5, '\x09Questions\x0242'), self.packet(6, '\x06Uptime\xfb'), self.packet(7, eof)
+        ]))
+        self.assertEqual(rows, [('Questions', '42'), ('Uptime', None)])
+
+    def test_error(self):
+        self.login()
+        errors = []
+        self.proto.query("SHOW NONSENSE").addErrback(errors.append)
+        self.proto.dataReceived(self.packet(1, '\xff' + pack('<H', 1064) + '#42000You have an error'))
+        self.assertEqual(errors[0].value.errno, 1064)
+        self.assertEqual(errors[0].value.message, 'You have an error')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,30 +1,304 @@
 from twisted.internet.utils import getProcessValue, getProcessOutput
-from util import DeferredConcurrencyLimiter
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from util import DeferredConcurrencyLimiter, LimiterQueueFull
+from rrdcached import RRDCachedClient
 from twisted.python.procutils import which
+from collections import deque
+import logging
+import time
+import re
 
 _limit = DeferredConcurrencyLimiter(10) # maximum ammounts of processes to run concurrently, 10 seems fine...
+# Updates have to land before the heartbeat runs out, graphs can wait, and never get more than 8 of the 10 processes.
+# Asking for a graph that's already waiting to be drawn just waits for that one.
+_limit.addLane('update', weight = 8)
+_limit.addLane('create', weight = 4)
+_limit.addLane('graph', weight = 1, cap = 8, maxQueue = 5000, merge = True)
 
 try:
     _rrdpath = which('rrdtool')[0]
 except IndexError:
     raise RuntimeError("rrdtool could not be found in $PATH, is it installed?")
-    
+
 """I've decided against using python's rrdtool, I think it leaks memory... anyways, this is a lot faster as well, as I don't need to defer to threads anymore!"""
 
-@_limit
+class RRDToolError(Exception):
+    """ rrdtool answered one of our commands with an ERROR, or went away before answering. """
+
+def _quote(arg):
+    """
+        Quote an argument so rrdtool's pipe mode line splitter gives it back to us as is.
+        rrdtool glues quoted pieces together like a shell does, but knows nothing about backslashes.
+    """
+    if '\n' in arg or '\r' in arg:
+        raise ValueError('rrdtool pipe mode can not handle newlines in arguments: %r' % arg)
+
+    if arg and not [c for c in ' \t"\'' if c in arg]:
+        return arg
+
+    return '"%s"' % arg.replace('"', '"\'"\'"')
+
+class RRDToolProcessProtocol(protocol.ProcessProtocol):
+    """
+        I talk to one long-lived `rrdtool -` process. Commands are pipelined, rrdtool answers them
+        in order with either "OK ..." or "ERROR: ...", so I just match the answers up with a queue.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.pending = deque()
+        self.output = []
+        self.buffer = ''
+        self.alive = False
+        self.commandsCompleted = 0
+        self.commandsPerSecond = 0.0
+        self._lastSampleCount = 0
+        self._lastSampleTime = time.time()
+
+    def __repr__(self):
+        return '<proc_rrd.RRDToolProcessProtocol index=%i, alive=%r, pending=%i, commandsCompleted=%i>' % (
+            self.index, self.alive, len(self.pending), self.commandsCompleted
+        )
+
+    def connectionMade(self):
+        self.alive = True
+
+    def execute(self, args):
+        """ Send a command to rrdtool, returns a deferred that fires with the output of the command. """
+        d = Deferred()
+        self.pending.append(d)
+        self.transport.write(' '.join([_quote(arg) for arg in args]) + '\n')
+        return d
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+
+        for line in lines:
+            if line.startswith('OK '):
+                self._commandDone(None)
+            elif line.startswith('ERROR:'):
+                self._commandDone(RRDToolError(line[6:].strip()))
+            else:
+                self.output.append(line)
+
+    def errReceived(self, data):
+        log.msg('rrdtool worker %i said: %s' % (self.index, data.strip()), logLevel = logging.WARNING)
+
+    def _commandDone(self, err):
+        output, self.output = self.output, []
+        self.commandsCompleted += 1
+
+        if not self.pending:
+            log.msg('rrdtool worker %i answered a command we never sent!' % self.index, logLevel = logging.ERROR)
+            return
+
+        d = self.pending.popleft()
+        if err is not None:
+            d.errback(err)
+        else:
+            d.callback('\n'.join(output))
+
+    def sampleRate(self, now):
+        """ Work out how many commands per second I have completed since the last time I was asked. """
+        elapsed = now - self._lastSampleTime
+        if elapsed > 0:
+            self.commandsPerSecond = (self.commandsCompleted - self._lastSampleCount) / elapsed
+        self._lastSampleCount = self.commandsCompleted
+        self._lastSampleTime = now
+
+    def processEnded(self, reason):
+        self.alive = False
+        pending, self.pending = self.pending, deque()
+        for d in pending:
+            d.errback(RRDToolError('rrdtool worker %i exited before answering' % self.index))
+
+        self.pool._workerEnded(self, reason)
+
+class RRDToolPool(object):
+    """
+        I keep `size` long-lived `rrdtool -` processes around and route commands to the one with the
+        least amount of work queued, this saves us a fork/exec per create, update and graph.
+
+        Workers that die get restarted after `restartDelay` seconds.
+    """
+    restartDelay = 1
+    rateInterval = 60
+
+    def __init__(self, size, rrdpath = None):
+        if size < 1:
+            raise ValueError("size must be > 0")
+
+        self.size = size
+        self.rrdpath = rrdpath or _rrdpath
+        self.workers = [None] * size
+        self.running = False
+        self.restarts = 0
+        self._rateCall = LoopingCall(self._sampleRates)
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        for index in xrange(self.size):
+            self._spawn(index)
+
+        self._rateCall.start(self.rateInterval, now = False)
+        log.msg('Started %i rrdtool workers [%s]' % (self.size, self.rrdpath), logLevel = logging.INFO)
+
+    def stop(self):
+        """ Stop the pool, the workers will exit once they see EOF on their stdin. """
+        if not self.running:
+            return
+
+        self.running = False
+        if self._rateCall.running:
+            self._rateCall.stop()
+
+        for worker in self.workers:
+            if worker is not None and worker.alive:
+                worker.transport.closeStdin()
+
+    def _spawn(self, index):
+        worker = self.workers[index] = RRDToolProcessProtocol(self, index)
+        reactor.spawnProcess(worker, self.rrdpath, args = [self.rrdpath, '-'])
+
+    def _workerEnded(self, worker, reason):
+        if not self.running or self.workers[worker.index] is not worker:
+            return
+
+        self.restarts += 1
+        log.msg('rrdtool worker %i died (%s), restarting it in %is' % (worker.index, reason.getErrorMessage(), self.restartDelay), logLevel = logging.ERROR)
+        reactor.callLater(self.restartDelay, self._restart, worker.index)
+
+    def _restart(self, index):
+        if self.running:
+            self._spawn(index)
+
+    def _sampleRates(self):
+        now = time.time()
+        for worker in self.workers:
+            if worker is not None:
+                worker.sampleRate(now)
+
+        log.msg('rrdtool workers commands/sec: %s' % ', '.join([
+            '%i=%.2f' % (worker.index, worker.commandsPerSecond) for worker in self.workers if worker is not None
+        ]), logLevel = logging.INFO)
+
+    def execute(self, args):
+        """ Run a command on the least busy worker, returns a deferred that fires with rrdtool's output. """
+        workers = [worker for worker in self.workers if worker is not None and worker.alive]
+        if not workers:
+            return fail(RRDToolError('No rrdtool workers are running'))
+
+        return min(workers, key = lambda worker: len(worker.pending)).execute(args)
+
+    def stats(self):
+        """ Returns a list of dicts describing each worker. """
+        return [dict(
+            index = worker.index,
+            pid = worker.transport.pid if worker.alive else None,
+            alive = worker.alive,
+            pending = len(worker.pending),
+            commands = worker.commandsCompleted,
+            commands_per_second = worker.commandsPerSecond
+        ) for worker in self.workers if worker is not None]
+
+_pool = None
+
+def start_pool(size, rrdpath = None):
+    """
+        Route all commands through a pool of `size` persistent rrdtool processes from now on.
+        Until the reactor is running, commands will still be run by spawning rrdtool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = RRDToolPool(size, rrdpath)
+        reactor.callWhenRunning(_pool.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', _pool.stop)
+
+    return _pool
+
+def pool_stats():
+    """ Returns the stats of the worker pool, or an empty list if we're not using one. """
+    if _pool is None:
+        return []
+    return _pool.stats()
+
+_cached = None
+
+def start_cached(address):
+    """
+        Send updates to the rrdcached daemon at `address` from now on, graphs will flush
+        the files they read from before they get drawn. If we lose the daemon, updates
+        wait for us to get it back, see RRDCachedClient, and only go straight to rrdtool
+        once too many are waiting.
+    """
+    global _cached
+    if _cached is None:
+        _cached = RRDCachedClient(address)
+        reactor.callWhenRunning(_cached.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', _cached.stop)
+
+    return _cached
+
+def flush(*filenames):
+    """ Make sure anything rrdcached is holding for these files is on disk, before reading them ourselves. """
+    if _cached is not None and _cached.connected:
+        return _cached.flush(*filenames)
+    return succeed(None)
+
+_defRegexp = re.compile(r'^DEF:[^=]+=((?:\\.|[^:])+):')
+
+def _sourceFiles(params):
+    """ Returns the rrd files that the DEFs in a graph command read from. """
+    files = set()
+    for param in params:
+        match = _defRegexp.match(param)
+        if match:
+            files.add(match.group(1).replace('\\:', ':'))
+    return files
+
+def _run(args, spawn):
+    """ Run a command on the worker pool if it's running, otherwise spawn an rrdtool process to run it. """
+    if _pool is not None and _pool.running:
+        d = _pool.execute(args)
+        if spawn is getProcessValue:
+            # Keep the same result as getProcessValue would have given us.
+            d.addCallback(lambda output: 0)
+        return d
+
+    return spawn(_rrdpath, args = args)
+
+def queue_stats():
+    """ How long rrdtool commands have been waiting for their turn, per kind of command. """
+    return _limit.stats()
+
+@_limit.lane('create')
 def create(filename, *params):
     args = ['create', filename] + list(params)
-    return getProcessOutput(_rrdpath, args = args)
-    
+    return _run(args, getProcessOutput)
+
 
-@_limit
+@_limit.lane('update')
 def update(filename, *params):
+    if _cached is not None and _cached.accepting:
+        return _cached.update(filename, *params)
+
     args = ['update', filename] + list(params)
-    return getProcessValue(_rrdpath, args = args)
+    return _run(args, getProcessValue)
 
-@_limit
+@_limit.lane('graph')
 def graph(filename, *params):
     args = ['graph', filename] + list(params)
-    return getProcessValue(_rrdpath, args = args)
-    
-__all__ = ['create', 'update', 'graph']
\ No newline at end of file
+    if _cached is not None and _cached.connected:
+        return _cached.flush(*_sourceFiles(params)).addCallback(lambda res: _run(args, getProcessValue))
+
+    return _run(args, getProcessValue)
+
+__all__ = ['create', 'update', 'graph', 'start_pool', 'pool_stats', 'queue_stats', 'start_cached', 'flush', 'RRDToolPool', 'RRDToolError', 'LimiterQueueFull']
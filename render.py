@@ -0,0 +1,256 @@
+"""
+    prickle.render
+    ~~~~~~~~~~~~~~
+
+    I draw graphs in processes of their own, so a storm of renders doesn't hold up polling.
+
+    With `render_workers` set, the TemplateRunner listens on a unix socket and starts that many
+    render workers, which connect to it. Graphs to draw are queued up here, and handed to the
+    workers over AMP, at most `render_worker_concurrency` at a time each. A worker answers once
+    the graph is drawn, so the template that asked for it knows when to bump its timestamp in
+    `last_draw_timestamp`, same as if it had drawn it itself.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor, protocol
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.protocols import amp
+from twisted.python import log
+from util import DeferredConcurrencyLimiter, LimiterQueueFull
+import proc_rrd as rrdtool
+import logging
+import tempfile
+import time
+import sys
+import os
+
+class RenderError(Exception):
+    """ A render worker couldn't draw a graph, or went away before it said whether it had. """
+
+class Render(amp.Command):
+    """ Draw graph `filename` of template `id` for `period`, with rrdtool graph `args`. """
+    arguments = [
+        ('id', amp.Unicode()),
+        ('period', amp.Unicode()),
+        ('filename', amp.String()),
+        ('args', amp.ListOf(amp.String()))
+    ]
+    response = []
+    errors = {RenderError: 'RENDER_ERROR', LimiterQueueFull: 'QUEUE_FULL'}
+
+class RenderWorkerProtocol(amp.AMP):
+    """ The front end's end of the connection to a render worker. """
+
+    def connectionMade(self):
+        amp.AMP.connectionMade(self)
+        self.pending = 0
+        self.rendered = 0
+        self.pool = self.factory.pool
+        self.pool._workerConnected(self)
+
+    def render(self, id, period, filename, args):
+        self.pending += 1
+        d = self.callRemote(Render, id = unicode(id), period = unicode(period), filename = filename, args = args)
+        d.addBoth(self._rendered)
+        return d
+
+    def _rendered(self, result):
+        self.pending -= 1
+        self.rendered += 1
+        return result
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.pool._workerDisconnected(self)
+
+class RenderProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.alive = False
+
+    def connectionMade(self):
+        self.alive = True
+
+    def processEnded(self, reason):
+        self.alive = False
+        self.pool._processEnded(self, reason)
+
+class RenderPool(object):
+    """
+        I start `size` render workers, and queue graphs up for them to draw. Graphs wait here until a
+        worker is free, or until one has connected, and asking for a graph that's already waiting to be
+        drawn just waits for that one. Workers that die get restarted after `restartDelay` seconds.
+    """
+    restartDelay = 1
+    maxQueue = 5000
+
+    def __init__(self, size, concurrency = 4, socketPath = None, options = ()):
+        if size < 1:
+            raise ValueError("size must be > 0")
+
+        self.size = size
+        self.concurrency = concurrency
+        self.socketPath = socketPath or os.path.join(tempfile.gettempdir(), 'prickle-%i.render.sock' % os.getpid())
+        self.options = list(options) # extra arguments for the workers, see main().
+        self.processes = [None] * size
+        self.workers = []
+        self.running = False
+        self.restarts = 0
+        self.port = None
+        self._waiting = [] # deferreds waiting for a worker to connect.
+        self._limit = DeferredConcurrencyLimiter(size * concurrency)
+        self._limit.addLane('graph', maxQueue = self.maxQueue, merge = True)
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+        factory = protocol.Factory()
+        factory.protocol = RenderWorkerProtocol
+        factory.pool = self
+        self.port = reactor.listenUNIX(self.socketPath, factory)
+
+        for index in xrange(self.size):
+            self._spawn(index)
+
+        log.msg('Started %i render workers [%s]' % (self.size, self.socketPath), logLevel = logging.INFO)
+
+    def stop(self):
+        """ Stop the pool, workers exit once they lose their connection to us. """
+        if not self.running:
+            return
+
+        self.running = False
+        for worker in self.workers:
+            worker.transport.loseConnection()
+
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(RenderError('The render workers were stopped'))
+
+    def graph(self, id, period, filename, args):
+        """ Have a worker draw graph `filename`, returns a deferred that fires once it's been drawn. """
+        return self._limit.run('graph', self._render, filename, id, period, args)
+
+    def _render(self, filename, id, period, args):
+        d = self._worker()
+        d.addCallback(lambda worker: worker.render(id, period, filename, args))
+        return d
+
+    def _worker(self):
+        """ Returns a deferred that fires with the least busy worker, once there is one. """
+        if self.workers:
+            return succeed(min(self.workers, key = lambda worker: worker.pending))
+
+        if not self.running:
+            return fail(RenderError('The render workers are not running'))
+
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def _spawn(self, index):
+        process = self.processes[index] = RenderProcessProtocol(self, index)
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+        args = [sys.executable, '-m', 'stats.render', self.socketPath, str(self.concurrency)] + self.options
+        reactor.spawnProcess(process, sys.executable, args = args, env = env, childFDs = {0: 'w', 1: 1, 2: 2})
+
+    def _processEnded(self, process, reason):
+        if not self.running or self.processes[process.index] is not process:
+            return
+
+        self.restarts += 1
+        log.msg('Render worker %i died (%s), restarting it in %is' % (process.index, reason.getErrorMessage(), self.restartDelay), logLevel = logging.ERROR)
+        reactor.callLater(self.restartDelay, self._restart, process.index)
+
+    def _restart(self, index):
+        if self.running:
+            self._spawn(index)
+
+    def _workerConnected(self, worker):
+        self.workers.append(worker)
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(worker)
+
+    def _workerDisconnected(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+    def status(self):
+        """ Returns what the workers are up to, and how long graphs have waited for them. """
+        return dict(
+            socket = self.socketPath,
+            restarts = self.restarts,
+            queue = self._limit.stats()['graph'],
+            workers = [dict(pending = worker.pending, rendered = worker.rendered) for worker in self.workers]
+        )
+
+class Renderer(amp.AMP):
+    """ A render worker's end of the connection, I draw what I'm asked to, `concurrency` graphs at a time. """
+
+    def __init__(self, concurrency):
+        amp.AMP.__init__(self)
+        self._limit = DeferredConcurrencyLimiter(concurrency)
+
+    @Render.responder
+    def render(self, id, period, filename, args):
+        t = time.time()
+        def rendered(result):
+            log.msg('Drew graph %r of %s for %s in %.3fs' % (filename, id, period, time.time() - t), logLevel = logging.DEBUG)
+            return {}
+
+        def failed(err):
+            raise RenderError(err.getErrorMessage())
+
+        d = self._limit.run('default', rrdtool.graph, filename, *args)
+        d.addCallbacks(rendered, failed)
+        return d
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        # Whoever started us is gone, or wants us gone.
+        if reactor.running:
+            reactor.stop()
+
+def main(argv = None):
+    """ Run as a render worker: python -m stats.render <socket> <concurrency> [--rrdtool-workers N] [--rrdcached ADDRESS] """
+    from optparse import OptionParser
+    parser = OptionParser(usage = '%prog socket concurrency [options]')
+    parser.add_option('--rrdtool-workers', type = 'int', default = 0)
+    parser.add_option('--rrdcached')
+    options, args = parser.parse_args(argv)
+    socketPath, concurrency = args
+
+    log.startLogging(sys.stdout)
+    if options.rrdtool_workers:
+        rrdtool.start_pool(options.rrdtool_workers)
+    if options.rrdcached:
+        rrdtool.start_cached(options.rrdcached)
+
+    def failed(err):
+        log.msg('Render worker could not connect to %s:' % socketPath, logLevel = logging.ERROR)
+        log.err(err)
+        reactor.stop()
+
+    creator = protocol.ClientCreator(reactor, Renderer, int(concurrency))
+    reactor.callWhenRunning(lambda: creator.connectUNIX(socketPath).addErrback(failed))
+    reactor.run()
+
+__all__ = ['RenderPool', 'RenderError', 'Render']
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+    prickle.rrdcached
+    ~~~~~~~~~~~~~~~~~
+
+    I speak rrdcached's line protocol, so updates can be queued in the daemon and written
+    out to disk in big sequential batches, instead of one small random write per update.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.defer import Deferred, DeferredList, fail, succeed
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+from collections import deque
+import logging
+import os.path
+import time
+
+DEFAULT_PORT = 42217
+
+class RRDCachedError(Exception):
+    """ rrdcached answered with a negative status, or we aren't connected to it. """
+
+def _escape(word):
+    """ rrdcached splits commands on spaces, but lets us escape them with a backslash. """
+    return word.replace('\\', '\\\\').replace(' ', '\\ ')
+
+class RRDCachedProtocol(LineReceiver):
+    """
+        Every answer starts with "<status> <message>", a negative status is an error,
+        a positive one tells us how many more lines belong to the answer.
+    """
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.pending = deque()
+        self._status = 0
+        self._lines = []
+        self.factory.clientConnected(self)
+
+    def command(self, *words):
+        d = Deferred()
+        self.pending.append(d)
+        self.sendLine(' '.join([_escape(word) for word in words]))
+        return d
+
+    def lineReceived(self, line):
+        if not self.pending:
+            log.msg('rrdcached sent us a line we did not ask for: %r' % line, logLevel = logging.ERROR)
+            return
+
+        if self._status:
+            self._lines.append(line)
+            if len(self._lines) == self._status:
+                lines, self._lines, self._status = self._lines, [], 0
+                self.pending.popleft().callback(lines)
+            return
+
+        status, _, message = line.partition(' ')
+        status = int(status)
+        if status < 0:
+            self.pending.popleft().errback(RRDCachedError(message))
+        elif status == 0:
+            self.pending.popleft().callback([message])
+        else:
+            self._status = status
+
+    def connectionLost(self, reason):
+        pending, self.pending = self.pending, deque()
+        for d in pending:
+            d.errback(RRDCachedError('Lost connection to rrdcached: %s' % reason.getErrorMessage()))
+
+        self.factory.clientDisconnected(self)
+
+class RRDCachedClient(ReconnectingClientFactory):
+    """
+        I hold a connection to a (local) rrdcached daemon, and keep an eye on its queue and journal.
+
+        `address` is either "unix:/path/to/socket", a path to a unix socket, or "host[:port]".
+
+        While I'm not connected, updates wait for me to get the daemon back, up to `maxBuffered` of them. They can't
+        be written straight to the files: the daemon may still hold older updates of the same files, which rrdtool
+        throws away as too old once it writes them, if newer ones got there first.
+    """
+    protocol = RRDCachedProtocol
+    maxDelay = 30
+    statsInterval = 60
+    queueWarning = 10000 # log a warning once this many files are waiting to be written.
+    maxBuffered = 100000 # updates kept while we're not connected, see `accepting`.
+
+    def __init__(self, address):
+        self.address = address
+        self.proto = None
+        self.stats = {}
+        self._buffered = deque() # (filename, values) of updates waiting for us to connect.
+        self._statsCall = LoopingCall(self.pollStats)
+
+    @property
+    def connected(self):
+        return self.proto is not None
+
+    @property
+    def accepting(self):
+        """ Do I take updates, because I'm connected, or still have room to keep them until I am again? """
+        return self.proto is not None or len(self._buffered) < self.maxBuffered
+
+    def start(self):
+        address = self.address
+        if address.startswith('unix:'):
+            reactor.connectUNIX(address[5:], self)
+        elif address.startswith('/'):
+            reactor.connectUNIX(address, self)
+        else:
+            host, _, port = address.partition(':')
+            reactor.connectTCP(host, int(port or DEFAULT_PORT), self)
+
+        self._statsCall.start(self.statsInterval, now = False)
+
+    def stop(self):
+        self.stopTrying()
+        if self._buffered:
+            log.msg('Never got rrdcached at %s back, %i updates that waited for it are lost.' % (self.address, len(self._buffered)), logLevel = logging.ERROR)
+        if self._statsCall.running:
+            self._statsCall.stop()
+        if self.proto is not None:
+            self.proto.transport.loseConnection()
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        return ReconnectingClientFactory.buildProtocol(self, addr)
+
+    def clientConnected(self, proto):
+        log.msg('Connected to rrdcached at %s' % self.address, logLevel = logging.INFO)
+        self.proto = proto
+
+        buffered, self._buffered = self._buffered, deque()
+        if buffered:
+            log.msg('Sending rrdcached the %i updates that waited for it.' % len(buffered), logLevel = logging.INFO)
+        for filename, values in buffered:
+            self.update(filename, *values).addErrback(self._bufferedError, filename)
+
+    def clientDisconnected(self, proto):
+        if self.proto is proto:
+            log.msg('Lost connection to rrdcached at %s' % self.address, logLevel = logging.ERROR)
+            self.proto = None
+
+    def command(self, *words):
+        if self.proto is None:
+            return fail(RRDCachedError('Not connected to rrdcached at %s' % self.address))
+        return self.proto.command(*words)
+
+    def update(self, filename, *values):
+        """
+            Queue values for filename in the daemon, fires with 0 like a successful `rrdtool update`. If I'm not
+            connected, they're kept until I am, with "N" made into the time they were given to me.
+        """
+        if self.proto is None:
+            now = '%i' % time.time()
+            self._buffered.append((filename, tuple([now + value[1:] if value.startswith('N:') else value for value in values])))
+            if len(self._buffered) == self.maxBuffered:
+                log.msg('%i updates are waiting for rrdcached at %s, writing the rest straight to the files, updates it '
+                    'still holds for them will be thrown away as too old.' % (self.maxBuffered, self.address), logLevel = logging.ERROR)
+            return succeed(0)
+
+        return self.command('UPDATE', os.path.abspath(filename), *values).addCallback(lambda res: 0)
+
+    def _bufferedError(self, err, filename):
+        log.msg('rrdcached failed an update of %r that waited for it: %s' % (filename, err.getErrorMessage()), logLevel = logging.WARNING)
+
+    def flush(self, *filenames):
+        """ Make the daemon write out anything it has queued for the given files. Errors are logged, not raised. """
+        return DeferredList([
+            self.command('FLUSH', os.path.abspath(filename)).addErrback(self._flushError, filename) for filename in filenames
+        ])
+
+    def _flushError(self, err, filename):
+        log.msg('rrdcached failed to flush %r: %s' % (filename, err.getErrorMessage()), logLevel = logging.WARNING)
+
+    def pollStats(self):
+        """ Ask the daemon how it's doing, and complain if it's falling behind. """
+        if self.proto is None:
+            return
+
+        return self.command('STATS').addCallbacks(self._gotStats, self._statsError)
+
+    def _gotStats(self, lines):
+        stats = {}
+        for line in lines:
+            key, _, value = line.partition(':')
+            try:
+                stats[key.strip()] = int(value)
+            except ValueError:
+                pass
+
+        self.stats = stats
+        queueLength = stats.get('QueueLength', 0)
+        log.msg('rrdcached queue length=%i, updates received=%i, journal bytes=%i, journal rotations=%i' % (
+            queueLength, stats.get('UpdatesReceived', 0), stats.get('JournalBytes', 0), stats.get('JournalRotate', 0)
+        ), logLevel = logging.INFO)
+
+        if queueLength > self.queueWarning:
+            log.msg('rrdcached has %i files waiting to be written, is the disk keeping up?' % queueLength, logLevel = logging.WARNING)
+
+        return stats
+
+    def _statsError(self, err):
+        log.msg('Failed to get stats from rrdcached: %s' % err.getErrorMessage(), logLevel = logging.ERROR)
+
+__all__ = ['RRDCachedClient', 'RRDCachedError']
@@ -0,0 +1,337 @@
+"""
+    prickle.rrdfile
+    ~~~~~~~~~~~~~~~
+
+    A read-only reader for rrd databases, I memory-map the file and decode the header,
+    data source and RRA definitions, and hand out the RRA ring buffers as views into
+    the map instead of shelling out to `rrdtool fetch`.
+
+    The file has to have been written by an rrdtool on this architecture, rrd files
+    are just C structs dumped to disk.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from collections import namedtuple
+from util import pick_rra
+import array
+import mmap
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The structs from rrd_format.h, an unival is a union of an unsigned long and a double.
+_statHead = struct.Struct('@4s5sdLLL')
+_unival = struct.Struct('@d')
+_univals = 10 * _unival.size
+_dsDef = struct.Struct('@20s20s')
+_rraDef = struct.Struct('@20sLL')
+_lastDs = 30
+_ulong = struct.Struct('@L')
+_double = struct.Struct('@d')
+_timeT = struct.Struct('@l')
+
+def _sizeof(head):
+    """ sizeof() one of the structs above followed by its unival[10], with the padding the compiler would add. """
+    return struct.calcsize('@%ds0d' % head) + _univals
+
+_statHeadSize = _sizeof(_statHead.size)
+_dsDefSize = _sizeof(_dsDef.size)
+_rraDefSize = _sizeof(_rraDef.size)
+_pdpPrepSize = _sizeof(_lastDs)
+_cdpPrepSize = _univals
+
+FLOAT_COOKIE = 8.642135E130
+NAN = float('nan')
+
+DataSource = namedtuple('DataSource', 'name type heartbeat min max')
+RRA = namedtuple('RRA', 'index cf pdp_count rows xff step cur_row offset')
+FetchResult = namedtuple('FetchResult', 'start end step names columns')
+
+class RRDFileError(Exception):
+    """ The file isn't an rrd database I can read. """
+
+def _cstring(s):
+    return s.split('\0', 1)[0]
+
+class RRDFile(object):
+    """
+        I am a memory-mapped rrd database.
+
+        >>> with RRDFile('/var/lib/prickle/web1.rrd') as rrd:
+        ...     result = rrd.fetch('AVERAGE', start = now - 3600, end = now)
+
+        Arrays I return are numpy arrays when numpy is installed (views into the map
+        whenever the rows asked for don't wrap around the ring buffer), or
+        array.array('d') otherwise.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+
+        try:
+            self._parse()
+        except struct.error:
+            raise RRDFileError('%r is truncated' % filename)
+
+    def __repr__(self):
+        return '<rrdfile.RRDFile %r, step=%i, ds=%r, rras=%i>' % (self.filename, self.step, self.ds_names, len(self.rras))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+            Let go of the map, it's unmapped once the last array viewing it is gone
+            (unmapping it from under a numpy view would crash us).
+        """
+        self._map = None
+
+    def _parse(self):
+        m = self._map
+        cookie, version, float_cookie, ds_cnt, rra_cnt, pdp_step = _statHead.unpack_from(m, 0)
+        if cookie != 'RRD\0':
+            raise RRDFileError('%r is not an rrd database' % self.filename)
+        if float_cookie != FLOAT_COOKIE:
+            raise RRDFileError('%r was written on a different architecture' % self.filename)
+
+        self.version = int(_cstring(version))
+        self.step = pdp_step
+        offset = _statHeadSize
+
+        self.ds = []
+        for i in xrange(ds_cnt):
+            name, type = _dsDef.unpack_from(m, offset)
+            par = offset + _dsDefSize - _univals
+            self.ds.append(DataSource(
+                _cstring(name), _cstring(type),
+                _ulong.unpack_from(m, par)[0], _double.unpack_from(m, par + _unival.size)[0], _double.unpack_from(m, par + 2 * _unival.size)[0]
+            ))
+            offset += _dsDefSize
+
+        rra_defs = []
+        for i in xrange(rra_cnt):
+            cf, row_cnt, pdp_cnt = _rraDef.unpack_from(m, offset)
+            xff = _double.unpack_from(m, offset + _rraDefSize - _univals)[0]
+            rra_defs.append((_cstring(cf), row_cnt, pdp_cnt, xff))
+            offset += _rraDefSize
+
+        last_up, = _timeT.unpack_from(m, offset)
+        offset += _timeT.size
+        usec = 0
+        if self.version >= 3:
+            usec, = _timeT.unpack_from(m, offset)
+            offset += _timeT.size
+        self.last_update_time = last_up
+        self.last_update = last_up + usec / 1e6
+
+        offset += ds_cnt * _pdpPrepSize + rra_cnt * ds_cnt * _cdpPrepSize
+
+        cur_rows = []
+        for i in xrange(rra_cnt):
+            cur_rows.append(_ulong.unpack_from(m, offset)[0])
+            offset += _ulong.size
+
+        self.rras = []
+        for i, ((cf, row_cnt, pdp_cnt, xff), cur_row) in enumerate(zip(rra_defs, cur_rows)):
+            self.rras.append(RRA(i, cf, pdp_cnt, row_cnt, xff, pdp_cnt * pdp_step, cur_row, offset))
+            offset += row_cnt * ds_cnt * _double.size
+
+        if offset > len(m):
+            raise RRDFileError('%r is truncated' % self.filename)
+
+    @property
+    def ds_names(self):
+        return [ds.name for ds in self.ds]
+
+    def ring(self, rra):
+        """
+            Returns the raw ring buffer of an RRA as a (rows, ds) numpy view, rows are in storage order,
+            the newest one is at rra.cur_row. Without numpy, I return a flat array.array copy.
+        """
+        rra = self._rra(rra)
+        count = rra.rows * len(self.ds)
+        if numpy is not None:
+            return numpy.frombuffer(self._map, numpy.float64, count, rra.offset).reshape(rra.rows, len(self.ds))
+
+        values = array.array('d')
+        values.fromstring(self._map[rra.offset:rra.offset + count * _double.size])
+        return values
+
+    def _rra(self, rra):
+        if isinstance(rra, RRA):
+            return rra
+        return self.rras[rra]
+
+    def choose_rra(self, cf, start, end, resolution = 1):
+        """ Returns the RRA `rrdtool fetch` would read [start, end] at `resolution` from. """
+        rras = [rra for rra in self.rras if rra.cf == cf]
+        i = pick_rra(self.step, [(rra.pdp_count, rra.rows) for rra in rras], start, end, resolution, self.last_update_time)
+        if i is None:
+            raise RRDFileError('%r has no %s RRA' % (self.filename, cf))
+        return rras[i]
+
+    def fetch(self, cf = 'AVERAGE', start = None, end = None, resolution = 1, ds = None):
+        """
+            Returns the same rows `rrdtool fetch` would, as a FetchResult of (start, end, step, names, columns),
+            where columns holds one array per data source in names, the first value is for start + step and
+            the last for end. `ds` picks which data sources to return, all of them by default.
+        """
+        if end is None:
+            end = self.last_update_time
+        if start is None:
+            start = end - 86400
+
+        rra = self.choose_rra(cf, start, end, resolution)
+        step = rra.step
+
+        # rrdtool rounds the range out to whole steps.
+        start -= start % step
+        end += step - end % step
+        count = (end - start) // step
+
+        names = self.ds_names
+        for name in ds or ():
+            if name not in names:
+                raise RRDFileError('%r has no data source %r' % (self.filename, name))
+        indexes = range(len(names)) if ds is None else [names.index(name) for name in ds]
+
+        # Which rows of the RRA, in time order, the range covers.
+        rra_end = self.last_update_time - self.last_update_time % step
+        rra_start = rra_end - step * (rra.rows - 1)
+        first = (start + step - rra_start) // step
+        lo = max(first, 0)
+        hi = min(first + count, rra.rows)
+        if hi > lo:
+            before, after = lo - first, first + count - hi
+        else:
+            before, after = count, 0
+
+        columns = [self._column(rra, i, lo, hi, before, after) for i in indexes]
+        return FetchResult(start, end, step, [names[i] for i in indexes], columns)
+
+    def _column(self, rra, ds, lo, hi, before, after):
+        """ Returns rows [lo, hi) of an RRA (in time order) for one data source, padded with `before` and `after` NaNs. """
+        pieces = []
+        if hi > lo:
+            first = (rra.cur_row + 1 + lo) % rra.rows
+            last = first + hi - lo
+            if last <= rra.rows:
+                pieces.append((first, last))
+            else:
+                pieces.append((first, rra.rows))
+                pieces.append((0, last - rra.rows))
+
+        ds_cnt = len(self.ds)
+        if numpy is not None:
+            ring = self.ring(rra)
+            parts = [ring[a:b, ds] for a, b in pieces]
+            if len(parts) == 1 and not before and not after:
+                return parts[0]
+
+            return numpy.concatenate([numpy.full(before, NAN)] + parts + [numpy.full(after, NAN)])
+
+        values = array.array('d', [NAN]) * before
+        row_size = ds_cnt * _double.size
+        for a, b in pieces:
+            rows = array.array('d')
+            rows.fromstring(self._map[rra.offset + a * row_size:rra.offset + b * row_size])
+            values.extend(rows[ds::ds_cnt])
+        values.extend(array.array('d', [NAN]) * after)
+        return values
+
+__all__ = ['RRDFile', 'RRDFileError', 'DataSource', 'RRA', 'FetchResult']
+
+import unittest
+
+class TestReader(unittest.TestCase):
+    """
+        Builds a corpus of databases from the bundled templates' create() definitions with rrdtool,
+        feeds them some updates, and checks we read back exactly what `rrdtool fetch` does.
+    """
+    start = 1300000000
+    updates = 3000
+
+    def setUp(self):
+        import tempfile
+        from twisted.python.procutils import which
+        if not which('rrdtool'):
+            self.skipTest('rrdtool is not installed')
+        self.rrdtool = which('rrdtool')[0]
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def _rrdtool(self, *args):
+        import subprocess
+        return subprocess.check_output([self.rrdtool] + list(args))
+
+    def _corpus(self, name):
+        """ Creates and fills <name>.rrd from the template called name. """
+        import os.path
+        from stats.templates import load_template
+        try:
+            template = load_template(name)(testing = True, id = name, config = {})
+        except (ImportError, RuntimeError), e:
+            self.skipTest('template %s can not be loaded: %s' % (name, e))
+
+        filename = os.path.join(self.path, '%s.rrd' % name)
+        args = template._createArgs()
+        self._rrdtool('create', filename, '-b', str(self.start), *args)
+
+        step = int(args[0].split()[1])
+        ds_cnt = len([arg for arg in args if arg.startswith('DS:')])
+        updates = ['%i:%s' % (self.start + step * i, ':'.join(['%i' % ((i * (j + 1)) % 1000) for j in xrange(ds_cnt)])) for i in xrange(1, self.updates + 1)]
+        for i in xrange(0, len(updates), 500):
+            self._rrdtool('update', filename, *updates[i:i + 500])
+
+        return filename, step
+
+    def _fetch(self, filename, start, end, resolution):
+        """ Runs `rrdtool fetch` and parses its output into a FetchResult. """
+        lines = self._rrdtool('fetch', filename, 'AVERAGE', '-s', str(start), '-e', str(end), '-r', str(resolution)).splitlines()
+        names = lines[0].split()
+        rows = [line.split(':') for line in lines[1:] if ':' in line]
+        times = [int(t) for t, _ in rows]
+        columns = [[float(values.split()[i]) for _, values in rows] for i in xrange(len(names))]
+        return times, names, columns
+
+    def _compare(self, name):
+        filename, step = self._corpus(name)
+        last = self.start + step * self.updates
+        with RRDFile(filename) as rrd:
+            self.assertEqual(rrd.step, step)
+            self.assertEqual(rrd.last_update_time, last)
+
+            for span, resolution in ((3600, 1), (86400, 60), (7 * 86400, 1800), (30 * 86400, 7200)):
+                times, names, columns = self._fetch(filename, last - span, last, resolution)
+                result = rrd.fetch('AVERAGE', last - span, last, resolution)
+                self.assertEqual(result.names, names)
+                self.assertEqual(range(result.start + result.step, result.end + 1, result.step), times)
+                for expected, got in zip(columns, result.columns):
+                    self.assertEqual(len(expected), len(got))
+                    for a, b in zip(expected, got):
+                        self.assertTrue((a != a and b != b) or abs(a - b) <= 1e-9 * max(abs(a), 1), (a, b))
+
+    def test_nginx(self):
+        self._compare('nginx')
+
+    def test_memcached(self):
+        self._compare('memcached')
+
+    def test_mysql(self):
+        self._compare('mysql')
+
+if __name__ == '__main__':
+    unittest.main()
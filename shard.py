@@ -0,0 +1,390 @@
+"""
+    prickle.shard
+    ~~~~~~~~~~~~~
+
+    I split polling across processes. With `poll_workers` set, the process that runs the web front
+    end forks that many pollers, each of which polls and draws its own shard of `config['graphs']`,
+    picked by a hash of the graph id so that a graph always lands on the same poller.
+
+    Pollers report their templates' counters, and the graphs they've drawn, back to the front end
+    every `poll_worker_report_interval` seconds, as lines of json on file descriptor 3. A poller that
+    dies gets restarted, the others carry on as if nothing happened.
+
+    Pollers are sent the config on stdin, as length prefixed pickles of ('config', config), when
+    they start and again every time the front end reloads it. On a cluster, only the front end runs
+    the heartbeat, and sends them ('alive', nodes) when they start and every time that changes.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from twisted.internet import reactor, protocol, fdesc
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python import log
+from struct import pack, unpack
+from . import metrics
+import cPickle as pickle
+import logging
+import signal
+import json
+import zlib
+import time
+import sys
+import os
+
+REPORT_FD = 3
+
+# The counters of BaseTemplate that pollers report, they only ever go up.
+_counters = ('requestsSent', 'successfulRequests', 'failedRequests', 'graphsRendered', 'graphsSkipped')
+# And the ones that are just passed along as they are.
+_values = ('lastUpdate', 'pollOffset')
+
+# The histograms pollers fill in, that the front end shows in /metrics.
+_histograms = ('poll_duration', 'render_duration')
+
+def shard_of(id, count):
+    """ Which of `count` pollers polls graph `id`. """
+    return (zlib.crc32(id) & 0xffffffff) % count
+
+def placements(graphs):
+    """
+        {graph id: the id it's placed by}, of the graphs that have to be polled in the same process, and on the same node,
+        as others: rollups (see templates.aggregate) and their members. Rollups that share members are placed together.
+        Graphs that aren't in here are placed by their own id.
+    """
+    from .templates import load_template
+
+    parent = {}
+    def find(id):
+        while parent.get(id, id) != id:
+            id = parent[id]
+        return id
+
+    for graph in graphs:
+        if not load_template(graph['template']).rollup:
+            continue
+        root = find(graph['id'])
+        parent.setdefault(root, root)
+        for id in graph['config'].get('ids', []):
+            other = find(id)
+            if other != root:
+                parent[other] = root
+
+    return dict((id, find(id)) for id in parent)
+
+def _picklable(config):
+    """ The config, without whatever a config file imported or defined that can't be sent to a poller. """
+    result = {}
+    for key, value in config.iteritems():
+        if key.startswith('_'):
+            continue
+        try:
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.msg('Not sending config %r to pollers, it could not be pickled.' % key, logLevel = logging.DEBUG)
+            continue
+        result[key] = value
+    return result
+
+class PollerProcessProtocol(protocol.ProcessProtocol):
+    """ I am one poller process, as seen from the front end. """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.alive = False
+        self.started = time.time()
+        self.reports = 0
+        self.lastReport = None
+        self.buffer = ''
+
+    def __repr__(self):
+        return '<shard.PollerProcessProtocol index=%i, alive=%r, reports=%i>' % (self.index, self.alive, self.reports)
+
+    def connectionMade(self):
+        self.alive = True
+        self.send('config', self.pool.config)
+        if self.pool.stats.cluster is not None:
+            self.send('alive', sorted(self.pool.stats.cluster.alive))
+
+    def send(self, kind, value):
+        data = pickle.dumps((kind, value), pickle.HIGHEST_PROTOCOL)
+        self.transport.write(pack('!I', len(data)) + data)
+
+    def childDataReceived(self, fd, data):
+        if fd != REPORT_FD:
+            return
+
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.reports += 1
+            self.lastReport = time.time()
+            try:
+                self.pool._report(self, json.loads(line))
+            except Exception:
+                log.msg('Poller %i sent a report we could not make sense of:' % self.index, logLevel = logging.ERROR)
+                log.err()
+
+    def processEnded(self, reason):
+        self.alive = False
+        self.pool._workerEnded(self, reason)
+
+class PollerPool(object):
+    """
+        I keep `size` poller processes running for a Stats instance, and fold what they report into its
+        `active_graphs`, `last_draw_timestamp` and metrics, so the front end shows them like its own.
+
+        Pollers that die get restarted after `restartDelay` seconds, which doubles every time one dies
+        within `maxRestartDelay` seconds of starting, up to `maxRestartDelay`.
+    """
+    restartDelay = 1
+    maxRestartDelay = 60
+
+    def __init__(self, stats, size):
+        if size < 1:
+            raise ValueError("size must be > 0")
+
+        self.stats = stats
+        self.size = size
+        self.workers = [None] * size
+        self.delays = [self.restartDelay] * size
+        self.running = False
+        self.restarts = 0
+        self.config = _picklable(stats.config)
+        # What pollers that have since died had counted, so the totals don't go back down when they restart.
+        self._base = {}
+        self._histograms = [dict() for i in xrange(size)]
+        self._baseHistograms = dict((name, {}) for name in _histograms)
+        if stats.cluster is not None:
+            stats.cluster.listeners.append(self.clusterChanged)
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        for index in xrange(self.size):
+            self._spawn(index)
+
+        log.msg('Started %i pollers' % self.size, logLevel = logging.INFO)
+
+    def stop(self):
+        """ Stop the pool, pollers shut down on SIGTERM like any twisted program. """
+        if not self.running:
+            return
+
+        self.running = False
+        for worker in self.workers:
+            if worker is not None and worker.alive:
+                worker.transport.signalProcess('TERM')
+
+    def reconfigure(self):
+        """ The front end reloaded its config, send it on to the pollers. """
+        self.config = _picklable(self.stats.config)
+        for worker in self.workers:
+            if worker is not None and worker.alive:
+                worker.send('config', self.config)
+
+    def clusterChanged(self):
+        """ The cluster's heartbeat, which only we run, saw nodes come or go, tell the pollers so they rebalance. """
+        alive = sorted(self.stats.cluster.alive)
+        for worker in self.workers:
+            if worker is not None and worker.alive:
+                worker.send('alive', alive)
+
+    def _spawn(self, index):
+        worker = self.workers[index] = PollerProcessProtocol(self, index)
+        env = dict(os.environ, PYTHONPATH = os.pathsep.join(sys.path))
+        args = [sys.executable, '-m', 'stats.shard', self.stats.instance_name, str(index), str(self.size)]
+        # stdin gets the configs, the poller logs to our stdout and stderr, and reports on REPORT_FD.
+        reactor.spawnProcess(worker, sys.executable, args = args, env = env, childFDs = {0: 'w', 1: 1, 2: 2, REPORT_FD: 'r'})
+
+    def _workerEnded(self, worker, reason):
+        if self.workers[worker.index] is not worker:
+            return
+
+        self._retire(worker.index)
+        if not self.running:
+            return
+
+        index = worker.index
+        if time.time() - worker.started > self.maxRestartDelay:
+            self.delays[index] = self.restartDelay
+        delay = self.delays[index]
+        self.delays[index] = min(delay * 2, self.maxRestartDelay)
+
+        self.restarts += 1
+        log.msg('Poller %i died (%s), restarting it in %is' % (index, reason.getErrorMessage(), delay), logLevel = logging.ERROR)
+        reactor.callLater(delay, self._restart, index)
+
+    def _restart(self, index):
+        if self.running:
+            self._spawn(index)
+
+    def _retire(self, index):
+        """ Remember what poller `index` counted, the one that replaces it will count from zero. """
+        graphs = self.stats.active_graphs
+        for id, template in graphs.iteritems():
+            if shard_of(self.stats.placement(id), self.size) == index:
+                self._base[id] = [getattr(template, name) for name in _counters]
+
+        for name, series in self._histograms[index].iteritems():
+            _addSeries(self._baseHistograms[name], series)
+        self._histograms[index] = {}
+
+    def _report(self, worker, report):
+        graphs = self.stats.active_graphs
+        for id, values in report['graphs'].iteritems():
+            template = graphs.get(id)
+            if template is None:
+                continue
+
+            base = self._base.get(id)
+            counters, rest = values[:len(_counters)], values[len(_counters):]
+            for i, name in enumerate(_counters):
+                setattr(template, name, counters[i] + (base[i] if base else 0))
+            for name, value in zip(_values, rest):
+                setattr(template, name, value)
+
+        self.stats.last_draw_timestamp.update(report['drawn'])
+
+        self._histograms[worker.index] = dict(
+            (name, dict((tuple(key), [counts, total, n]) for key, counts, total, n in rows)) for name, rows in report['metrics'].iteritems()
+        )
+        for name in _histograms:
+            series = dict((key, [list(counts), total, n]) for key, (counts, total, n) in self._baseHistograms[name].iteritems())
+            for histograms in self._histograms:
+                _addSeries(series, histograms.get(name, {}))
+            getattr(metrics, name).series = series
+
+    def status(self):
+        """ Returns a list of dicts describing each poller. """
+        now = time.time()
+        return [dict(
+            index = worker.index,
+            pid = worker.transport.pid if worker.alive else None,
+            alive = worker.alive,
+            uptime = now - worker.started,
+            reports = worker.reports,
+            last_report = now - worker.lastReport if worker.lastReport else None
+        ) for worker in self.workers if worker is not None]
+
+def _addSeries(series, other):
+    """ Adds the histogram series `other` into `series`, both are {label values: [bucket counts, sum, count]}. """
+    for key, (counts, total, n) in other.iteritems():
+        mine = series.get(key)
+        if mine is None:
+            series[key] = [list(counts), total, n]
+        else:
+            mine[0] = [a + b for a, b in zip(mine[0], counts)]
+            mine[1] += total
+            mine[2] += n
+
+class Reporter(object):
+    """ I run in a poller, and write what its templates are up to out to the front end every `interval` seconds. """
+
+    def __init__(self, stats, interval, fd = REPORT_FD):
+        self.stats = stats
+        self.fp = os.fdopen(fd, 'w')
+        self.loopingCall = LoopingCall(self.report)
+        self.interval = interval
+        self._sent = {}
+        self._drawn = {}
+
+    def start(self):
+        self.loopingCall.start(self.interval, now = False)
+
+    def report(self):
+        graphs = {}
+        for id, template in self.stats.active_graphs.iteritems():
+            if not template.running:
+                continue
+            values = [getattr(template, name) for name in _counters + _values]
+            if self._sent.get(id) != values:
+                graphs[id] = self._sent[id] = values
+
+        drawn = {}
+        for filename, timestamp in self.stats.last_draw_timestamp.iteritems():
+            if self._drawn.get(filename) != timestamp:
+                drawn[filename] = self._drawn[filename] = timestamp
+
+        report = dict(graphs = graphs, drawn = drawn, metrics = dict(
+            # json wants string keys, so the series go as [[label values, bucket counts, sum, count], ...]
+            (name, [[key] + series for key, series in getattr(metrics, name).series.iteritems()]) for name in _histograms
+        ))
+
+        try:
+            self.fp.write(json.dumps(report) + '\n')
+            self.fp.flush()
+        except IOError, e:
+            log.msg('Lost the front end (%s), shutting down.' % e, logLevel = logging.ERROR)
+            self.loopingCall.stop()
+            reactor.stop()
+
+class ConfigReader(Int32StringReceiver):
+    """
+        I run in a poller, and hand the configs the front end sends after the first one to Stats.reload, and the nodes
+        of the cluster it says are up to Cluster.setAlive.
+    """
+    MAX_LENGTH = 1 << 30 # the configs of a lot of graphs get big.
+
+    def __init__(self, stats, fd = 0):
+        self.stats = stats
+        self.fd = fd
+
+    def start(self):
+        fdesc.setNonBlocking(self.fd)
+        reactor.addReader(self)
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return 'ConfigReader'
+
+    def doRead(self):
+        return fdesc.readFromFD(self.fd, self.dataReceived)
+
+    def stringReceived(self, data):
+        kind, value = pickle.loads(data)
+        if kind == 'config':
+            self.stats.reload(value)
+        elif kind == 'alive':
+            if self.stats.cluster is not None:
+                self.stats.cluster.setAlive(value)
+        else:
+            log.msg('The front end sent us %r, which we know nothing about.' % kind, logLevel = logging.ERROR)
+
+def _read(fd, size):
+    """ Reads exactly size bytes from fd, which is still blocking. """
+    data = ''
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            raise EOFError('The front end went away before sending the config')
+        data += chunk
+    return data
+
+def main(argv = None):
+    """ Run as a poller: python -m stats.shard <instance name> <index> <count>, with the pickled configs on stdin. """
+    from stats import Stats
+
+    instance_name, index, count = (argv or sys.argv[1:])
+    log.startLogging(sys.stdout)
+    # A hangup is for the front end, which sends us the config it reloads.
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    stats = Stats('%s.poller%s' % (instance_name, index))
+    kind, config = pickle.loads(_read(0, unpack('!I', _read(0, 4))[0]))
+    assert kind == 'config', 'The front end sent %r before the config' % kind
+    stats.config.update(config)
+    stats.shard = (int(index), int(count))
+    reactor.callWhenRunning(ConfigReader(stats).start)
+    stats.run()
+
+__all__ = ['PollerPool', 'Reporter', 'ConfigReader', 'shard_of', 'placements']
+
+if __name__ == '__main__':
+    main()
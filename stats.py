@@ -8,14 +8,17 @@
     :license: BSD!
 """
 
-from werkzeug.datastructures import ImmutableDict
 from .templates import load_template, template_exists, TemplateRunner
-from .app import WebApp
-from .base.config import Config
+from .base.config import Config, ImmutableDict
+from . import proc_rrd
+from . import metrics
+from . import shard
 from twisted.internet import reactor
 from twisted.python.threadpool import ThreadPool
 from twisted.python import log
 import logging
+import signal
+import time
 
 class Stats(object):
     """
@@ -34,22 +37,60 @@ class Stats(object):
             week = 300*3,
             default = 60
         ),
+        graph_render_mode = 'scheduled', # or 'on_demand', to draw graphs when they're requested and older than graph_max_age, or 'client', to draw charts in the browser instead.
+        graph_max_age = dict(), # per period, defaults to graph_draw_frequency.
+        hot_graphs = [], # ids of graphs that are still drawn on a timer in 'on_demand' and 'client' mode.
+        export_concurrency = 4, # how many rrd files /export reads at once.
+        poll_spread = True, # poll each template at its own offset into its interval, instead of all at once.
+        max_connections = 1000, # most connections templates keep open to what they poll, all together, but for http ones, which keep one per host.
+        connection_idle_timeout = 300, # close connections to what we poll after they've been unused this long.
         wsgi_min_threads = 1,
-        wsgi_max_threads = 5
+        wsgi_max_threads = 5,
+        rrdtool_workers = 0, # run rrdtool commands through this many persistent `rrdtool -` processes, 0 spawns one per command.
+        rrdcached_address = None, # e.g. 'unix:/var/run/rrdcached.sock', queue updates in rrdcached instead of writing them directly. While it's down, they wait for it, up to RRDCachedClient.maxBuffered, then they're written directly and the older ones it held are lost.
+        poll_workers = 0, # poll and draw graphs in this many processes of their own, each owning a shard of the graphs, 0 does it all in this one.
+        poll_worker_report_interval = 5, # how often, in seconds, poll workers tell the web front end what they're up to.
+        render_workers = 0, # draw graphs in this many processes of their own, instead of between polls.
+        render_worker_concurrency = 4, # graphs each render worker draws at once.
+        render_socket = None, # unix socket the render workers connect to, defaults to one in the temp directory.
+        cluster_nodes = dict(), # name -> 'host:port' of the web front end of every node sharing this config, see `cluster`.
+        cluster_node = None, # which of cluster_nodes I am.
+        cluster_heartbeat = 5, # seconds between asking the other nodes how they are.
+        cluster_timeout = 15, # seconds a node can go without answering before its graphs move to the others.
+        database_create_concurrency = 8, # databases create_databases creates at once.
+        counter_state_path = None, # where templates keep the counters they last read over restarts, defaults to counters.state in database_path, False not to.
+        admin_hosts = ['127.0.0.1', '::1'] # addresses that may use /admin, e.g. to reload the config.
     ))
 
     def __init__(self, instance_name):
         self.instance_name = instance_name
         self.config = Config(self.default_config)
-        self.flask_app = WebApp(self)
+        self._flask_app = None
         self.template_runner = TemplateRunner(self)
         self.active_graphs = dict()
         self.last_draw_timestamp = dict()
+        self.shard = None # (index, count) when I'm one of `poll_workers` poller processes.
+        self.pollers = None # the shard.PollerPool, when I'm the web front end of `poll_workers` pollers.
+        self.cluster = None # the cluster.Cluster I'm a node of, if `cluster_nodes` is set.
+        self.creating = None # the deferred of create_databases, while it's running.
+        self.overrides = dict() # the config given to run(), that reload() puts back over the config file.
+        self.placements = dict() # graph id -> the id it's placed by, for graphs that are polled along with others.
         self.wsgi_threadpool = ThreadPool(minthreads = self.config['wsgi_min_threads'], maxthreads=self.config['wsgi_max_threads'], name = 'wsgi_threadpool')
+        metrics.watch(self)
     
-    def validate_config(self):
-        """ Validates the loaded configuration. """
-        c = self.config
+    @property
+    def flask_app(self):
+        """ The web front end, flask and the rest of the web stack aren't imported until someone wants it. """
+        if self._flask_app is None:
+            t = time.time()
+            from .app import WebApp
+            metrics.import_times.setdefault('stats.app', time.time() - t)
+            self._flask_app = WebApp(self)
+        return self._flask_app
+    
+    def validate_config(self, config = None):
+        """ Validates the loaded configuration, or `config`. """
+        c = self.config if config is None else config
         
         # Make sure that we have a database_path, and an image_path...
         assert 'database_path' in c
@@ -61,6 +102,8 @@ class Stats(object):
         for period, interval in self.default_config['graph_draw_frequency'].iteritems():
             graph_draw_frequency.setdefault(period, interval)
         
+        assert c['graph_render_mode'] in ('scheduled', 'on_demand', 'client')
+        
         # A quick check to make sure that our port is an integer.
         c['httpd_port'] = int(c['httpd_port'])
         
@@ -72,11 +115,100 @@ class Stats(object):
             assert graph['id'] not in ids
             ids.add(graph['id'])
             assert(template_exists(graph['template']))
+        
+        assert c['poll_workers'] >= 0
+        assert c['render_workers'] >= 0
+        assert c['cluster_node'] is None or c['cluster_node'] in c['cluster_nodes']
+            
+    def placement(self, id):
+        """ What decides which poller, and which node, polls graph `id`, see shard.placements. """
+        return self.placements.get(id, id)
+    
+    def owns(self, id):
+        """ Do I poll and draw graph `id`, or is it another poller's, or another node's? """
+        id = self.placement(id)
+        if self.cluster is not None and not self.cluster.owns(id):
+            return False
+        return self.shard is None or shard.shard_of(id, self.shard[1]) == self.shard[0]
+            
+    def reload(self, config = None):
+        """
+            Load the config file again, or take `config` (pollers are sent theirs by the front end), and start, stop or
+            reconfigure only the graphs that were added, removed or changed, see TemplateRunner.reconfigure. The rest
+            carry on polling as if nothing happened. Of the other settings, the ones that are read as they're needed
+            (max_connections, hot_graphs, ...) change, the ones that are only read at startup (the worker counts, the
+            paths, ports and cluster) need a restart.
             
+            Returns what changed, or None if the new config was no good, in which case the old one is kept. That includes
+            a graph whose template won't take its new config, see TemplateRunner.prepare, nothing is touched until every
+            added or changed graph's template has been made from it.
+        """
+        new = Config(self.default_config)
+        try:
+            if config is None:
+                if self.config.filename is None:
+                    raise ValueError('No config file was loaded, so there is nothing to reload')
+                new.load(self.config.filename)
+                new.filename = self.config.filename
+            else:
+                new.update(config)
+            new.update(self.overrides)
+            self.validate_config(new)
+            plan = self.template_runner.prepare(self.config['graphs'], new['graphs'])
+        except Exception:
+            log.msg('Not reloading the config, the new one is no good:', logLevel = logging.ERROR)
+            log.err()
+            return None
+        
+        if self.shard is not None:
+            self._divide_config(new)
+        
+        self.config.clear()
+        self.config.update(new)
+        self.config.filename = new.filename
+        # Rollups that were added or changed can take graphs that were already there with them.
+        self.placements = shard.placements(self.config['graphs'])
+        self.template_runner.rebalance()
+        changes = self.template_runner.reconfigure(plan)
+        
+        if self.pollers is not None:
+            self.pollers.reconfigure()
+        
+        log.msg('Reloaded the config from %s.' % (self.config.filename or 'the front end'), logLevel = logging.INFO)
+        return changes
+    
+    def _divide_config(self, config):
+        """ I'm a poller, so I get my share of what's shared between the pollers. """
+        config['max_connections'] = max(1, config['max_connections'] // self.shard[1])
+    
     def create_databases(self, overwrite = False):
-        """ A convenience function to create all rrd databases. """
+        """
+            A convenience function to create all rrd databases. Returns a deferred that fires with a summary when
+            they've been created, run() won't start polling until then.
+        """
         self.validate_config()
-        self.template_runner.create_databases(overwrite)
+        
+        def done(res):
+            self.creating = None
+            return res
+        
+        self.creating = self.template_runner.create_databases(overwrite).addBoth(done)
+        return self.creating
+    
+    def after_creating(self, f, *args, **kwargs):
+        """ Call f once create_databases is done, or right away if it isn't running. """
+        if self.creating is None:
+            return f(*args, **kwargs)
+        
+        def created(res):
+            f(*args, **kwargs)
+            return res
+        self.creating.addBoth(created)
+        
+    def log_import_times(self):
+        """ Logs how long importing prickle, and the parts of it imported as they were needed, took. """
+        times = metrics.import_times
+        log.msg('Imported %s' % ', '.join(['%s in %.3fs' % (name, times[name]) for name in sorted(times)]), logLevel = logging.INFO)
         
     def start_threadpool(self, pool):
         """ Schedules the start of a threadpool, and schedule the stop of it when the reactor shuts down. """
@@ -104,14 +236,52 @@ class Stats(object):
         """
         # Load and validate the configuration.
         self.config.update(config_args)
+        self.overrides.update(config_args)
         self.validate_config()
+        self.placements = shard.placements(self.config['graphs'])
+        
+        # Say how long starting up took, for whoever is waiting on a rolling restart.
+        reactor.callWhenRunning(self.log_import_times)
+        
+        if self.config['rrdtool_workers']:
+            proc_rrd.start_pool(self.config['rrdtool_workers'])
+        
+        if self.config['rrdcached_address']:
+            proc_rrd.start_cached(self.config['rrdcached_address'])
+        
+        if self.config['cluster_nodes']:
+            from . import cluster
+            assert self.config['cluster_node'], 'cluster_nodes is set, but not which of them this is (cluster_node)'
+            self.cluster = cluster.Cluster(self)
+            self.cluster.listeners.append(self.template_runner.rebalance)
+            # Pollers don't run a heartbeat of their own, their front end sends them what it hears, see shard.PollerPool.
+            if self.shard is None:
+                reactor.callWhenRunning(self.cluster.start)
+        
+        if self.shard is not None:
+            # I'm a poller, the web front end that started me serves the web site.
+            self._divide_config(self.config)
+            self.template_runner.run()
+            reactor.callWhenRunning(shard.Reporter(self, self.config['poll_worker_report_interval']).start)
+            reactor.run()
+            return
+        
+        # Reload the config on SIGHUP, pollers are sent it by us.
+        reactor.callWhenRunning(signal.signal, signal.SIGHUP, lambda signum, frame: reactor.callFromThread(self.reload))
         
         # Schedule the start of the threadpools.
         self.wsgi_threadpool.adjustPoolsize(minthreads = self.config['wsgi_min_threads'], maxthreads=self.config['wsgi_max_threads'])
         self.start_threadpool(self.wsgi_threadpool)
         
-        # Start the web server and the template runner.
-        self.template_runner.run()
+        # Start the web server and the template runner, or the pollers that do the template runner's work,
+        # but don't start polling before the databases are there.
+        if self.config['poll_workers']:
+            self.template_runner.run(poll = False)
+            self.pollers = shard.PollerPool(self, self.config['poll_workers'])
+            reactor.callWhenRunning(self.after_creating, self.pollers.start)
+            reactor.addSystemEventTrigger('before', 'shutdown', self.pollers.stop)
+        else:
+            self.after_creating(self.template_runner.run)
         self.flask_app.run()
         
         # Finally, start the twisted reactor.
@@ -4,20 +4,32 @@
     
     i load templates by template name, and hold the TemplateRunner
     
+    templates are the modules of this package, or classes that other packages hand us with a
+    `prickle.templates` entry point, e.g. `redis = prickle_redis.template:Redis`. a template's
+    module isn't imported until a graph uses it.
+    
 """
 import os.path
-import imp
-from twisted.internet.task import LoopingCall
+import importlib
 from twisted.internet.defer import DeferredList, maybeDeferred, inlineCallbacks
+from twisted.internet.task import cooperate
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.internet import reactor
+from stats.base.connections import ConnectionManager
+from stats.base.counters import CounterStore
+from stats.base.scheduler import Scheduler
+import stats.metrics as metrics
 import logging
 import time
 import operator
+from collections import defaultdict
 
 
 templates_dict = {}
 templates = []
+_index = None
+_entry_points = None
 
 def _make_aliases(template):
     aliases = getattr(template, 'aliases', range(template.numGraphs))
@@ -26,33 +38,68 @@ def _make_aliases(template):
     template.aliases_reversed = dict((v, k) for (k, v) in enumerate(aliases))
     
 
+def template_index():
+    """
+        {template name: module}, of the templates in this package, worked out from one look at its directory
+        the first time anyone asks, without importing any of them.
+    """
+    global _index
+    if _index is None:
+        index = {}
+        for directory in __path__:
+            for filename in os.listdir(directory):
+                name, ext = os.path.splitext(filename)
+                if ext == '.py' and not name.startswith('_'):
+                    index.setdefault(name, '%s.%s' % (__name__, name))
+        _index = index
+    return _index
+    
+def _entry_point(name):
+    """
+        The `prickle.templates` entry point called name, for templates that live in packages of their own.
+        pkg_resources takes a while to import, so I'm only asked about names that aren't in template_index().
+    """
+    global _entry_points
+    if _entry_points is None:
+        try:
+            import pkg_resources
+        except ImportError:
+            _entry_points = {}
+        else:
+            _entry_points = dict((ep.name, ep) for ep in pkg_resources.iter_entry_points('prickle.templates'))
+    return _entry_points.get(name)
+
 def load_template(name):
-    """ Attempts to load a template by name """
+    """ Attempts to load a template by name, importing its module if it hasn't been already. """
     if name in templates_dict:
         return templates_dict[name]
-        
+    
+    t = time.time()
+    module = template_index().get(name)
+    if module is not None:
+        template = importlib.import_module(module).template
     else:
-        fp, pathname, description = imp.find_module(name, __path__)
-        try:
-            template = templates_dict[name] = imp.load_module(name, fp, pathname, description).template
-            template.template = name
-            templates.append(template)
-            templates.sort(key=operator.attrgetter('template'))
-            _make_aliases(template)
-            
-            return template
-        
-        finally:
-            fp.close()
+        ep = _entry_point(name)
+        if ep is None:
+            raise ImportError('No template named %r' % name)
+        template = ep.load()
+        module = ep.module_name
+    metrics.import_times[module] = time.time() - t
+    
+    templates_dict[name] = template
+    template.template = name
+    templates.append(template)
+    templates.sort(key=operator.attrgetter('template'))
+    _make_aliases(template)
+    
+    return template
             
 def template_exists(name):
-    """ Checks if a template exists """
-    try:
-        load_template(name)
-        return True
-    except ImportError, AttributeError:
-        raise
-        return False
+    """
+        Checks if a template exists, without importing it. A template module that fails to import is only found out
+        by load_template, when the graph is first made.
+    """
+    return name in templates_dict or name in template_index() or _entry_point(name) is not None
         
 
 class TemplateRunner(object):
@@ -61,35 +108,328 @@ class TemplateRunner(object):
     def __init__(self, stats):
         self.stats = stats
         self.loopingCalls = []
+        self.scheduler = Scheduler() # drives every poll and render.
+        self.connections = ConnectionManager() # the connections templates keep open to what they poll.
+        self.httpPool = None # made with the Agent of `http`, the first time a template asks for it.
+        self._http = None
+        self.renderers = None # the render.RenderPool that draws our graphs, if they're drawn in processes of their own.
+        self.polling = False # are we running templates, or just making them for the web front end?
+        self.rollups = {} # graph id -> the running rollups it feeds its updates to, see templates.aggregate.
+        self.counters = CounterStore() # the counters templates last read, kept over restarts, see counter_state_path.
+        self.skippedGraphs = defaultdict(int) # per period, graphs not drawn because nothing on them could've changed.
         self.scheduledPeriods = set(stats.config['graph_draw_frequency'].keys()) # we know what we have scheduled, and we know what default needs.
         self.scheduledPeriods.discard('default')
     
+    progressInterval = 5 # seconds between telling how far create_databases has got.
+    
+    @property
+    def http(self):
+        """
+            The Agent templates that poll over http share. Its pool keeps one connection per host open between polls,
+            and closes them after `connection_idle_timeout` seconds of not being used.
+        """
+        if self._http is None:
+            from twisted.web.client import Agent, HTTPConnectionPool
+            self.httpPool = HTTPConnectionPool(reactor, persistent = True)
+            self.httpPool.maxPersistentPerHost = 1
+            self.httpPool.cachedConnectionTimeout = self.stats.config['connection_idle_timeout']
+            self._http = Agent(reactor, pool = self.httpPool)
+        return self._http
+    
     def create_databases(self, overwrite = False):
-        for graph in self.stats.config['graphs']:
-            cls = load_template(graph['template'])
-            Cls = cls(self.make_filename(graph['id']), id = graph['id'], config = graph['config'], factory = self)
-            Cls._create(overwrite)
+        """
+            Create the database of every configured graph that hasn't got one, `database_create_concurrency` at a time.
+            Returns a deferred that fires with a summary of what was done once they're all done.
+        """
+        config = self.stats.config
+        graphs = config['graphs']
+        
+        # One look at the directory, instead of one per database.
+        try:
+            existing = frozenset(os.listdir(config['database_path']))
+        except OSError:
+            existing = frozenset()
+        
+        summary = dict(total = len(graphs), created = 0, existing = 0, failed = 0)
+        started = [time.time()] * 2 # when we started, and when we last said how far we'd got.
+        
+        def created(res):
+            summary['created' if res else 'existing'] += 1
+        
+        def failed(err, id):
+            summary['failed'] += 1
+            log.msg('Could not create the database of %r:' % id, logLevel = logging.ERROR)
+            log.err(err)
+        
+        def work():
+            for graph in graphs:
+                # A graph that raises here mustn't end the generator, and with it every task taking graphs off it.
+                try:
+                    template = self.make_template(graph)
+                    d = template._create(overwrite, exists = os.path.basename(template.filename) in existing)
+                except Exception:
+                    failed(Failure(), graph['id'])
+                else:
+                    yield d.addCallbacks(created, failed, errbackArgs = (graph['id'], ))
+                
+                now = time.time()
+                if now - started[1] > self.progressInterval:
+                    started[1] = now
+                    log.msg('Created %(created)i databases so far, %(existing)i were already there, %(failed)i failed, of %(total)i.' % summary, logLevel = logging.INFO)
+        
+        def done(res):
+            summary['seconds'] = time.time() - started[0]
+            log.msg('Created %(created)i databases, %(existing)i were already there, %(failed)i failed, of %(total)i, in %(seconds).1f seconds.' % summary, logLevel = logging.INFO)
+            return summary
+        
+        # Every cooperative task takes the next graph off the same generator.
+        graphsLeft = work()
+        return DeferredList([
+            cooperate(graphsLeft).whenDone() for i in xrange(max(1, config['database_create_concurrency']))
+        ]).addCallback(done)
         
     def make_filename(self, id):
         """ Convenience function that creates the filename / path for an rrd database """
         return os.path.join(self.stats.config['database_path'], '%s.rrd' % id)
         
-    def run(self):
-        """ Start each of the configured templates up. """
+    def make_template(self, graph):
+        """
+            Make the template of `graph`, one of config['graphs']. It gets a copy of the graph's config to fill its
+            defaults into, so that the config stays as it was loaded for prepare() to compare against.
+        """
+        cls = load_template(graph['template'])
+        template = cls(self.make_filename(graph['id']), id = graph['id'], config = dict(graph['config']), factory = self)
+        template._defaultIntervalDraws = tuple(set(template.config['periods']) - self.scheduledPeriods)
+        return template
+        
+    def run(self, poll = True):
+        """
+            Start each of the configured templates up. If `poll` is False, they're only made, for the web front end
+            to show, because they're polled by pollers in processes of their own (see `shard`).
+        """
+        self.polling = poll
+        if poll:
+            self.connections.maxConnections = self.stats.config['max_connections']
+            self.connections.idleTimeout = self.stats.config['connection_idle_timeout']
+            self.connections.start()
+            self.scheduler.start()
+            if self.stats.config['render_workers']:
+                self.start_renderers()
+            self.load_counters()
+        
         for graph in self.stats.config['graphs']:
-            cls = load_template(graph['template'])
-            Cls = cls(self.make_filename(graph['id']), id = graph['id'], config = graph['config'], factory = self)
-            Cls._defaultIntervalDraws = list(set(Cls.config['periods']) - self.scheduledPeriods)
-            self.stats.active_graphs[graph['id']] = Cls
-            Cls.run()
+            Cls = self.stats.active_graphs[graph['id']] = self.make_template(graph)
+            # Pollers make every template, the ones that combine others need them, but only run their own.
+            if poll and self.stats.owns(graph['id']):
+                Cls.run()
+        
+        if not poll:
+            return
+        
+        # Counters of graphs someone else polls now would be compared with what they read after we stopped.
+        for id in self.counters:
+            if id not in self.stats.active_graphs or not self.stats.owns(id):
+                self.counters.forget(id)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.save_counters)
+        
+        load = self.poll_load()
+        if load['polls']:
+            log.msg('Scheduled %i polls every %i seconds, %.2f per second on average, at most %i in one second (at +%is).' % (
+                sum(load['polls']), load['window'], load['mean'], load['peak'], load['polls'].index(load['peak'])
+            ), logLevel = logging.INFO)
         
         reactor.callWhenRunning(self.start_graphing_loop)
+    
+    def rebalance(self):
+        """ Start the templates that have become ours, and stop the ones that aren't anymore, see `Stats.owns`. """
+        if not self.polling:
+            return
+        
+        started = stopped = 0
+        for id, template in self.stats.active_graphs.iteritems():
+            owned = self.stats.owns(id)
+            if owned and not template.running:
+                template.run()
+                started += 1
+            elif template.running and not owned:
+                template.stop()
+                self.counters.forget(id)
+                stopped += 1
+        
+        log.msg('Started polling %i graphs, and stopped polling %i.' % (started, stopped), logLevel = logging.INFO)
+    
+    def prepare(self, oldGraphs, newGraphs):
+        """
+            Work out what reconfigure() has to do to go from `oldGraphs` to `newGraphs`, both like config['graphs'],
+            touching only the graphs whose entry changed. The templates of graphs that were added are made here, and
+            those of graphs whose config changed are made once with it to see that it's good, so whatever a template
+            raises on its config is raised here, before anything is stopped. A graph whose template changed is
+            removed and added again.
+        """
+        old = dict((graph['id'], graph) for graph in oldGraphs)
+        new = dict((graph['id'], graph) for graph in newGraphs)
+        
+        removed = [id for id in old if id not in new or new[id]['template'] != old[id]['template']]
+        added = [id for id in new if id not in old or new[id]['template'] != old[id]['template']]
+        changed = [id for id in new if id in old and id not in added and new[id]['config'] != old[id]['config']]
+        
+        plan = dict(removed = removed, added = {}, changed = {}, forget = [])
+        for id in added:
+            plan['added'][id] = self.make_template(new[id])
+        for id in changed:
+            self.make_template(new[id])
+            plan['changed'][id] = dict(new[id]['config'])
+            # Counters read from another host, or with other settings, are nothing to compare the next ones with.
+            oldConfig, newConfig = dict(old[id]['config']), dict(new[id]['config'])
+            oldConfig.pop('periods', None)
+            newConfig.pop('periods', None)
+            if oldConfig != newConfig:
+                plan['forget'].append(id)
+        return plan
+    
+    def reconfigure(self, plan):
+        """
+            Bring active_graphs in line with config['graphs'], as `plan` from prepare() says. New graphs get their
+            databases created and are started, graphs that are gone are stopped, and graphs whose config changed are
+            handed it while they run (see BaseTemplate.reconfigure), forgetting their counters unless only their periods
+            changed. Returns {'added': ids, 'removed': ids, 'changed': ids}.
+        """
+        graphs = self.stats.active_graphs
+        
+        if self.polling:
+            self.connections.maxConnections = self.stats.config['max_connections']
+            self.connections.idleTimeout = self.stats.config['connection_idle_timeout']
+            if self.httpPool is not None:
+                self.httpPool.cachedConnectionTimeout = self.stats.config['connection_idle_timeout']
+        
+        for id in plan['removed']:
+            template = graphs.pop(id, None)
+            if template is not None:
+                template.stop()
+            self.counters.forget(id)
+        
+        for id, config in plan['changed'].iteritems():
+            template = graphs[id]
+            template.reconfigure(config)
+            template._defaultIntervalDraws = tuple(set(template.config['periods']) - self.scheduledPeriods)
+        for id in plan['forget']:
+            self.counters.forget(id)
+        
+        def start(res, template):
+            # Unless it was reloaded away while its database was being made.
+            if graphs.get(template.id) is template and not template.running and self.polling:
+                template.run()
+        
+        for id, template in plan['added'].iteritems():
+            graphs[id] = template
+            if self.polling and self.stats.owns(id):
+                template._create().addErrback(log.err).addCallback(start, template)
+        
+        added, removed, changed = sorted(plan['added']), sorted(plan['removed']), sorted(plan['changed'])
+        log.msg('Reconfigured graphs, %i added, %i removed, %i changed.' % (len(added), len(removed), len(changed)), logLevel = logging.INFO)
+        return dict(added = added, removed = removed, changed = changed)
+    
+    def counter_state_path(self):
+        """
+            The file my counters are kept in over restarts, or None if they aren't. Every poller, and every node of a
+            cluster, has one of its own, since they all poll different graphs.
+        """
+        config = self.stats.config
+        path = config['counter_state_path']
+        if path is None:
+            path = os.path.join(config['database_path'], 'counters.state')
+        elif not path:
+            return None
+        
+        if config['cluster_node']:
+            path = '%s.%s' % (path, config['cluster_node'])
+        if self.stats.shard is not None:
+            path = '%s.%i' % (path, self.stats.shard[0])
+        return path
+    
+    def load_counters(self):
+        """ Pick up the counters save_counters left, so the first poll of every graph after a restart can be written. """
+        path = self.counter_state_path()
+        if path is None:
+            return
+        
+        try:
+            count = self.counters.load(path)
+        except Exception:
+            log.msg('Could not read counters from %s, starting over:' % path, logLevel = logging.ERROR)
+            log.err()
+            return
+        
+        if count:
+            log.msg('Loaded the counters of %i graphs from %s' % (count, path), logLevel = logging.INFO)
+    
+    def save_counters(self):
+        """ Put the counters templates last read on disk, for load_counters after a restart. """
+        path = self.counter_state_path()
+        if path is None:
+            return
+        
+        t = time.time()
+        try:
+            count = self.counters.save(path)
+        except (IOError, OSError), e:
+            log.msg('Could not save counters to %s: %s' % (path, e), logLevel = logging.ERROR)
+            return
+        
+        log.msg('Saved the counters of %i graphs to %s in %.3fs' % (count, path, time.time() - t), logLevel = logging.INFO)
+    
+    def start_renderers(self):
+        """ Draw graphs in `render_workers` processes of their own from now on. """
+        config = self.stats.config
+        socketPath = config['render_socket']
+        if socketPath and self.stats.shard is not None:
+            socketPath = '%s.%i' % (socketPath, self.stats.shard[0])
+        
+        options = []
+        if config['rrdtool_workers']:
+            options += ['--rrdtool-workers', str(config['rrdtool_workers'])]
+        if config['rrdcached_address']:
+            options += ['--rrdcached', config['rrdcached_address']]
+        
+        # The render workers, and the AMP they're spoken to with, aren't imported until they're wanted.
+        t = time.time()
+        import stats.render as render
+        metrics.import_times.setdefault('stats.render', time.time() - t)
+        
+        self.renderers = render.RenderPool(config['render_workers'], config['render_worker_concurrency'], socketPath, options)
+        reactor.callWhenRunning(self.renderers.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.renderers.stop)
+    
+    def poll_load(self, resolution = 1):
+        """
+            Returns how many polls start in each `resolution` second slot of a window as long as the longest interval,
+            starting at a multiple of it in wall clock time, along with the mean and peak number of polls per slot.
+        """
+        running = [template for template in self.stats.active_graphs.itervalues() if template.pollOffset is not None]
+        window = max([template.interval for template in running] or [0])
+        slots = [0] * int(-(-window // resolution))
+        
+        for template in running:
+            t = template.pollOffset
+            while t < window:
+                slots[int(t // resolution)] += 1
+                t += template.interval
+        
+        return dict(
+            resolution = resolution,
+            window = window,
+            polls = slots,
+            mean = float(sum(slots)) / len(slots) if slots else 0.0,
+            peak = max(slots or [0])
+        )
         
     def start_graphing_loop(self):
         """Schedule all the looping calls for the graphs!"""
-        from collections import defaultdict
         graph_draw_frequency = self.stats.config['graph_draw_frequency']
         
+        if self.stats.config['graph_render_mode'] == 'client' and not self.stats.config['hot_graphs']:
+            log.msg("Charts are drawn by the browser, not drawing any graphs on a timer.", logLevel = logging.INFO)
+            return
         
         # Instead of scheduling many LoopingCalls if the interval is the same, we group loopingcalls by intervals.
         i_group = defaultdict(list)
@@ -98,12 +438,12 @@ class TemplateRunner(object):
             i_group[interval].append(period)
             
         for interval, periods in i_group.iteritems():
-            lc = LoopingCall(self.render_graphs, periods)
+            lc = self.scheduler.call(self.render_graphs, periods)
             self.loopingCalls.append(lc)
             log.msg("Starting graphing_loop for periods=%r, interval=%i" % (periods, interval), logLevel = logging.INFO)
             lc.start(interval)
         
-        log.msg("Started %i LoopingCalls to graph with." % len(self.loopingCalls), logLevel = logging.INFO)
+        log.msg("Scheduled %i calls to graph with." % len(self.loopingCalls), logLevel = logging.INFO)
             
     def stop(self):
         """ Stop the template runner """
@@ -115,31 +455,47 @@ class TemplateRunner(object):
             
         for template in self.stats.active_graphs.itervalues():
             template.stop()
+        
+        self.polling = False
+        self.connections.stop()
+        if self.httpPool is not None:
+            self.httpPool.closeCachedConnections()
+        self.scheduler.stop()
+        if self.renderers is not None:
+            self.renderers.stop()
             
-        self.active_graphs.clear()
+        self.stats.active_graphs.clear()
         
     
     def _do_graph_render(self, callback, periods):
         """ Iternal method to render graphs """
         
+        t = time.time()
         return DeferredList([
-            maybeDeferred(callback, period).addErrback(self._graph_error, period) for period in periods
+            maybeDeferred(callback, period).addErrback(self._graph_error, period).addBoth(self._graph_rendered, period, t) for period in periods
         ], consumeErrors = True)
+    
+    def _graph_rendered(self, res, period, t):
+        metrics.render_duration.observe(time.time() - t, period = period)
+        return res
             
     def _graph_error(self, err, period):
         log.msg("Error generating graphs, period=%s" % period, logLevel = logging.ERROR)
         log.err(err)
     
     
-    def render_graphs(self, periods):
-        """
-            Render all the graphs that each template provides, work happens
-            in multiple threads. Returns a deferred that fires when graphs have
-            been successfully rendered.
-        """
+    def _jobQueue(self, periods):
+        """ Returns [(template, periods it should draw), ...] for every template that has anything to draw for `periods`. """
+        
+        # When rendering on demand, or charts are drawn by the browser, only the hot graphs get drawn on a timer.
+        onDemand = self.stats.config['graph_render_mode'] in ('on_demand', 'client')
+        hotGraphs = set(self.stats.config['hot_graphs'])
         
         jobQueue = []
         for template in self.stats.active_graphs.itervalues():
+            if not template.running or onDemand and template.id not in hotGraphs:
+                continue
+            
             t_periodsToRun = []
             t_periods = template.config['periods']
             
@@ -155,15 +511,28 @@ class TemplateRunner(object):
                 jobQueue.append(
                     (template, t_periodsToRun)
                 )
+        return jobQueue
+    
+    def render_graphs(self, periods):
+        """
+            Render all the graphs that each template provides, work happens
+            in multiple threads. Returns a deferred that fires when graphs have
+            been successfully rendered.
+        """
+        
+        jobQueue = self._jobQueue(periods)
         
         # We have nothing to do...
         if not jobQueue:
             return
         log.msg('Generating graphs for periods=%r, jobQueueLength=%i' % (periods, len(jobQueue)), logLevel = logging.INFO)
         t = time.time()
+        skipped = sum(self.skippedGraphs.itervalues())
         
         def workDone(res):
-            log.msg('Generated graphs for periods=%r in  %.3f seconds.' % (periods, time.time() - t), logLevel = logging.INFO)
+            log.msg('Generated graphs for periods=%r in  %.3f seconds, skipped %i unchanged graphs.' % (
+                periods, time.time() - t, sum(self.skippedGraphs.itervalues()) - skipped
+            ), logLevel = logging.INFO)
             return res
         
         d = DeferredList([
@@ -177,4 +546,4 @@ class TemplateRunner(object):
             
     
     
-__all__ = ['TemplateRunner', 'load_template', 'template_exists', 'templates', 'templates_dict']
\ No newline at end of file
+__all__ = ['TemplateRunner', 'load_template', 'template_exists', 'template_index', 'templates', 'templates_dict']
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+    prickle.templates.aggregate
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    I roll the graphs of a group of hosts up into one database, as they're polled, so graphing the
+    group means reading one file instead of one per host:
+
+        dict(id = 'web', template = 'aggregate', config = dict(template = 'nginx', ids = ['web1', 'web2', ...], ds = ['requests']))
+
+    `template` is the template of the graphs in `ids`, and `ds` the data sources of theirs to roll
+    up, all of them if it's left out. Every time a member writes an update, I work out the rates
+    rrdtool would store from it, and every `interval` seconds (the members' interval, unless it's
+    set) I write the sum, average and maximum of each data source over the members that have
+    reported lately, along with how many that was.
+
+    Members are fed to me in the process that polls them, so with `poll_workers` or a cluster, a
+    group and its members are always polled by the same poller on the same node, see shard.placements.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from stats.base import BaseTemplate
+from stats import util
+import time
+
+class Aggregate(BaseTemplate):
+    interval = 60
+    numGraphs = 3
+    aliases = ['sum', 'avg', 'max']
+    rollup = True
+    sharedDefinitions = False # my data sources, and so my database and graphs, are config['ds'].
+
+    _functions = [
+        ('sum', 'total'),
+        ('avg', 'average per member'),
+        ('max', 'most of any member'),
+    ]
+
+    def init(self):
+        from stats.templates import load_template
+
+        self.config.setdefault('ids', [])
+        members = load_template(self.config['template'])(testing = True, id = self.id, config = {})
+        self.interval = self.config.get('interval', members.interval)
+
+        self._memberSources = members._dataSources()
+        types = dict(self._memberSources)
+        self.config.setdefault('ds', [name for name, type in self._memberSources])
+        for name in self.config['ds']:
+            if name not in types:
+                raise ValueError('%r has no data source %r to roll up' % (self.config['template'], name))
+        self._types = [(name, types[name]) for name in self.config['ds']]
+
+        if not hasattr(self, '_rates'):
+            # Kept when I'm reconfigured, the members still in the group carry on.
+            self._last = {} # member id -> (time, {data source: value}) of the last update it wrote.
+            self._rates = {} # member id -> (time, {data source: rate}) of the last update it wrote.
+
+    def _column(self, name, function):
+        # rrdtool wants data source names of at most 19 characters.
+        return '%s_%s' % (name[:15], function)
+
+    def create(self):
+        yield '-s %(interval)i'
+
+        for name in self.config['ds']:
+            for function, title in self._functions:
+                yield "DS:%s:GAUGE:%%(2interval)s:U:U" % self._column(name, function)
+        yield "DS:members:GAUGE:%(2interval)s:0:U"
+
+        yield  "RRA:AVERAGE:0.5:1:2880"
+        yield  "RRA:AVERAGE:0.5:30:672"
+        yield  "RRA:AVERAGE:0.5:120:732"
+        yield  "RRA:AVERAGE:0.5:720:1460"
+
+    def run(self):
+        BaseTemplate.run(self)
+        for id in self.config['ids']:
+            self.factory.rollups.setdefault(id, []).append(self)
+
+    def stop(self):
+        if self.running:
+            self._unlink()
+        BaseTemplate.stop(self)
+
+    def reconfigure(self, config):
+        if self.running:
+            self._unlink()
+        BaseTemplate.reconfigure(self, config)
+        if self.running:
+            for id in self.config['ids']:
+                self.factory.rollups.setdefault(id, []).append(self)
+
+    def _unlink(self):
+        rollups = self.factory.rollups
+        for id in self.config['ids']:
+            if self in rollups.get(id, ()):
+                rollups[id].remove(self)
+                if not rollups[id]:
+                    del rollups[id]
+
+    def feed(self, member, data):
+        """ `member` is writing `data`, what its update() returned, to its database. """
+        fields = data.split(':')
+        t = time.time() if fields[0] == 'N' else float(fields[0])
+        values = {}
+        for (name, type), value in zip(self._memberSources, fields[1:]):
+            if value != 'U':
+                values[name] = float(value)
+
+        last = self._last.get(member.id)
+        elapsed = t - last[0] if last else member.interval
+        rates = {}
+        if elapsed > 0:
+            for name, type in self._types:
+                value = values.get(name)
+                if value is None:
+                    continue
+                if type == 'GAUGE':
+                    rates[name] = value
+                elif type == 'ABSOLUTE':
+                    rates[name] = value / elapsed
+                elif last and name in last[1]:
+                    # COUNTER or DERIVE, a counter that went down was reset.
+                    rate = (value - last[1][name]) / elapsed
+                    if rate >= 0 or type == 'DERIVE':
+                        rates[name] = rate
+
+        self._last[member.id] = (t, values)
+        self._rates[member.id] = (t, rates)
+
+    def do_work(self):
+        """ Roll up the rates of the members that have written an update in the last two intervals. """
+        now = time.time()
+        fresh = []
+        for id in self.config['ids']:
+            t, rates = self._rates.get(id, (None, None))
+            if t is not None and now - t < 2 * self.interval:
+                fresh.append(rates)
+
+        if not fresh:
+            return None
+
+        values = []
+        for name, type in self._types:
+            rates = [member[name] for member in fresh if name in member]
+            if rates:
+                values += ['%f' % sum(rates), '%f' % (sum(rates) / len(rates)), '%f' % max(rates)]
+            else:
+                values += ['U', 'U', 'U']
+        values.append(str(len(fresh)))
+
+        return 'N:' + ':'.join(values)
+
+    def update(self, data):
+        return data
+
+    def graph(self):
+        colors = util.colors(len(self.config['ds']))
+        for function, title in self._functions:
+            graph = [
+                "-s -1%(period)s",
+                "-t %%(id)s, %s of %i %s graphs" % (title, len(self.config['ids']), self.config['template']),
+                "--lazy",
+                "-h", "150", "-w", "700",
+                "-a", "PNG",
+            ]
+            for name, color in zip(self.config['ds'], colors):
+                column = self._column(name, function)
+                graph += [
+                    "DEF:%s=%%(filename)s:%s:AVERAGE" % (column, column),
+                    "LINE2:%s%s:%s" % (column, color, name),
+                    "GPRINT:%s:MAX:  Max\\: %%%%7.2lf %%%%S" % column,
+                    "GPRINT:%s:AVERAGE: Avg\\: %%%%7.2lf %%%%S" % column,
+                    "GPRINT:%s:LAST: Current\\: %%%%7.2lf %%%%S\\r" % column,
+                ]
+            yield graph
+
+template = Aggregate
+
+import unittest
+
+class TestAggregate(unittest.TestCase):
+    class Member(BaseTemplate):
+        __slots__ = ()
+        interval = 10
+
+    def setUp(self):
+        self.aggregate = Aggregate(testing = True, id = 'web', config = dict(template = 'nginx', ids = ['web1', 'web2'], ds = ['active', 'requests']))
+        self.members = [self.Member(testing = True, id = id) for id in ('web1', 'web2')]
+
+    def test_rollup(self):
+        now = time.time()
+        self.aggregate.feed(self.members[0], '%i:4:100:0:4:5' % (now - 10))
+        self.aggregate.feed(self.members[1], '%i:6:300:0:4:5' % (now - 10))
+        self.aggregate.feed(self.members[0], '%i:2:50:0:4:5' % now)
+        # active is a GAUGE, requests is ABSOLUTE, per 10 seconds.
+        self.assertEqual(self.aggregate.do_work(), 'N:%f:%f:%f:%f:%f:%f:2' % (8, 4, 6, 35, 17.5, 30))
+
+    def test_stale(self):
+        self.aggregate.feed(self.members[0], '%i:4:100:0:4:5' % (time.time() - 3 * self.aggregate.interval))
+        self.assertEqual(self.aggregate.do_work(), None)
+
+    def test_unknown_ds(self):
+        self.assertRaises(ValueError, Aggregate, testing = True, id = 'web', config = dict(template = 'nginx', ds = ['nope']))
+
+if __name__ == '__main__':
+    unittest.main()
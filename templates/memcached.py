@@ -11,10 +11,9 @@
 from stats.base import BaseTemplate
 from twisted.internet import reactor, protocol
 from twisted.protocols.memcache import MemCacheProtocol, DEFAULT_PORT
-from twisted.python import log
-import logging
 
 class Memcached(BaseTemplate):
+    __slots__ = ()
     interval = 60
     numGraphs = 4
     aliases = ['requests', 'memory', 'connections', 'io']
@@ -30,6 +29,7 @@ class Memcached(BaseTemplate):
     _gaugeFields = frozenset([
         'curr_connections', 'bytes'
     ])
+    _counterFields = [key for key in _wantedFields if key not in _gaugeFields]
     
     dataFactory = lambda self, data: dict((k, int(v)) for k, v in data.iteritems() if k in self._wantedFieldsSet)
     
@@ -125,38 +125,26 @@ class Memcached(BaseTemplate):
             )
         ]
     
-    def do_work(self):
-        d = protocol.ClientCreator(reactor, MemCacheProtocol).connectTCP(self.config['host'], self.config['port'])
-        d.addCallback(
-            lambda proto: proto.stats().addBoth(
-                lambda res: (res, proto.transport.loseConnection())[0]
-            )
+    def _connect(self):
+        return protocol.ClientCreator(reactor, MemCacheProtocol, timeOut = self.interval).connectTCP(
+            self.config['host'], self.config['port'], timeout = self.interval
         )
+    
+    def do_work(self):
+        d = self.getConnection(self._connect)
+        d.addCallback(lambda proto: proto.stats())
+        d.addErrback(self.dropConnection)
         return d
     
     def update(self, data):
-        if self.successfulRequests == 0:
-            self._lastData = data
+        deltas = self._deltas([data[key] for key in self._counterFields])
+        if deltas is None:
             return
         
-        curData = {}
-        invalid = False
-        for key in self._wantedFields:
-            if key in self._gaugeFields:
-                curData[key] = data[key]
-            else:
-                d = data[key] - self._lastData[key]
-                if d < 0:
-                    log.msg('[%s] field [%s] returned negative delta, possible server restart?' % (self.id, key), logLevel = logging.INFO)
-                    invalid = True
-                    break
-                curData[key] = d
-                
-        self._lastData = data
+        curData = dict(zip(self._counterFields, deltas))
+        for key in self._gaugeFields:
+            curData[key] = data[key]
         
-        if invalid:
-            return
-
         return ('N%s' % (':%i' * len(self._wantedFields))) % tuple([
             curData[key] for key in self._wantedFields
         ])
@@ -9,22 +9,29 @@
 """
 
 from stats.base import BaseTemplate
-from twisted.internet import reactor, protocol
+from stats import mysqlclient
 from twisted.internet.threads import deferToThread
-from twisted.python import log
-import logging
-try:
-    import MySQLdb as mysqldb
-except ImportError:
-    try:
-        import pymysql as mysqldb
-    except ImportError:
-        raise RuntimeError("No appropriate mysql drivers found :(")
+
+_mysqldb = [] # MySQLdb or pymysql, or None if there's neither, imported the first time a graph wants driver = 'mysqldb'.
+
+def mysqldb():
+    if not _mysqldb:
+        try:
+            import MySQLdb as driver
+        except ImportError:
+            try:
+                import pymysql as driver
+            except ImportError:
+                # We can still talk to MySQL ourselves, see mysqlclient.
+                driver = None
+        _mysqldb.append(driver)
+    return _mysqldb[0]
 
 
 DEFAULT_PORT = 3306
 
 class MySQL(BaseTemplate):
+    __slots__ = ()
     interval = 60
     numGraphs = 4
     aliases = ['queries', 'qcache', 'handler', 'io']
@@ -33,36 +40,55 @@ class MySQL(BaseTemplate):
         self.config.setdefault('port', DEFAULT_PORT)
         self.config.setdefault('idle_timeout', self.interval + 10)
         self.config.setdefault('connect_timeout', 15)
+        # 'native' talks to the server on the reactor, 'mysqldb' uses MySQLdb (or pymysql) in the threadpool.
+        self.config.setdefault('driver', 'native')
         
-    def _threadedWork(self):
-        wanted = self._wantedFieldsSet
-        conn = mysqldb.connect(
+        if self.config['driver'] == 'mysqldb' and mysqldb() is None:
+            raise RuntimeError("No appropriate mysql drivers found :(")
+    
+    def _connectNative(self):
+        return mysqlclient.connect(
+            self.config['host'],
+            self.config['port'],
+            user = self.config['user'],
+            password = self.config['passwd'],
+            timeout = self.config['connect_timeout']
+        )
+    
+    def _connect(self):
+        return deferToThread(
+            mysqldb().connect,
             host = self.config['host'],
             passwd = self.config['passwd'],
             port = self.config['port'],
-            user = self.config['user']
+            user = self.config['user'],
+            connect_timeout = self.config['connect_timeout']
         )
+    
+    def _close(self, conn):
+        deferToThread(conn.close).addErrback(lambda err: None)
+    
+    def _threadedWork(self, conn):
+        cur = conn.cursor()
+        cur.execute(self._statusQuery)
+        rows = cur.fetchall()
+        cur.close()
         
+        return rows
+    
+    def _parseStatus(self, rows):
+        wanted = self._wantedFieldsSet
         result = {}
         
-        cur = conn.cursor()
-        cur.execute('SHOW GLOBAL STATUS')
-        for k, v in cur:
+        for k, v in rows:
             k = k.lower()[:19]
             if k in wanted or k == 'uptime':
                 result[k] = long(v)
-                
-        cur.close()
-        conn.close()
         
         return result
-        
-    def stop(self):
-        """ Override to disconnect from MySQL """
-        self.conn.disconnect()
-        BaseTemplate.stop(self)
     
-    _wantedFields = [s.lower()[:19] for s in sorted([
+    # The names of the status variables we graph, rrdtool only allows 19 characters in a DS name.
+    _statusVariables = sorted([
         'Questions', 'Open_tables', 'Bytes_sent', 'Bytes_received', 'Open_files', 'Key_read_requests', 'Key_reads', 'Qcache_hits', 'Qcache_queries_in_cache', 'Qcache_not_cached',
         'Handler_read_key',
         'Handler_delete',
@@ -76,12 +102,19 @@ class MySQL(BaseTemplate):
         'Handler_read_first',
         'Handler_rollback',
         
-    ])]
+    ])
+    _wantedFields = [s.lower()[:19] for s in _statusVariables]
     _wantedFieldsSet = frozenset(_wantedFields)
     
+    # Only ask for what we need, instead of the few hundred variables SHOW GLOBAL STATUS has.
+    _statusQuery = 'SHOW GLOBAL STATUS WHERE Variable_name IN (%s)' % ', '.join(
+        "'%s'" % name for name in _statusVariables + ['Uptime']
+    )
+    
     _gaugeFields = frozenset(s.lower()[:19] for s in [
         'Open_tables', 'Open_files', 'Qcache_queries_in_cache'
     ])
+    _counterFields = [key for key in _wantedFields if key not in _gaugeFields] + ['uptime']
     
     #dataFactory = lambda self, data: dict((k, int(v)) for k, v in data.iteritems() if k in self._wantedFieldsSet)
     
@@ -198,39 +231,27 @@ class MySQL(BaseTemplate):
 
     
     def do_work(self):
-        return deferToThread(
-            self._threadedWork
-        )
+        if self.config['driver'] == 'native':
+            d = self.getConnection(self._connectNative, close = lambda proto: proto.quit())
+            d.addCallback(lambda proto: proto.query(self._statusQuery))
+        else:
+            d = self.getConnection(self._connect, isAlive = lambda conn: conn.open, close = self._close)
+            d.addCallback(lambda conn: deferToThread(self._threadedWork, conn))
+        
+        d.addErrback(self.dropConnection)
+        d.addCallback(self._parseStatus)
+        return d
     
     def update(self, data):
-        if self.successfulRequests == 0:
-            self._lastData = data
-            return
-        
-        if data['uptime'] < self._lastData['uptime']:
-            self._lastData = data
-            log.msg('Detected server restart, invalidating current stats...', logLevel = logging.INFO)
+        # Uptime going down is a restart, even if every counter has since gone past where it was.
+        deltas = self._deltas([data[key] for key in self._counterFields])
+        if deltas is None:
             return
         
-        curData = {}
-        invalid = False
-        for key in self._wantedFields:
-            if key in self._gaugeFields:
-                curData[key] = data[key]
-            else:
-                d = data[key] - self._lastData[key]
-                if d < 0:
-                    log.msg('[%s] field [%s] returned negative delta, possible server restart?' % (self.id, key), logLevel = logging.INFO)
-                    invalid = True
-                    break
-                curData[key] = d
-                
-        self._lastData = data
+        curData = dict(zip(self._counterFields, deltas))
+        for key in self._gaugeFields:
+            curData[key] = data[key]
         
-        if invalid:
-            return
-
-
         return ('N%s' % (':%i' * len(self._wantedFields))) % tuple([
             curData[key] for key in self._wantedFields
         ])
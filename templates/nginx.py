@@ -11,10 +11,13 @@
 
 from collections import namedtuple
 from stats.base import BaseTemplate
-from twisted.web.client import getPage
+from twisted.internet import reactor
+from twisted.web.client import readBody
+from twisted.web.error import Error
 import re
 
 class Nginx(BaseTemplate):
+    __slots__ = ()
     dataFactory = namedtuple('nginxStatsTuple', 'active requests reading writing waiting')
     interval = 60
     numGraphs = 2
@@ -95,10 +98,20 @@ class Nginx(BaseTemplate):
             )
         ]
     
+    def _response(self, response):
+        d = readBody(response)
+        if response.code != 200:
+            def error(body):
+                raise Error(response.code, response.phrase, body)
+            d.addCallback(error)
+        return d
+    
     def do_work(self):
-        return getPage(
-            'http://%s:%i/app_status' % (self.config['host'], self.config['port'])
-        )
+        # The connection is kept alive between polls, as long as nginx lets us, see TemplateRunner.http.
+        d = self.factory.http.request('GET', 'http://%s:%i/app_status' % (self.config['host'], self.config['port']))
+        d.addTimeout(self.interval, reactor)
+        d.addCallback(self._response)
+        return d
     
     _parseRegexps = re.compile(
         "Active connections:\s+(\d+) \r?\n"
@@ -110,21 +123,13 @@ class Nginx(BaseTemplate):
     def parse(self, data):
         return self.dataFactory(*[int(i) for i in self._parseRegexps.match(data).groups()])
     
-    _lastRequestsNumber = 0
-    
     def update(self, data):
-        if self.successfulRequests == 0:
-            self._lastRequestsNumber = data.requests
+        # nginx counts requests from zero again when it restarts, so those are written like they always were.
+        deltas = self._deltas([data.requests], fromZero = True)
+        if deltas is None:
             return
         
-        if data.requests < self._lastRequestsNumber:
-            requests = data.requests
-        else:
-            requests = data.requests - self._lastRequestsNumber
-        
-        self._lastRequestsNumber = data.requests
-        
-        return 'N:%i:%i:%i:%i:%s' % (data.active, requests, data.reading, data.writing, data.waiting)
+        return 'N:%i:%i:%i:%i:%s' % (data.active, deltas[0], data.reading, data.writing, data.waiting)
         
         
 
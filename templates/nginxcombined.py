@@ -8,8 +8,8 @@
     :license: BSD!
 """
 
-import stats.proc_rrd as rrdtool
 from stats.base import BaseTemplate
+from stats import util
 from twisted.python import log
 from twisted.internet.defer import inlineCallbacks
 import os.path
@@ -17,9 +17,11 @@ import time
 import logging
 
 class Nginx(BaseTemplate):
+    __slots__ = ()
     interval = 0
     numGraphs = 1
     useDatabase = False
+    sharedDefinitions = False # my graph is drawn from the databases of config['ids'].
     aliases = ['requests']
     
     @inlineCallbacks
@@ -29,20 +31,40 @@ class Nginx(BaseTemplate):
             'filename': self.filename
         }
         filename = '%s-%s.0.png' % (self.id, period)
+        args = list(self.graph(fmt_dict))
+        
+        # We're drawn from the databases of the nginx templates we combine, so skip
+        # drawing unless one of their RRAs has a new row since the last time.
+        graphs = self.factory.stats.active_graphs
+        sources = [graphs.get(id) for id in self.config['ids']]
+        step = sources[0]._rraStep(period, args) if sources and sources[0] is not None else None
+        state = self._sourceState(step, sources) if step else None
+        if self._skipGraph(period, 0, state):
+            return
         
         log.msg('Generating graph %r!' % filename, logLevel = logging.DEBUG)
+        self.graphsRendered += 1
         try:
-            yield rrdtool.graph(
+            yield self._rrdGraph(
                 os.path.join(self.factory.stats.config['image_path'], filename),
-                *list(self.graph(fmt_dict))
+                args, period
             )
             self.factory.stats.last_draw_timestamp[filename] = int(time.time())
+            self._setDrawnState(period, 0, state)
         except:
             log.err()
+    
+    def _graphOne(self, period, index):
+        """ I only have the one graph. """
+        return self._graph(period)
+    
+    def _graphDefinition(self, period, index):
+        return list(self.graph({'period': period, 'filename': self.filename}))
                 
     def graph(self, fmt_dict):
         db = self.factory.make_filename
         colors = '#FFA500 #FF7F50 #FF0000 #FF00FF'.split(' ')
+        colors += util.colors(len(self.config['ids']) - len(colors))
         
         yield "-s -1%(period)s" % fmt_dict
         yield "-t"
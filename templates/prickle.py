@@ -0,0 +1,164 @@
+"""
+    prickle.templates.prickle
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    I graph how prickle itself is doing, from the same numbers /metrics shows.
+
+    :copyright: (c) 2011 Edgeworth E. Euler
+    :license: BSD!
+"""
+
+from stats.base import BaseTemplate
+import stats.metrics as metrics
+import stats.proc_rrd as rrdtool
+
+class Prickle(BaseTemplate):
+    __slots__ = ()
+    interval = 60
+    numGraphs = 4
+    aliases = ['polls', 'latency', 'queues', 'wsgi']
+    sortPriority = -1
+
+    _wantedFields = [
+        'polls', 'poll_errors', 'poll_ms', 'renders', 'render_ms', 'rrd_started', 'rrd_wait_ms',
+        'update_queue', 'graph_queue', 'wsgi_working', 'wsgi_backlog'
+    ]
+
+    # Everything else is a running total.
+    _gaugeFields = frozenset([
+        'update_queue', 'graph_queue', 'wsgi_working', 'wsgi_backlog'
+    ])
+
+    def create(self):
+        yield '-s %(interval)i'
+
+        for field in self._wantedFields:
+            yield "DS:%s:%s:%%(2interval)s:0:U" % (
+                field, 'GAUGE' if field in self._gaugeFields else 'DERIVE',
+            )
+
+        yield  "RRA:AVERAGE:0.5:1:2880"
+        yield  "RRA:AVERAGE:0.5:30:672"
+        yield  "RRA:AVERAGE:0.5:120:732"
+        yield  "RRA:AVERAGE:0.5:720:1460"
+
+    def graph(self):
+        return [
+            (
+                "-s -1%(period)s",
+                "-t %(id)s polls/second",
+                "--lazy",
+                "-h", "150", "-w", "700",
+                "-l 0",
+                "-a", "PNG",
+                "-v polls/sec",
+                "DEF:polls=%(filename)s:polls:AVERAGE",
+                "DEF:poll_errors=%(filename)s:poll_errors:AVERAGE",
+                "AREA:polls#BFFF00:Polls",
+                "GPRINT:polls:MAX:  Max\\: %%7.2lf",
+                "GPRINT:polls:AVERAGE: Avg\\: %%7.2lf",
+                "GPRINT:polls:LAST: Current\\: %%7.2lf polls/sec\\r",
+                "LINE2:poll_errors#FF0000:Failed",
+                "GPRINT:poll_errors:MAX: Max\\: %%7.2lf",
+                "GPRINT:poll_errors:AVERAGE: Avg\\: %%7.2lf",
+                "GPRINT:poll_errors:LAST: Current\\: %%7.2lf polls/sec\\r",
+                "HRULE:0#000000"
+            ), (
+                "-s -1%(period)s",
+                "-t %(id)s latency",
+                "--lazy",
+                "-h", "150", "-w", "700",
+                "-l 0",
+                "-a", "PNG",
+                "-v milliseconds",
+                "DEF:polls=%(filename)s:polls:AVERAGE",
+                "DEF:poll_ms=%(filename)s:poll_ms:AVERAGE",
+                "DEF:renders=%(filename)s:renders:AVERAGE",
+                "DEF:render_ms=%(filename)s:render_ms:AVERAGE",
+                "DEF:rrd_started=%(filename)s:rrd_started:AVERAGE",
+                "DEF:rrd_wait_ms=%(filename)s:rrd_wait_ms:AVERAGE",
+                # Time spent per second over things done per second, is time spent per thing.
+                "CDEF:poll=polls,0,GT,poll_ms,polls,/,0,IF",
+                "CDEF:render=renders,0,GT,render_ms,renders,/,0,IF",
+                "CDEF:wait=rrd_started,0,GT,rrd_wait_ms,rrd_started,/,0,IF",
+                "LINE2:poll#0022FF:Poll",
+                "GPRINT:poll:MAX:          Max\\: %%7.1lf",
+                "GPRINT:poll:AVERAGE: Avg\\: %%7.1lf",
+                "GPRINT:poll:LAST: Current\\: %%7.1lf ms\\r",
+                "LINE2:render#FF9800:Render",
+                "GPRINT:render:MAX:        Max\\: %%7.1lf",
+                "GPRINT:render:AVERAGE: Avg\\: %%7.1lf",
+                "GPRINT:render:LAST: Current\\: %%7.1lf ms\\r",
+                "LINE2:wait#FF0000:rrdtool wait",
+                "GPRINT:wait:MAX:  Max\\: %%7.1lf",
+                "GPRINT:wait:AVERAGE: Avg\\: %%7.1lf",
+                "GPRINT:wait:LAST: Current\\: %%7.1lf ms\\r",
+                "HRULE:0#000000"
+            ), (
+                "-s -1%(period)s",
+                "-t %(id)s rrdtool queues",
+                "--lazy",
+                "-h", "150", "-w", "700",
+                "-l 0",
+                "-a", "PNG",
+                "-v commands waiting",
+                "DEF:update_queue=%(filename)s:update_queue:AVERAGE",
+                "DEF:graph_queue=%(filename)s:graph_queue:AVERAGE",
+                "LINE2:update_queue#22FF22:Updates",
+                "GPRINT:update_queue:LAST:  Current\\: %%7.1lf",
+                "GPRINT:update_queue:AVERAGE: Avg\\: %%7.1lf",
+                "GPRINT:update_queue:MAX: Max\\: %%7.1lf\\r",
+                "LINE2:graph_queue#CC00FF:Graphs",
+                "GPRINT:graph_queue:LAST:   Current\\: %%7.1lf",
+                "GPRINT:graph_queue:AVERAGE: Avg\\: %%7.1lf",
+                "GPRINT:graph_queue:MAX: Max\\: %%7.1lf\\r",
+                "HRULE:0#000000"
+            ), (
+                "-s -1%(period)s",
+                "-t %(id)s web frontend threads",
+                "--lazy",
+                "-h", "150", "-w", "700",
+                "-l 0",
+                "-a", "PNG",
+                "-v threads",
+                "DEF:wsgi_working=%(filename)s:wsgi_working:AVERAGE",
+                "DEF:wsgi_backlog=%(filename)s:wsgi_backlog:AVERAGE",
+                "AREA:wsgi_working#00AAAA:Working",
+                "GPRINT:wsgi_working:LAST:  Current\\: %%5.1lf",
+                "GPRINT:wsgi_working:AVERAGE: Avg\\: %%5.1lf",
+                "GPRINT:wsgi_working:MAX: Max\\: %%5.1lf\\r",
+                "LINE2:wsgi_backlog#FF0000:Waiting",
+                "GPRINT:wsgi_backlog:LAST:  Current\\: %%5.1lf",
+                "GPRINT:wsgi_backlog:AVERAGE: Avg\\: %%5.1lf",
+                "GPRINT:wsgi_backlog:MAX: Max\\: %%5.1lf requests\\r",
+                "HRULE:0#000000"
+            )
+        ]
+
+    def do_work(self):
+        polls, pollSeconds = metrics.poll_duration.total()
+        renders, renderSeconds = metrics.render_duration.total()
+        lanes = rrdtool.queue_stats()
+        working, idle, backlog, max = metrics.threadpool_stats(self.factory.stats.wsgi_threadpool)
+
+        return dict(
+            polls = polls,
+            poll_errors = metrics.poll_duration.total(result = 'error')[0],
+            poll_ms = pollSeconds * 1000,
+            renders = renders,
+            render_ms = renderSeconds * 1000,
+            rrd_started = sum([lane['started'] for lane in lanes.itervalues()]),
+            rrd_wait_ms = sum([lane['totalWait'] for lane in lanes.itervalues()]) * 1000,
+            update_queue = lanes['update']['queued'],
+            graph_queue = lanes['graph']['queued'],
+            wsgi_working = working,
+            wsgi_backlog = backlog
+        )
+
+    def update(self, data):
+        # DERIVE only takes integers.
+        return ('N%s' % (':%i' * len(self._wantedFields))) % tuple([
+            data[key] for key in self._wantedFields
+        ])
+
+template = Prickle
@@ -1,35 +1,227 @@
-from twisted.internet.defer import Deferred, DeferredSemaphore, DeferredLock, maybeDeferred
+from twisted.internet.defer import Deferred, maybeDeferred, fail
+from twisted.python.failure import Failure
 from functools import wraps
+from collections import deque
+import colorsys
+import time
+
+class LimiterQueueFull(Exception):
+    """ A lane of a DeferredConcurrencyLimiter had too many calls waiting already, so this one was shed. """
+
+class _Lane(object):
+    """ One priority class of a DeferredConcurrencyLimiter, and what it's been up to. """
+    
+    def __init__(self, name, weight, cap, maxQueue, merge):
+        self.name = name
+        self.weight = weight
+        self.cap = cap
+        self.maxQueue = maxQueue
+        self.merge = merge
+        self.queue = deque() # (waiters, f, a, kw, key, queuedAt)
+        self.queued = {} # key -> waiters, of calls in the queue that later calls with the same key merge into.
+        self.active = 0
+        self.current = 0 # for the smooth weighted round robin.
+        self.started = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.shed = 0
+        self.merged = 0
+    
+    def stats(self):
+        return dict(
+            weight = self.weight,
+            cap = self.cap,
+            queued = len(self.queue),
+            active = self.active,
+            started = self.started,
+            totalWait = self.totalWait,
+            meanWait = self.totalWait / self.started if self.started else 0.0,
+            maxWait = self.maxWait,
+            shed = self.shed,
+            merged = self.merged
+        )
 
 class DeferredConcurrencyLimiter:
-    """Initiliaze me, and then use me as a decorator, to limit the ammount of defers that can execute asynchronously."""
+    """
+        Initiliaze me, and then use me as a decorator, to limit the ammount of defers that can execute asynchronously.
+        
+        Calls can be split into lanes with addLane(), and decorated with lane(name). When a token frees up, it goes to
+        the lane next in line by weight (a smooth weighted round robin), skipping lanes that are waiting on nothing or
+        already have `cap` calls running. A lane with a `maxQueue` sheds calls once that many are waiting, failing them
+        with LimiterQueueFull, and in a lane that merges, a call with the same first argument as one that's still
+        waiting just shares its result.
+    """
     
-    def __init__(self, tokens = 5):
+    def __init__(self, tokens = 5, maxQueue = None):
         if tokens < 1:
             raise ValueError("tokens must be > 0")
         
-        if tokens == 1:
-            self.lock = DeferredLock()
-        else:
-            self.lock = DeferredSemaphore(tokens)
+        self.tokens = tokens
+        self.active = 0
+        self.lanes = {}
+        self._dispatching = False
+        self.addLane('default', maxQueue = maxQueue)
+    
+    def addLane(self, name, weight = 1, cap = None, maxQueue = None, merge = False):
+        if weight < 1:
+            raise ValueError("weight must be > 0")
+        
+        self.lanes[name] = _Lane(name, weight, cap, maxQueue, merge)
     
-    def _releaseLock(self, response, lock):
-        lock.release()
-        return response
+    def stats(self):
+        """ Returns what each lane is up to, and how long calls have waited in it. """
+        return dict((name, lane.stats()) for name, lane in self.lanes.iteritems())
     
-    def _lockAcquired(self, lock, f, *a, **kw):
-        d = maybeDeferred(f, *a, **kw)
-        d.addBoth(self._releaseLock, lock)
+    def run(self, name, f, *a, **kw):
+        """ Call f(*a, **kw) in lane `name` once there's a token free for it, returns a deferred that fires with its result. """
+        lane = self.lanes[name]
+        d = Deferred()
+        key = a[0] if lane.merge and a else None
+        
+        if key is not None and key in lane.queued:
+            lane.merged += 1
+            lane.queued[key].append(d)
+            return d
+        
+        if lane.maxQueue is not None and len(lane.queue) >= lane.maxQueue:
+            lane.shed += 1
+            return fail(LimiterQueueFull('%i calls are already waiting in the %r lane' % (len(lane.queue), name)))
+        
+        waiters = [d]
+        lane.queue.append((waiters, f, a, kw, key, time.time()))
+        if key is not None:
+            lane.queued[key] = waiters
+        
+        self._dispatch()
         return d
     
+    def _pick(self):
+        """ The lane that gets the next free token, if any can take it. """
+        best = None
+        total = 0
+        for lane in self.lanes.itervalues():
+            if not lane.queue or (lane.cap is not None and lane.active >= lane.cap):
+                continue
+            
+            lane.current += lane.weight
+            total += lane.weight
+            if best is None or lane.current > best.current:
+                best = lane
+        
+        if best is not None:
+            best.current -= total
+        return best
+    
+    def _dispatch(self):
+        if self._dispatching:
+            # We're already in the loop below, it'll get to it.
+            return
+        
+        self._dispatching = True
+        try:
+            while self.active < self.tokens:
+                lane = self._pick()
+                if lane is None:
+                    break
+                
+                waiters, f, a, kw, key, queuedAt = lane.queue.popleft()
+                if key is not None:
+                    del lane.queued[key]
+                
+                wait = time.time() - queuedAt
+                lane.started += 1
+                lane.totalWait += wait
+                lane.maxWait = max(lane.maxWait, wait)
+                
+                self.active += 1
+                lane.active += 1
+                maybeDeferred(f, *a, **kw).addBoth(self._done, lane, waiters)
+        finally:
+            self._dispatching = False
+    
+    def _done(self, result, lane, waiters):
+        self.active -= 1
+        lane.active -= 1
+        self._dispatch()
+        
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+    
+    def lane(self, name):
+        """ A decorator that limits calls to the function in lane `name`. """
+        def decorator(f):
+            @wraps(f)
+            def wrapped(*a, **kw):
+                return self.run(name, f, *a, **kw)
+            
+            return wrapped
+        
+        return decorator
+    
     def __call__(self, f):
-        @wraps(f)
-        def wrapped(*a, **kw):
-            d = self.lock.acquire()
-            d.addCallback(self._lockAcquired, f, *a, **kw)
+        return self.lane('default')(f)
+
+class DeferredCoalescer:
+    """I make sure only one call per key is in flight, everyone else asking for the same key while it runs shares its result."""
+    
+    def __init__(self):
+        self.inflight = {}
+    
+    def _done(self, result, key):
+        for d in self.inflight.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+    
+    def __call__(self, key, f, *a, **kw):
+        d = Deferred()
+        if key in self.inflight:
+            self.inflight[key].append(d)
             return d
         
-        return wrapped
+        self.inflight[key] = [d]
+        maybeDeferred(f, *a, **kw).addBoth(self._done, key)
+        return d
+
+def pick_rra(pdp_step, rras, start, end, step, last_update = None):
+    """
+        Picks the RRA rrdtool would fetch [start, end] from when asked for a resolution of `step` seconds, the same way
+        rrd_fetch does: out of the RRAs that reach back to `start` the one whose step is closest to `step`, otherwise the
+        one that covers the most of the range. `rras` is a sequence of (pdp_cnt, row_cnt), I return an index into it.
+    """
+    if last_update is None:
+        last_update = end
+    
+    best_full = best_part = None
+    for i, (pdp_cnt, row_cnt) in enumerate(rras):
+        rra_step = pdp_step * pdp_cnt
+        cal_end = last_update - last_update % rra_step
+        cal_start = cal_end - rra_step * row_cnt
+        diff = abs(step - rra_step)
+        
+        if cal_start <= start:
+            if best_full is None or diff < best_full[0]:
+                best_full = (diff, i)
+        else:
+            match = (end - start) - (cal_start - start)
+            if best_part is None or match > best_part[0] or (match == best_part[0] and diff < best_part[1]):
+                best_part = (match, diff, i)
+    
+    if best_full is not None:
+        return best_full[1]
+    if best_part is not None:
+        return best_part[2]
+    return None
+
+def colors(n):
+    """ n colours, as rrdtool wants them (#RRGGBB), spread evenly around the colour wheel so every line of a graph gets its own. """
+    return [
+        '#%02X%02X%02X' % tuple([int(c * 255) for c in colorsys.hsv_to_rgb(float(i) / n, 0.8, 0.95)]) for i in xrange(n)
+    ]
 
 from functools import partial as _wrapFn
 